@@ -66,6 +66,13 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'default_cache'
     },
+    # Shared by all processes, for recording when cached data is invalidated. See ALGOBUILDER_INVALIDATION_CACHE.
+    'invalidation': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'algobuilder_invalidation_cache',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 100000}
+    },
 }
 
 CELERY_RESULT_BACKEND = 'django-db'
@@ -177,6 +184,98 @@ ALGOBUILDER_PRICEDATA_MAXPLOTS = 100
 ALGOBUILDER_PRICEDATA_SYMBOL_REFRESH_CRON = '{"month_of_year": "*", "day_of_month": "*", "day_of_week": "mon-fri", ' \
                                             '"hour": 23, "minute": 0}'
 
+# The zlib compression level, 1 to 9, of dataframes cached by the django_cache decorator, or 0 for no compression.
+# Compression reduces the size of candles by around a third, but is much slower, so is only worthwhile for caches
+# across a network. See python manage.py benchmark_cache_codec.
+ALGOBUILDER_CACHE_COMPRESSION = 0
+
+# The maximum number of seconds that calls to functions decorated by django_cache wait for another call with the same
+# arguments to retrieve output from the function, before retrieving it themselves
+ALGOBUILDER_CACHE_LOCK_TIMEOUT = 60
+
+# The Django cache that records when data cached in each process, e.g. feature results, is invalidated, so that writes in
+# one process invalidate the data cached in all of them. This must be shared by all processes, so can't be a local
+# memory cache. The database cache is shared by all processes using the database, and its table is created by the
+# migrations, but each check of whether cached data is invalidated is a database query. Memcached avoids this.
+ALGOBUILDER_INVALIDATION_CACHE = 'invalidation'
+
+# The number of feature executions whose most recent results are cached in each process by the feature result store,
+# and the maximum number of results cached for each.
+ALGOBUILDER_FEATURE_RESULT_CACHE_EXECUTIONS = 256
+ALGOBUILDER_FEATURE_RESULT_CACHE_ROWS = 10000
+
+# The size of each chunk when backfilling the history of a new feature execution. Feature executions with more history
+# than this are backfilled in parallel chunks.
+ALGOBUILDER_FEATURE_BACKFILL_CHUNK_SIZE = '7D'
+
+# The number of rows to delete at a time when deleting inactive feature results after a recompute
+ALGOBUILDER_FEATURE_DELETE_BATCH_SIZE = 10000
+
+# The number of datasource symbol candle periods whose most recent candles are cached in each worker process for
+# feature calculations, and the maximum number of candles cached for each.
+ALGOBUILDER_CANDLE_CACHE_SYMBOLS = 100
+ALGOBUILDER_CANDLE_CACHE_ROWS = 100000
+
+# Whether the most recent candles for each datasource symbol and candle period are held in shared memory by price
+# retrieval, so that feature workers on the same host read them without querying the database, and the maximum number
+# of candles held for each. Each holds 80 bytes per candle.
+ALGOBUILDER_CANDLE_SHARED_MEMORY = False
+ALGOBUILDER_CANDLE_SHARED_ROWS = 10000
+
+# The directory for the memory mapped candle files used by notebooks and research, read by
+# pricedata.files.CandleFileCache and written by the export_candles command.
+ALGOBUILDER_CANDLE_FILE_DIR = os.path.join(BASE_DIR, 'candles')
+
+# The size of the windows that ticks are retrieved from datasources, stored and aggregated into candles in. A number
+# followed by any valid pandas timeseries offset alias.
+ALGOBUILDER_PRICEDATA_TICK_WINDOW = '1D'
+
+# The maximum number of windows that datasources fetch concurrently, and the number of rows to aim for in each window,
+# when they fetch data in windows.
+ALGOBUILDER_PRICEDATA_FETCH_WORKERS = 4
+ALGOBUILDER_PRICEDATA_FETCH_TARGET_ROWS = 100000
+
+# The maximum number of symbols that async datasources retrieve prices for concurrently.
+ALGOBUILDER_PRICEDATA_ASYNC_CONCURRENCY = 100
+
+# How often the health of pooled datasource instances is checked, in seconds. Unhealthy instances are reconnected.
+ALGOBUILDER_PRICEDATA_DATASOURCE_HEALTH_CHECK_SECONDS = 60
+
+# The weekly market closure, as the day and UTC time that the market closes and the day and UTC time that it opens, e.g.
+# ('Fri 22:00', 'Sun 22:00') for forex. Used for symbols without trading sessions for themselves or their instrument
+# type. Candles aren't expected, and prices aren't retrieved, while the market is closed. None if the market never
+# closes, as for crypto. Markets that close are better configured with trading sessions for their instrument type.
+ALGOBUILDER_PRICEDATA_MARKET_CLOSED = None
+
+# How often the candles retrieved for each datasource candle period are checked for gaps. A number followed by any
+# valid pandas timeseries offset alias.
+ALGOBUILDER_PRICEDATA_GAP_CHECK_INTERVAL = '1H'
+
+# The maximum number of missing candles in each gap. Longer gaps are split, so that each repair retrieves a bounded
+# number of candles.
+ALGOBUILDER_PRICEDATA_GAP_MAX_CANDLES = 10000
+
+# The shortest candle period checked for gaps. Datasources usually build shorter candles from ticks, so they have no
+# candles for periods without ticks, which aren't gaps. Set to a shorter period, e.g. '1S', to check shorter candles.
+ALGOBUILDER_PRICEDATA_GAP_MIN_PERIOD = '1M'
+
+# The number of gaps repaired each time that the candles for a datasource candle period are checked, the rate that
+# each worker repairs them at (as a celery rate limit), and the number of attempts before a gap is marked unavailable.
+ALGOBUILDER_PRICEDATA_GAP_REPAIRS = 50
+ALGOBUILDER_PRICEDATA_GAP_REPAIR_RATE_LIMIT = '30/m'
+ALGOBUILDER_PRICEDATA_GAP_REPAIR_ATTEMPTS = 3
+
+# Adaptive scheduling of price retrieval, in seconds. Prices are retrieved this long after each candle closes, plus a
+# random jitter of up to the jitter, but no more often than the minimum interval. While no new candles are found,
+# retrieval backs off by up to the maximum backoff. Retrievals due further away than the maximum eta are left to the
+# periodic task. Each retrieval is claimed for the lease, after which it is due again in case the worker stopped.
+ALGOBUILDER_PRICEDATA_SCHEDULE_DELAY = 1
+ALGOBUILDER_PRICEDATA_SCHEDULE_JITTER = 2
+ALGOBUILDER_PRICEDATA_SCHEDULE_MIN_INTERVAL = 10
+ALGOBUILDER_PRICEDATA_SCHEDULE_MAX_BACKOFF = 300
+ALGOBUILDER_PRICEDATA_SCHEDULE_MAX_ETA = 3600
+ALGOBUILDER_PRICEDATA_SCHEDULE_LEASE = 600
+
 # Configure login from log-config.yaml
 with open(f'{BASE_DIR}/log-config.yaml', 'r') as f:
     config = yaml.safe_load(f.read())
@@ -1,9 +1,12 @@
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
+from django.db import connection
 from django.test import TestCase
 
-from algobuilder.utils import django_cache, DatabaseUtility
+from algobuilder.utils import django_cache, invalidate_django_cache, DataFrameCodec, DatabaseUtility
 from pricedata.models import Symbol
 
 
@@ -46,6 +49,137 @@ class DjangoCacheTest(TestCase):
         data2 = DecoratorTestClass().get_data_decorated('test2')
         self.assertFalse(data1.equals(data2))
 
+    def test_keys(self):
+        """
+        Test that calls with the same arguments share cached output, however they are passed, and that calls with
+        different arguments don't, however long they are.
+        :return:
+        """
+        class DecoratorTestClass:
+            @django_cache(tags=['test'])
+            def get_data(self, parameter: str, option: int = 1):
+                return pd.DataFrame({'random': [random.randint(0, 1000000)]})
+
+        data = DecoratorTestClass().get_data('test')
+        self.assertTrue(data.equals(DecoratorTestClass().get_data('test', 1)))
+        self.assertTrue(data.equals(DecoratorTestClass().get_data(parameter='test', option=1)))
+        self.assertFalse(data.equals(DecoratorTestClass().get_data('test', 2)))
+
+        long_parameter = 'x' * 300
+        data = DecoratorTestClass().get_data(long_parameter + 'a')
+        self.assertFalse(data.equals(DecoratorTestClass().get_data(long_parameter + 'b')))
+
+    def test_invalidation(self):
+        """
+        Test that cached output is retrieved again once its tag is invalidated or it times out, and not otherwise.
+        :return:
+        """
+        class DecoratorTestClass:
+            @django_cache(tags=['test_tag'])
+            def get_tagged(self):
+                return pd.DataFrame({'random': [random.randint(0, 1000000)]})
+
+            @django_cache(timeout=0)
+            def get_expired(self):
+                return pd.DataFrame({'random': [random.randint(0, 1000000)]})
+
+        data = DecoratorTestClass().get_tagged()
+        invalidate_django_cache('other_tag')
+        self.assertTrue(data.equals(DecoratorTestClass().get_tagged()))
+        invalidate_django_cache('test_tag')
+        self.assertFalse(data.equals(DecoratorTestClass().get_tagged()))
+
+        self.assertFalse(DecoratorTestClass().get_expired().equals(DecoratorTestClass().get_expired()))
+
+    def test_functions(self):
+        """
+        Test that the decorator caches free functions, static methods and class methods
+        :return:
+        """
+        @django_cache
+        def get_function(parameter: str):
+            return pd.DataFrame({'random': [random.randint(0, 1000000)], 'parameter': [parameter]})
+
+        class DecoratorTestClass:
+            @staticmethod
+            @django_cache
+            def get_static(parameter: str):
+                return get_function.__wrapped__(parameter)
+
+            @django_cache
+            @staticmethod
+            def get_static_inner(parameter: str):
+                return get_function.__wrapped__(parameter)
+
+            @classmethod
+            @django_cache
+            def get_class(cls, parameter: str):
+                return get_function.__wrapped__(parameter)
+
+        for function in [get_function, DecoratorTestClass.get_static, DecoratorTestClass().get_static,
+                         DecoratorTestClass.get_static_inner, DecoratorTestClass().get_static_inner,
+                         DecoratorTestClass.get_class]:
+            data = function('test')
+            self.assertEqual(data['parameter'].iloc[0], 'test')
+            self.assertTrue(data.equals(function('test')))
+            self.assertFalse(data.equals(function('test2')))
+
+    def test_single_flight(self):
+        """
+        Test that concurrent calls that miss the cache retrieve from the function once, and the others wait for it
+        :return:
+        """
+        calls = []
+
+        @django_cache
+        def get_slow(parameter: str):
+            calls.append(parameter)
+            time.sleep(0.5)
+            return pd.DataFrame({'random': [random.randint(0, 1000000)]})
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(get_slow, ['test'] * 4))
+        self.assertListEqual(calls, ['test'])
+        self.assertTrue(all(result.equals(results[0]) for result in results))
+
+        # Waiting calls retrieve from the function themselves if the call that locked raises an error
+        @django_cache
+        def get_error(parameter: str):
+            calls.append(parameter)
+            time.sleep(0.2)
+            if len(calls) == 2:
+                raise ValueError()
+            return pd.DataFrame({'random': [random.randint(0, 1000000)]})
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(get_error, 'error') for _ in range(0, 2)]
+        self.assertEqual(len([future for future in futures if future.exception() is None]), 1)
+        self.assertEqual(len(calls), 3)
+
+
+class DataFrameCodecTest(TestCase):
+    def test_codec(self):
+        """
+        Test that dataframes are serialised and deserialised with their dtypes and index, with and without compression
+        :return:
+        """
+        data = pd.DataFrame({'price': [1.23456789, 2.5, float('nan')], 'volume': [1, 2, 3], 'name': ['a', 'b', 'c']},
+                            index=pd.date_range('2021-01-01', periods=3, freq='1min', tz='UTC', name='time'))
+
+        for compression in [0, 6]:
+            decoded = DataFrameCodec.decode(DataFrameCodec.encode(data, compression=compression))
+            self.assertTrue(decoded.equals(data))
+            self.assertTrue(decoded.dtypes.equals(data.dtypes))
+            self.assertTrue(decoded.index.equals(data.index))
+
+            # The dataframe read back can be changed
+            decoded.iloc[0, 0] = 0
+            self.assertEqual(decoded['price'].iloc[0], 0)
+
+        # Bytes from another format version aren't read
+        with self.assertRaises(ValueError):
+            DataFrameCodec.decode(b'\x00' + DataFrameCodec.encode(data)[1:])
+
 
 class DatabaseUtilityTest(TestCase):
     def test_bulk_insert(self):
@@ -100,6 +234,43 @@ class DatabaseUtilityTest(TestCase):
         symbols = Symbol.objects.filter(instrument_type='CFD')
         self.assertEqual(len(symbols), 10)
 
+    def test_upsert_unchanged(self):
+        """
+        Test that upserting rows that already exist with the same values doesn't write them
+        """
+        df = pd.DataFrame(columns=['name', 'instrument_type'], data=[[f'Symbol_{i}', 'FOREX'] for i in range(0, 10)])
+        DatabaseUtility.bulk_insert_or_update(data=df, table='pricedata_symbol')
+
+        def row_versions():
+            # The physical location of each row. Updating a row writes a new version of it, so changes its location.
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT name, ctid FROM pricedata_symbol")
+                return dict(cursor.fetchall())
+
+        before = row_versions()
+        df.loc[0, 'instrument_type'] = 'CFD'
+        DatabaseUtility.bulk_insert_or_update(data=df, table='pricedata_symbol', unique_fields=['name'])
+        after = row_versions()
+
+        self.assertEqual([name for name in before.keys() if before[name] != after[name]], ['Symbol_0'])
+        self.assertEqual(Symbol.objects.get(name='Symbol_0').instrument_type, 'CFD')
+
+    def test_upsert_unique_only(self):
+        """
+        Test that upserting rows with only unique fields inserts the new rows and leaves the existing rows
+        """
+        df = pd.DataFrame(columns=['name', 'instrument_type'], data=[[f'Symbol_{i}', 'FOREX'] for i in range(0, 10)])
+        DatabaseUtility.bulk_insert_or_update(data=df, table='pricedata_symbol')
+
+        # 5 existing rows, 5 new rows and an existing name with a different instrument type
+        df = pd.DataFrame(columns=['name', 'instrument_type'],
+                          data=[[f'Symbol_{i}', 'FOREX'] for i in range(5, 15)] + [['Symbol_0', 'CFD']])
+        DatabaseUtility.bulk_insert_or_update(data=df, table='pricedata_symbol',
+                                              unique_fields=['name', 'instrument_type'])
+
+        self.assertEqual(Symbol.objects.count(), 15)
+        self.assertEqual(Symbol.objects.get(name='Symbol_0').instrument_type, 'FOREX')
+
     def test_batching(self):
         """
         Test that batching of inserts results in the correct number of records
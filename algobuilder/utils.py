@@ -2,24 +2,111 @@
 A collection of utilities for use across apps
 """
 import functools
+import hashlib
+import inspect
+import io
 import logging
 import math
+import pickle
+import struct
+import time
+import types
+import uuid
+import zlib
 import numpy as np
 import pandas as pd
-from typing import List
+from typing import List, Optional
 
+from django.conf import settings
 from django.core.cache import caches, InvalidCacheBackendError
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.db import connection
+from django.db.models import Model
 
 
 # TARGET PROJECT THEME: Caching
-# TODO Enable support for static methods.
+class DataFrameCodec:
+    """
+    Serialises dataframes to bytes for caching, and back. Dataframes are pickled with protocol 5, with their column
+    data as out of band buffers so that it is copied once into the serialised bytes rather than through the pickle
+    stream. This preserves dtypes, timezones and indexes exactly, unlike JSON, and is much faster and smaller. The bytes
+    are optionally compressed with zlib, set by ALGOBUILDER_CACHE_COMPRESSION in settings.
+
+    The serialised bytes are a header of the format version, whether compressed, the number of buffers and the length of
+    the pickle and each buffer, followed by the pickle and the buffers. As with the Django cache backends, which pickle
+    the values that they store, only bytes encoded by this codec from a trusted cache should be decoded.
+    """
+
+    # Format version, included in the header so that bytes encoded by a different version aren't decoded
+    __version = 1
+
+    # Header. Version, whether compressed and the number of buffers.
+    __header = struct.Struct('<BBI')
+
+    @staticmethod
+    def encode(data: pd.DataFrame, compression: int = None) -> bytes:
+        """
+        Serialises a dataframe.
+        :param data: The dataframe
+        :param compression: Optional. The zlib compression level, 1 to 9, or 0 for no compression. Default from
+            settings.
+        :return: The serialised bytes
+        """
+        compression = settings.ALGOBUILDER_CACHE_COMPRESSION if compression is None else compression
+        buffers = []
+        stream = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+        parts = [stream] + [buffer.raw() for buffer in buffers]
+        if compression > 0:
+            parts = [zlib.compress(part, compression) for part in parts]
+
+        return b''.join([DataFrameCodec.__header.pack(DataFrameCodec.__version, compression > 0, len(buffers)),
+                         struct.pack(f'<{len(parts)}Q', *[len(part) for part in parts])] + parts)
+
+    @staticmethod
+    def decode(data: bytes) -> pd.DataFrame:
+        """
+        Deserialises a dataframe serialised by encode.
+        :param data: The serialised bytes
+        :return: The dataframe
+        :raises ValueError: If the bytes weren't serialised by this version of the codec
+        """
+        view = memoryview(data)
+        version, compressed, num_buffers = DataFrameCodec.__header.unpack_from(view)
+        if version != DataFrameCodec.__version:
+            raise ValueError(f"Cached dataframe format version {version} isn't supported.")
+
+        offset = DataFrameCodec.__header.size
+        lengths = struct.unpack_from(f'<{num_buffers + 1}Q', view, offset)
+        offset += 8 * len(lengths)
+        parts = []
+        for length in lengths:
+            part = view[offset:offset + length]
+            # Buffers are copied, either by decompression or to a bytearray, so that the dataframe is writeable
+            parts.append(bytearray(zlib.decompress(part) if compressed else part))
+            offset += length
+
+        return pickle.loads(parts[0], buffers=parts[1:])
+
+
 class _Cache(object):
     """
     Decorator to retrieve dataframe output of decorated function from Django cache if it exists. If it doesn't it will
     retrieve from decorated function and store in cache.
 
-    This is only suitable for decorating functions that return a pandas dataframe. It does not work with static methods.
+    This is only suitable for decorating functions that return a pandas dataframe. It can decorate functions, methods,
+    static methods and class methods, either inside or outside of staticmethod and classmethod. Output of methods is
+    cached across all instances of the class, so instances aren't included in the cache key.
+
+    Cache keys are a hash of the qualified name of the function and its arguments, bound to its parameters so that the
+    same call made with positional or keyword arguments has the same key. Cached values can be tagged, e.g. with the
+    data that they are read from. Invalidating a tag changes its version, which is included in the key of every value
+    cached with the tag, so that they are all retrieved from the function again. Tag versions are held in the
+    ALGOBUILDER_INVALIDATION_CACHE, shared by all processes, so invalidating a tag in one process invalidates the values
+    cached with it in every cache.
+
+    Concurrent calls that miss the cache for the same key, in any process, only retrieve from the function once. The
+    first takes a lock in the cache and the others wait for its output to be cached, for up to
+    ALGOBUILDER_CACHE_LOCK_TIMEOUT seconds, after which they retrieve from the function themselves.
 
     Dependency: Django must be set up with caching
     """
@@ -33,17 +120,66 @@ class _Cache(object):
     # Wrapped function
     __func = None
 
-    def __init__(self, func, cache_name='default'):
+    # How long values are cached for, the Django cache version and the tags
+    __timeout = DEFAULT_TIMEOUT
+    __version = None
+    __tags = ()
+
+    # Whether the wrapped function is a static method, a class method or a method, from how it was decorated and
+    # whether it was declared in a class
+    __static = False
+    __class_method = False
+    __method = False
+
+    # Prefix of the cache keys of values and tag versions, and suffix of the cache keys of locks
+    __key_prefix = 'django_cache'
+    __tag_prefix = 'django_cache_tag'
+    __lock_suffix = 'lock'
+
+    # How often calls waiting for another to retrieve from the function check whether it has, in seconds
+    __poll_seconds = 0.05
+
+    def __init__(self, func, cache_name='default', timeout=DEFAULT_TIMEOUT, version=None, tags=None):
         """
         Decorator to cache the output of a function.
         :param func: The function being decorated
         :param cache_name: The name of the Django cache. Default will use the default cache.
+        :param timeout: Optional. The number of seconds to cache the output for, or None to cache it until it is
+            evicted. Default will use the timeout of the Django cache.
+        :param version: Optional. The Django cache version. Change to stop using output cached by previous versions.
+        :param tags: Optional. Tags for the output, that can be invalidated with invalidate_django_cache.
 
         To configure Django caching see https://docs.djangoproject.com/en/3.2/topics/cache/
         """
+        # Decorating a static or class method. Wrap its function.
+        if isinstance(func, (staticmethod, classmethod)):
+            self.__static = isinstance(func, staticmethod)
+            self.__class_method = isinstance(func, classmethod)
+            func = func.__func__
+
         functools.update_wrapper(self, func)
         self.__func = func
         self.__cache_name = cache_name
+        self.__timeout = timeout
+        self.__version = version
+        self.__tags = tuple(tags or ())
+
+    def __set_name__(self, owner, name):
+        """
+        Called when declared in a class. Unless decorating a static method, the function is a method.
+        """
+        self.__method = not self.__static
+
+    def __get__(self, instance, owner=None):
+        """
+        Binds methods to the instance, and class methods to the class, that they are accessed from, as functions are.
+        """
+        if self.__class_method:
+            return types.MethodType(self, owner if owner is not None else type(instance))
+        elif self.__static or instance is None:
+            return self
+        else:
+            return types.MethodType(self, instance)
 
     def __call__(self, *args, **kwargs):
         """
@@ -52,55 +188,160 @@ class _Cache(object):
         :param kwargs:
         :return: return the decorated function.
         """
-        # Session key is func name and passed parameters with spaces and control characters removed and reduced to
-        # 200 characters max
-        cache_key = f"{self.__func.__name__}_{','.join([f'{x}' for x in args])}_" \
-                    f"{','.join([f'{x}={kwargs[x]}' for x in kwargs.keys()])}"
-        for char in [" ", "\n"]:
-            cache_key = cache_key.replace(char, "")
-        cache_key = cache_key[0:200] if len(cache_key) > 200 else cache_key
-
         # Try and get from cache. If it doesnt exist in cache, then return from wrapped function.
         try:
             cache = caches[self.__cache_name]
-
-            # Get from cache if it exists
-            json_txt = cache.get(cache_key, None)
-
-            if json_txt is not None:
-                self.__log.debug(f"Retrieved {cache_key} from cache.")
-                ret = pd.read_json(json_txt, orient='table')
+            cache_key = self.__key(cache, args, kwargs)
+            ret = self.__get_cached(cache, cache_key)
+
+            if ret is not None:
+                self.__log.debug(f"Retrieved {self.__func.__qualname__} {cache_key} from cache.")
+            elif cache.add(f'{cache_key}:{_Cache.__lock_suffix}', True,
+                           timeout=settings.ALGOBUILDER_CACHE_LOCK_TIMEOUT, version=self.__version):
+                # Locked, so no other calls retrieve from the function while this one does
+                try:
+                    ret = self.__retrieve(cache, cache_key, args, kwargs)
+                finally:
+                    cache.delete(f'{cache_key}:{_Cache.__lock_suffix}', version=self.__version)
             else:
-                self.__log.debug(f"Retrieving {cache_key} from function.")
-                ret = self.__func(self, *args, **kwargs)
-
-                # Save it in cache as JSON
-                cache.set(cache_key, ret.to_json(orient='table'))
+                ret = self.__wait(cache, cache_key)
+                if ret is None:
+                    ret = self.__retrieve(cache, cache_key, args, kwargs)
         except InvalidCacheBackendError as ex:
             # If cache doesnt exist, or there was an error , we will retrieve from the wrapped function.
-            self.__log.debug(f"Retrieving {cache_key} from function. Error accessing cache", ex)
-            ret = self.__func(self, *args, **kwargs)
+            self.__log.debug(f"Retrieving {self.__func.__qualname__} from function. Error accessing cache", ex)
+            ret = self.__func(*args, **kwargs)
+
+        return ret
+
+    @staticmethod
+    def invalidate(tags: List[str]):
+        """
+        Invalidates all output cached with any of the tags, by changing the versions of the tags.
+        :param tags: The tags to invalidate
+        :return:
+        """
+        try:
+            caches[settings.ALGOBUILDER_INVALIDATION_CACHE].set_many(
+                {f'{_Cache.__tag_prefix}:{tag}': uuid.uuid4().hex for tag in tags}, timeout=None)
+        except InvalidCacheBackendError as ex:
+            _Cache.__log.debug(f"Unable to invalidate {tags}. Error accessing cache", ex)
+
+    def __get_cached(self, cache, cache_key: str) -> Optional[pd.DataFrame]:
+        """
+        Gets output from the cache. Values cached in an older format are retrieved again.
+        :return: The output, or None if it isn't cached.
+        """
+        cached = cache.get(cache_key, None, version=self.__version)
+
+        return DataFrameCodec.decode(cached) if isinstance(cached, bytes) else None
+
+    def __retrieve(self, cache, cache_key: str, args, kwargs) -> pd.DataFrame:
+        """
+        Retrieves output from the function and stores it in the cache, serialised.
+        """
+        self.__log.debug(f"Retrieving {self.__func.__qualname__} {cache_key} from function.")
+        ret = self.__func(*args, **kwargs)
+        cache.set(cache_key, DataFrameCodec.encode(ret), timeout=self.__timeout, version=self.__version)
 
         return ret
 
+    def __wait(self, cache, cache_key: str) -> Optional[pd.DataFrame]:
+        """
+        Waits for another call to retrieve output from the function and cache it.
+        :return: The output, or None if the other call released its lock without caching output, e.g. because it
+            raised an error, or didn't cache output within the lock timeout.
+        """
+        self.__log.debug(f"Waiting for {self.__func.__qualname__} {cache_key} to be retrieved by another call.")
+        deadline = time.monotonic() + settings.ALGOBUILDER_CACHE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(_Cache.__poll_seconds)
+            ret = self.__get_cached(cache, cache_key)
+            if ret is not None:
+                return ret
+            elif cache.get(f'{cache_key}:{_Cache.__lock_suffix}', version=self.__version) is None:
+                # The lock may have been released after the output was cached, between the two reads
+                return self.__get_cached(cache, cache_key)
+
+        return None
+
+    def __key(self, cache, args, kwargs) -> str:
+        """
+        The cache key for a call. The qualified name of the function and a hash of the arguments and tag versions.
+        """
+        # Bind the arguments to the parameters of the function, with defaults, excluding the instance or class of
+        # methods. If they don't bind, the function will raise the error when called.
+        try:
+            bound = inspect.signature(self.__func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = list(bound.arguments.items())[1 if self.__method or self.__class_method else 0:]
+        except TypeError:
+            arguments = [args, sorted(kwargs.items())]
+
+        # The current version of each tag, created if the tag hasn't been used before
+        tag_versions = []
+        if len(self.__tags) > 0:
+            tag_cache = caches[settings.ALGOBUILDER_INVALIDATION_CACHE]
+            tag_keys = [f'{_Cache.__tag_prefix}:{tag}' for tag in self.__tags]
+            versions = tag_cache.get_many(tag_keys)
+            tag_versions = [versions[key] if key in versions else
+                            tag_cache.get_or_set(key, uuid.uuid4().hex, timeout=None) for key in tag_keys]
+
+        digest = hashlib.sha256(_Cache.__canonical([arguments, tag_versions]).encode()).hexdigest()
+        return f'{_Cache.__key_prefix}:{self.__func.__qualname__[-100:]}:{digest}'
+
+    @staticmethod
+    def __canonical(value) -> str:
+        """
+        A string representation of a value that is the same for equal values. Containers are represented by their
+        contents, with dicts and sets sorted, Django models by their class and primary key, and pandas and numpy data by
+        a hash of their contents.
+        """
+        if isinstance(value, dict):
+            return '{' + ','.join(sorted(f'{_Cache.__canonical(key)}:{_Cache.__canonical(item)}'
+                                         for key, item in value.items())) + '}'
+        elif isinstance(value, (set, frozenset)):
+            return '{' + ','.join(sorted(_Cache.__canonical(item) for item in value)) + '}'
+        elif isinstance(value, (list, tuple)):
+            return '[' + ','.join(_Cache.__canonical(item) for item in value) + ']'
+        elif isinstance(value, Model):
+            return f'{value._meta.label}({value.pk!r})'
+        elif isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+            return f'{type(value).__name__}({pd.util.hash_pandas_object(value).values.tobytes().hex()})'
+        elif isinstance(value, np.ndarray):
+            return f'ndarray({value.dtype},{value.shape},{hashlib.sha256(value.tobytes()).hexdigest()})'
+        else:
+            return repr(value)
+
 
 # wrap _Cache to allow for deferred calling
-def django_cache(func=None, cache_name=None):
+def django_cache(func=None, cache_name='default', timeout=DEFAULT_TIMEOUT, version=None, tags=None):
     if func:
         return _Cache(func)
     else:
         def wrapper(function):
-            return _Cache(function, cache_name=cache_name)
+            return _Cache(function, cache_name=cache_name, timeout=timeout, version=version, tags=tags)
 
         return wrapper
 
 
+def invalidate_django_cache(*tags: str):
+    """
+    Invalidates the output of all functions decorated with django_cache that were cached with any of the tags. Called
+    after writing the data that the tags represent.
+    :param tags: The tags to invalidate
+    :return:
+    """
+    _Cache.invalidate(list(tags))
+
+
 # TARGET PROJECT THEME: Database
 class DatabaseUtility:
     @staticmethod
     def bulk_insert_or_update(data: pd.DataFrame, table: str, unique_fields=None, batch_size=None):
         """
-        Bulk insert or update (upsert) of price data. If unique fields already exists, then update else insert
+        Bulk insert or update (upsert) of price data. If unique fields already exists, then update else insert. Rows
+        that already exist with the same values are not updated.
 
         :param data: The pandas dataframe to insert / update to db. The columns in the dataframe must match the table
             columns.
@@ -131,10 +372,34 @@ class DatabaseUtility:
                     DatabaseUtility.__bulk_insert_batch(batch, table)
                 else:
                     # UPSERT
-                    DatabaseUtility.__bulk_upsert_batch(data, table, unique_fields)
+                    DatabaseUtility.__bulk_upsert_batch(batch, table, unique_fields)
             else:
                 log.debug(f"No data to save.")
 
+    @staticmethod
+    def bulk_copy(data: pd.DataFrame, table: str):
+        """
+        Bulk insert using COPY. Much faster than INSERT for large volumes, as the rows are streamed to the database as
+        CSV rather than bound into SQL. There is no upsert, so rows must not already exist.
+
+        :param data: The pandas dataframe to insert to db. The columns in the dataframe must match the table columns.
+            Datetime columns must be timezone aware.
+        :param table: The name of the table to insert to
+        :return:
+        """
+        # Logger
+        log = logging.getLogger(__name__)
+
+        if data is not None and len(data.index) > 0:
+            buffer = io.StringIO()
+            data.to_csv(buffer, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S.%f%z')
+            buffer.seek(0)
+
+            log.debug(f"COPYING {len(data.index)} rows to {table}.")
+            with connection.cursor() as cursor:
+                cursor.copy_expert(f"COPY {table} ({','.join(list(data.columns))}) FROM STDIN WITH (FORMAT csv)",
+                                   buffer)
+
     @staticmethod
     def __bulk_insert_batch(data: pd.DataFrame, table: str):
         """
@@ -167,17 +432,26 @@ class DatabaseUtility:
 
         # Get create fields from dataframe and the update fields as the create fields - unique fields
         create_fields = data.columns
-        update_fields = set(create_fields) - set(unique_fields)
+        update_fields = [field for field in create_fields if field not in unique_fields]
 
         # Build build list of x = excluded.x columns for SET part of sql
         on_duplicates = []
         for field in update_fields:
             on_duplicates.append(field + "=excluded." + field)
 
+        # Only update rows whose values have changed, so that unchanged rows aren't written and don't leave dead tuples.
+        # If every field is unique, there is nothing to update.
+        if len(update_fields) > 0:
+            changed = f"({','.join([f'{table}.{field}' for field in update_fields])}) IS DISTINCT FROM " \
+                      f"({','.join([f'excluded.{field}' for field in update_fields])})"
+            on_conflict = f"ON CONFLICT ({','.join(list(unique_fields))}) DO UPDATE SET {','.join(on_duplicates)} " \
+                          f"WHERE {changed}"
+        else:
+            on_conflict = "ON CONFLICT DO NOTHING"
+
         # Create the SQL
         sqlvals = DatabaseUtility.__get_sql_insert_values_from_dataframe(data)
-        sql = f"INSERT INTO {table} ({','.join(list(data.columns))}) VALUES {','.join(sqlvals)} " \
-              f"ON CONFLICT ({','.join(list(unique_fields))}) DO UPDATE SET {','.join(on_duplicates)}"
+        sql = f"INSERT INTO {table} ({','.join(list(data.columns))}) VALUES {','.join(sqlvals)} {on_conflict}"
 
         # Execute
         log.debug(f"UPSERTING {len(data.index)} rows to {table}.")
@@ -10,7 +10,9 @@ admin.site.index_title = 'AlgoBuilder administration'
 # Feature.
 @admin.register(models.Feature)
 class FeatureAdmin(admin.ModelAdmin):
-    fields = ("name", "pluginclass", "calculation_period", "calculation_frequency", "active")
+    fields = ("name", "pluginclass", "calculation_period", "calculation_frequency", "outputs", "input_features",
+              "active")
+    filter_horizontal = ("input_features",)
     list_display = ("name", "pluginclass", "calculation_period", "calculation_frequency", "active")
     list_editable = ("calculation_frequency", "active",)
 
@@ -32,7 +34,30 @@ class DatasourceSymbols(admin.TabularInline):
 # FeatureExecution. Symbols added inline
 @admin.register(models.FeatureExecution)
 class FeatureExecutionAdmin(admin.ModelAdmin):
-    fields = ("feature", "name", "active")
+    fields = ("feature", "name", "input_executions", "active")
+    filter_horizontal = ("input_executions",)
     list_display = ("feature", "name", "active")
 
     inlines = [DatasourceSymbols]
+
+
+# FeatureExecutionBackfill. Created by the feature task. Shows progress and can be resumed.
+@admin.register(models.FeatureExecutionBackfill)
+class FeatureExecutionBackfillAdmin(admin.ModelAdmin):
+    fields = ("feature_execution", "from_date", "to_date", "chunk_size", "complete")
+    readonly_fields = fields
+    list_display = ("feature_execution", "from_date", "to_date", "chunk_size", "chunks_complete", "complete")
+    list_filter = ("complete",)
+    actions = ["resume"]
+
+    @admin.display(description='Chunks complete')
+    def chunks_complete(self, obj):
+        complete, total = obj.progress
+        return f"{complete} / {total}"
+
+    @admin.action(description='Resume selected backfills')
+    def resume(self, request, queryset):
+        from feature import tasks  # Imported when needed, due to circular dependency
+
+        for backfill in queryset.filter(complete=False):
+            tasks.backfill_feature_execution.delay(backfill.feature_execution_id)
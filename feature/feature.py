@@ -1,10 +1,17 @@
-import abc
+import copy
 import logging
+import pickle
+import zlib
+import numpy as np
 import pandas as pd
-from django.db import connection
+from django.db import connection, transaction
 
 from datetime import datetime
+from typing import Dict, List, Tuple, Union
+from django.db.models import F, Max, Min, Q
+from algobuilder.utils import DatabaseUtility
 from pricedata import models as pd_models
+from pricedata.cache import CandleWindowCache, candle_fields
 from feature import models as ft_models
 
 
@@ -119,11 +126,12 @@ class FeatureImplementation:
             """
 
         # If we have calculated this feature before, get the last calculation time and append to sql query
-        last_calc_exists = \
-            ft_models.FeatureExecutionResult.objects.filter(feature_execution=feature_execution).last() is not None
+        result_model = feature_execution.feature.result_model
+        results = result_model.objects.filter(feature_execution=feature_execution,
+                                              version=feature_execution.result_version)
+        last_calc_exists = results.last() is not None
         if last_calc_exists:
-            last_calc =\
-                ft_models.FeatureExecutionResult.objects.filter(feature_execution=feature_execution).latest("time")
+            last_calc = results.latest("time")
             last_calc_time = last_calc.time
             sql += f" WHERE times.time > '{last_calc_time}'"
 
@@ -150,8 +158,9 @@ class FeatureImplementation:
         """
         Gets the data for the specified feature execution datasource symbol required to calculate the feature.
         :param feature_execution_datasource_symbol:
-        :return: Dataframe containing candle data for the specified feature_execution_datasource_symbol. Will return
-            None there are no features left to calculate.
+        :return: Dataframe containing candle data for the specified feature_execution_datasource_symbol, with the candle
+            fields as floats, and any results already calculated. Will return None there are no features left to
+            calculate.
         """
 
         # Get the from date
@@ -159,39 +168,687 @@ class FeatureImplementation:
 
         dataframe = None
         if from_date is not None:
-            # Get the data. QuerySet to get the candles and feature results, then convert to dataframe with outer join
-            # on time so that we can identify those already calculated so that we don't update again. Sort and index on
-            # time.
-            candles = pd_models.Candle.\
-                objects.filter(datasource_symbol=feature_execution_datasource_symbol.datasource_symbol,
-                               time__gte=from_date).all()
-
-            results = ft_models.FeatureExecutionResult.objects.\
-                filter(feature_execution=feature_execution_datasource_symbol.feature_execution,
+            # Get the data. Candles from the candle window cache and a QuerySet to get the feature results, then outer
+            # join on time so that we can identify those already calculated so that we don't update again. Sort and
+            # index on time.
+            df_candles = CandleWindowCache.get(feature_execution_datasource_symbol.datasource_symbol_id,
+                                               feature_execution_datasource_symbol.candle_period, from_date)
+            df_candles['datasource_symbol_id'] = feature_execution_datasource_symbol.datasource_symbol_id
+            df_candles['period'] = feature_execution_datasource_symbol.candle_period
+
+            feature_execution = feature_execution_datasource_symbol.feature_execution
+            results = feature_execution.feature.result_model.objects.\
+                filter(feature_execution=feature_execution, version=feature_execution.result_version,
                        time__gte=from_date).all()
 
-            df_candles = pd.DataFrame(list(candles.values()))
             df_results = pd.DataFrame(list(results.values()))
 
+            # Results for features with multiple outputs are in an outputs column. Return them as the result.
+            df_results = df_results.rename(columns={'outputs': 'result'})
+
             # If we have results, join them otherwise just return the candles with empty results columns
             if len(df_results.index) > 0 and len(df_candles.index) > 0:
-                df_candles = df_candles.set_index('time')
                 df_results = df_results.set_index('time')
                 dataframe = pd.concat([df_candles, df_results], axis=1, join="outer").sort_index()
             elif len(df_candles.index) > 0:
-                dataframe = df_candles.set_index('time').sort_index()
+                dataframe = df_candles
                 dataframe['result'] = None
                 dataframe['feature_execution_id'] = None
 
         # Return the dataframe
         return dataframe
 
-    @abc.abstractmethod
+    @staticmethod
+    def get_input_data_from_date(feature_execution: ft_models.FeatureExecution) -> datetime:
+        """
+        Gets the from date for the input feature results required to calculate this feature for the supplied
+        feature_execution. The equivalent of get_data_from_date for features calculated from other features.
+
+        from_date will be the next calculation date - the calculation period, where the next calculation date is the
+        earliest date where results are available for all input executions, that we have not already calculated this
+        feature for.
+
+        :param feature_execution: The feature execution to get the data from date for
+        :return: A datetime specifying the from date for the input results. None if there is nothing to calculate.
+        """
+        # Input results are in the result model of each input's feature, so look in both
+        through_table = ft_models.FeatureExecution.input_executions.through._meta.db_table
+        result_table = ft_models.FeatureExecutionResult.objects.model._meta.db_table
+        output_table = ft_models.FeatureExecutionOutput.objects.model._meta.db_table
+        sql = \
+            f"""
+            SELECT min(times.time)
+            FROM
+                (
+                    SELECT res.time as time
+                    FROM
+                        (
+                            SELECT feature_execution_id, version, time FROM {result_table}
+                            UNION ALL
+                            SELECT feature_execution_id, version, time FROM {output_table}
+                        ) AS res INNER JOIN
+                        {through_table} inp ON res.feature_execution_id = inp.to_featureexecution_id INNER JOIN
+                        feature_featureexecution fe ON res.feature_execution_id = fe.id AND
+                            res.version = fe.result_version
+                    WHERE inp.from_featureexecution_id = %s
+                    GROUP BY res.time
+                    HAVING COUNT(res.time) =
+                        (
+                            SELECT COUNT(*) FROM {through_table} WHERE from_featureexecution_id = %s
+                        )
+                ) as times
+            """
+
+        # If we have calculated this feature before, only look for input results after the last calculation
+        last_calc = feature_execution.feature.result_model.objects.filter(
+            feature_execution=feature_execution, version=feature_execution.result_version).order_by('-time').first()
+        params = [feature_execution.id, feature_execution.id]
+        if last_calc is not None:
+            sql += " WHERE times.time > %s"
+            params.append(last_calc.time)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+
+        next_calc_time = row[0]
+
+        from_date = None
+        if next_calc_time is not None:
+            cp_td = pd.to_timedelta(feature_execution.feature.calculation_period)
+            from_date = next_calc_time - cp_td if last_calc is not None else next_calc_time
+
+        return from_date
+
+    @staticmethod
+    def get_input_data(feature_execution: ft_models.FeatureExecution) -> pd.DataFrame:
+        """
+        Gets the input feature results required to calculate the feature for the specified feature execution. The
+        results for all input executions are loaded in a single query for each result model.
+        :param feature_execution:
+        :return: Dataframe indexed and sorted on time with a column of results for each input execution, named by the
+            input execution name, or for input executions of features with multiple outputs, a column for each output,
+            named by the input execution name and output name, e.g. 'ma_exec.upper'. A result column contains any
+            results already calculated for this feature execution, as a list of outputs for features with multiple
+            outputs. Will return None if there are no features left to calculate.
+        """
+        from_date = FeatureImplementation.get_input_data_from_date(feature_execution)
+
+        dataframe = None
+        if from_date is not None:
+            executions = {fe.id: fe for fe in [feature_execution] +
+                          list(feature_execution.input_executions.select_related('feature'))}
+
+            frames = []
+            for result_model in [ft_models.FeatureExecutionResult, ft_models.FeatureExecutionOutput]:
+                ids = [fe_id for fe_id, fe in executions.items() if fe.feature.result_model is result_model]
+                if len(ids) == 0:
+                    continue
+
+                # The results of the inputs in their active versions, and of this feature execution in the version
+                # being calculated
+                value = 'result' if result_model is ft_models.FeatureExecutionResult else 'outputs'
+                results = result_model.objects.filter(feature_execution_id__in=ids, time__gte=from_date).filter(
+                    Q(feature_execution_id=feature_execution.id, version=feature_execution.result_version) |
+                    (~Q(feature_execution_id=feature_execution.id) & Q(version=F('feature_execution__result_version'))))
+                df_results = pd.DataFrame(list(results.values('feature_execution_id', 'time', value)))
+
+                for fe_id, group in (df_results.groupby('feature_execution_id') if len(df_results.index) > 0 else []):
+                    group = group.set_index('time')
+                    if value == 'outputs' and fe_id != feature_execution.id:
+                        frames.append(pd.DataFrame(group['outputs'].tolist(), index=group.index,
+                                                   columns=[f'{executions[fe_id].name}.{output}'
+                                                            for output in executions[fe_id].feature.output_names]))
+                    else:
+                        name = 'result' if fe_id == feature_execution.id else executions[fe_id].name
+                        frames.append(group[value].rename(name).to_frame())
+
+            if len(frames) > 0:
+                dataframe = pd.concat(frames, axis=1, join='outer').sort_index()
+                dataframe.index.name = 'time'
+                if 'result' not in dataframe.columns:
+                    dataframe['result'] = None
+
+                # Only times where all inputs are available
+                dataframe = dataframe.dropna(subset=dataframe.columns.difference(['result']))
+
+        return dataframe
+
+    @staticmethod
+    def get_new_candles(feature_execution_datasource_symbol: ft_models.FeatureExecutionDataSourceSymbol,
+                        last_time: datetime) -> pd.DataFrame:
+        """
+        Gets the candles for the specified feature execution datasource symbol that arrived after last_time. Used by
+        incremental features, which hold the data from earlier candles in their state.
+        :param feature_execution_datasource_symbol:
+        :param last_time: The time of the last candle already processed.
+        :return: Dataframe of candle data as floats, indexed and sorted on time. Empty if there are no new candles.
+        """
+        candles = CandleWindowCache.get(feature_execution_datasource_symbol.datasource_symbol_id,
+                                        feature_execution_datasource_symbol.candle_period, last_time)
+
+        return candles[candles.index > last_time]
+
+    @staticmethod
+    def get_candles(feature_execution_datasource_symbol: ft_models.FeatureExecutionDataSourceSymbol,
+                    from_date: datetime, to_date: datetime) -> pd.DataFrame:
+        """
+        Gets the candles for the specified feature execution datasource symbol in a date range.
+        :param feature_execution_datasource_symbol:
+        :param from_date: The time of the first candle.
+        :param to_date: Candles up to, but not including, this time.
+        :return: Dataframe of candle data as floats, indexed and sorted on time. Empty if there are no candles.
+        """
+        return CandleWindowCache.get(feature_execution_datasource_symbol.datasource_symbol_id,
+                                     feature_execution_datasource_symbol.candle_period, from_date, to_date)
+
+    @staticmethod
+    def get_candle_range(feature_execution: ft_models.FeatureExecution) -> Tuple[datetime, datetime]:
+        """
+        Gets the times of the first and last candles available for a single symbol feature execution.
+        :param feature_execution:
+        :return: Tuple of the first and last candle times. (None, None) if there are no candles or datasource symbols.
+        """
+        feds = feature_execution.featureexecutiondatasourcesymbol_set.first()
+        if feds is None:
+            return None, None
+
+        times = pd_models.Candle.objects.filter(datasource_symbol=feds.datasource_symbol, period=feds.candle_period).\
+            aggregate(first=Min('time'), last=Max('time'))
+
+        return times['first'], times['last']
+
+    @staticmethod
+    def get_panel(feature_executions: List[ft_models.FeatureExecution],
+                  from_dates: Dict[int, datetime] = None, to_date: datetime = None) -> pd.DataFrame:
+        """
+        Gets the candle data for many single symbol feature executions as one panel. The candles for all their
+        datasource symbols are read together from the candle window cache.
+        :param feature_executions: The feature executions to get the data for
+        :param from_dates: Optional dict of feature execution id to the date to get its candles from. Candles are
+            retrieved from the first available for feature executions that are not in the dict.
+        :param to_date: Optional. Only candles before this date.
+        :return: Dataframe indexed and sorted on time with two levels of columns, the candle field (e.g. bid_close) and
+            the feature execution id, so that panel['bid_close'] is a time x feature execution frame of floats. Times
+            where a feature execution has no candle are NaN. None if there are no candles.
+        """
+        from_dates = {} if from_dates is None else from_dates
+
+        # The datasource symbol and candle period for each feature execution
+        feds = list(ft_models.FeatureExecutionDataSourceSymbol.objects.filter(feature_execution__in=feature_executions).
+                    values_list('feature_execution_id', 'datasource_symbol_id', 'candle_period'))
+
+        # The candles for all of them, each from the earliest from date of its feature executions
+        requests = [(dss_id, period, from_dates.get(fe_id)) for fe_id, dss_id, period in feds]
+        windows = CandleWindowCache.get_many(requests, to_date)
+
+        # One set of candles per feature execution, from its own from date
+        candles = {}
+        for fe_id, dss_id, period in feds:
+            window = windows[(dss_id, period)]
+            if fe_id in from_dates:
+                window = window[window.index >= from_dates[fe_id]]
+            if len(window.index) > 0:
+                candles[fe_id] = window
+
+        panel = None
+        if len(candles) > 0:
+            panel = pd.concat(candles, axis=1, names=['feature_execution_id', None]).swaplevel(axis=1).sort_index()
+            panel = panel[[field for field in candle_fields if field in panel.columns.get_level_values(0)]]
+
+        return panel
+
+    @staticmethod
+    def get_last_result_times(feature_execution_ids: List[int]) -> Dict[int, datetime]:
+        """
+        Gets the time of the last result in the active version for each of the specified feature executions, whichever
+        model their results are stored in.
+        :param feature_execution_ids:
+        :return: Dict of feature execution id to last result time. Feature executions without results are not included.
+        """
+        last_times = {}
+        for result_model in [ft_models.FeatureExecutionResult, ft_models.FeatureExecutionOutput]:
+            last_times.update(result_model.objects.filter(feature_execution_id__in=feature_execution_ids,
+                                                          version=F('feature_execution__result_version')).
+                              values('feature_execution_id').annotate(last_time=Max('time')).
+                              values_list('feature_execution_id', 'last_time'))
+
+        return last_times
+
+    @staticmethod
+    def get_results(feature_execution: ft_models.FeatureExecution, from_date: datetime = None,
+                    to_date: datetime = None, version: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gets the results for a feature execution as numpy arrays. Results are read as float64 by the database, so no
+        Decimals are created, whichever model they are stored in.
+        :param feature_execution:
+        :param from_date: Optional. Only results from this date.
+        :param to_date: Optional. Only results up to and including this date.
+        :param version: Optional. The version of the results. Defaults to the active version.
+        :return: Tuple of a datetime64[ns] array of times in UTC, sorted, and a float64 array of results with a row for
+            each time and a column for each output. Single result features have a single column.
+        """
+        outputs = feature_execution.feature.output_names
+        if len(outputs) > 0:
+            table = ft_models.FeatureExecutionOutput.objects.model._meta.db_table
+            select = ", ".join([f"outputs[{i + 1}]" for i in range(0, len(outputs))])
+        else:
+            table = ft_models.FeatureExecutionResult.objects.model._meta.db_table
+            select = "result::float8"
+
+        sql = f"SELECT extract(epoch from time)::float8, {select} FROM {table} " \
+              f"WHERE feature_execution_id = %s AND version = %s"
+        params = [feature_execution.id, feature_execution.result_version if version is None else version]
+        if from_date is not None:
+            sql += " AND time >= %s"
+            params.append(from_date)
+        if to_date is not None:
+            sql += " AND time <= %s"
+            params.append(to_date)
+        sql += " ORDER BY time"
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, max(len(outputs), 1) + 1)
+
+        # Epoch seconds to ns. Round to the microsecond precision of the database.
+        times = (np.round(rows[:, 0] * 1e6).astype(np.int64) * 1000).astype('datetime64[ns]')
+
+        return times, rows[:, 1:]
+
+    @staticmethod
+    def save_results(feature_execution: ft_models.FeatureExecution, results: Union[pd.Series, pd.DataFrame],
+                     version: int = None):
+        """
+        Saves the calculated results for a feature execution. Results that already exist for the same time will be
+        updated.
+        :param feature_execution: The feature execution that the results were calculated for
+        :param results: Series of results indexed on candle time. For features with multiple outputs, a dataframe
+            indexed on candle time with a column for each output. NaN results are not saved.
+        :param version: Optional. The version of the results. Defaults to the active version.
+        """
+        FeatureImplementation.__save_many_results([(feature_execution, results)], version)
+
+    @staticmethod
+    def __save_many_results(results: List[Tuple[ft_models.FeatureExecution, Union[pd.Series, pd.DataFrame]]],
+                            version: int = None):
+        """
+        Saves the calculated results for many feature executions in a single bulk upsert for each result model.
+        :param results: List of tuples of feature execution and its results, as for save_results
+        :param version: Optional. The version of the results. Defaults to the active version of each feature execution.
+        """
+        outputs = []
+        single = []
+        for feature_execution, execution_results in results:
+            execution_version = feature_execution.result_version if version is None else version
+            if isinstance(execution_results, pd.DataFrame):
+                execution_results = execution_results[feature_execution.feature.output_names].dropna(how='all')
+                outputs.append(pd.DataFrame({'time': execution_results.index,
+                                             'feature_execution_id': feature_execution.id,
+                                             'version': execution_version,
+                                             'outputs': execution_results.to_numpy(dtype=float).tolist()}))
+            else:
+                execution_results = execution_results.dropna()
+                single.append(pd.DataFrame({'time': execution_results.index,
+                                            'feature_execution_id': feature_execution.id,
+                                            'version': execution_version,
+                                            'result': execution_results.values}))
+
+        if len(outputs) > 0:
+            FeatureImplementation.__write_outputs(pd.concat(outputs, ignore_index=True))
+        if len(single) > 0:
+            FeatureImplementation.__write_results(pd.concat(single, ignore_index=True))
+
+    @staticmethod
+    def __write_results(data: pd.DataFrame):
+        """
+        Bulk upserts results for any number of feature executions.
+        :param data: Dataframe with columns time, feature_execution_id, version and result.
+        """
+        DatabaseUtility.bulk_insert_or_update(data=data,
+                                              table=ft_models.FeatureExecutionResult.objects.model._meta.db_table,
+                                              unique_fields=['feature_execution_id', 'version', 'time'],
+                                              batch_size=1000)
+
+    @staticmethod
+    def __write_outputs(data: pd.DataFrame):
+        """
+        Bulk upserts results for any number of feature executions of a feature with multiple outputs.
+        :param data: Dataframe with columns time, feature_execution_id, version and outputs, a list of floats.
+        """
+        DatabaseUtility.bulk_insert_or_update(data=data,
+                                              table=ft_models.FeatureExecutionOutput.objects.model._meta.db_table,
+                                              unique_fields=['feature_execution_id', 'version', 'time'],
+                                              batch_size=1000)
+
+    @property
+    def incremental(self) -> bool:
+        """
+        Whether this feature implements the incremental contract, init_state and update.
+        :return:
+        """
+        return type(self).update is not FeatureImplementation.update
+
+    @property
+    def vectorised(self) -> bool:
+        """
+        Whether this feature implements calculate_panel, to calculate many feature executions in one vectorised pass.
+        :return:
+        """
+        return type(self).calculate_panel is not FeatureImplementation.calculate_panel
+
+    @property
+    def backfillable(self) -> bool:
+        """
+        Whether the history of this feature can be calculated in chunks by a backfill. Vectorised and incremental
+        features can be.
+        :return:
+        """
+        return self.vectorised or self.incremental
+
+    def calculate_panel(self, panel: pd.DataFrame) -> pd.DataFrame:
+        """
+        Vectorised features only. Calculates the feature for many single symbol feature executions at once.
+
+        :param panel: The candle data for the feature executions, as returned by get_panel. e.g.
+            panel['bid_close'].to_numpy() is a time x feature execution matrix of bid close prices.
+        :return: Dataframe of results with the same index as the panel and a column for each feature execution id.
+            For features with multiple outputs, two levels of columns, the output name and the feature execution id.
+            Results where the feature execution has no candle are ignored.
+        """
+        raise NotImplementedError
+
+    def init_state(self, feature_execution: ft_models.FeatureExecution, history: pd.DataFrame) -> any:
+        """
+        Incremental features only. Creates the calculation state for a feature execution that doesn't yet have one.
+
+        :param feature_execution: The feature execution to create the state for
+        :param history: The candles, indexed on time, that results have already been calculated for and that fall
+            within the calculation period of the first candle still to be calculated. Empty if this feature execution
+            has not been calculated before.
+        :return: The state. Any picklable object, e.g. a dict containing running sums and numpy arrays.
+        """
+        raise NotImplementedError
+
+    def update(self, feature_execution: ft_models.FeatureExecution, state: any,
+               new_candles: pd.DataFrame) -> Tuple[any, pd.Series]:
+        """
+        Incremental features only. Calculates the feature for new candles from the state left by the last run.
+
+        :param feature_execution: The feature execution being calculated
+        :param state: The state returned by init_state or by the last call to update
+        :param new_candles: The candles, indexed and sorted on time, that the feature has not been calculated for
+        :return: Tuple of the updated state and a series of results indexed on candle time. For features with multiple
+            outputs, a dataframe indexed on candle time with a column for each output.
+        """
+        raise NotImplementedError
+
     def execute(self, feature_execution):
         """
-        Executes the feature calculation for a single feature execution
+        Executes the feature calculation for a single feature execution. Features that implement the incremental
+        contract (init_state and update) don't need to implement this. All other features must.
 
         :param feature_execution: The feature execution containing the datasource_candleperiod, calculation_period and
             symbols for the calculation
         """
-        raise NotImplementedError
+        if self.incremental:
+            self.execute_incremental(feature_execution)
+        else:
+            raise NotImplementedError
+
+    def execute_batch(self, feature_executions: List[ft_models.FeatureExecution]):
+        """
+        Executes the feature calculation for many feature executions of this feature. Vectorised features calculate
+        them together in one pass over a panel of their candles, with the results saved in a single bulk upsert.
+        Features that are also incremental only do this for feature executions that have not been calculated before,
+        continuing incrementally from then on. Incremental features are updated together, with their states read in a
+        single query, their new candles read together and their results and states saved in single bulk writes. All
+        other feature executions are executed one at a time.
+
+        :param feature_executions: The feature executions to calculate
+        """
+        # The last result time for each feature execution
+        last_times = FeatureImplementation.get_last_result_times([fe.id for fe in feature_executions])
+
+        panel_executions = []
+        incremental_executions = []
+        for feature_execution in feature_executions:
+            if self.vectorised and not (self.incremental and feature_execution.id in last_times):
+                panel_executions.append(feature_execution)
+            elif self.incremental:
+                incremental_executions.append(feature_execution)
+            else:
+                self.execute(feature_execution)
+
+        if len(panel_executions) > 0:
+            self.__execute_panel(panel_executions, last_times)
+
+        if len(incremental_executions) > 0:
+            self.__execute_incremental_batch(incremental_executions)
+
+    def __execute_panel(self, feature_executions: List[ft_models.FeatureExecution], last_times: Dict[int, datetime]):
+        """
+        Calculates the feature for the feature executions in a single vectorised pass and saves all results together.
+        Candles are loaded from the calculation period before the last result of each feature execution and results are
+        only saved for the candles after it.
+        :param feature_executions:
+        :param last_times: The last result time for each feature execution that has results.
+        """
+        cp_td = pd.to_timedelta(self._feature.calculation_period)
+        from_dates = {fe_id: last_time - cp_td for fe_id, last_time in last_times.items()}
+        panel = FeatureImplementation.get_panel(feature_executions, from_dates)
+
+        if panel is not None:
+            self.__log.debug(f"Calculating {self._feature} for {len(feature_executions)} feature executions over "
+                             f"{len(panel.index)} times.")
+            results = self.calculate_panel(panel)
+
+            # A time x feature execution frame for each output
+            outputs = self._feature.output_names
+            frames = {output: results[output] for output in outputs} if len(outputs) > 0 else {'result': results}
+
+            for name, frame in frames.items():
+                # Only keep results where there is a candle and it hasn't already been calculated
+                frame = frame.where(panel['bid_close'].notna())
+                for fe_id, last_time in last_times.items():
+                    if fe_id in frame.columns:
+                        frame.loc[frame.index <= last_time, fe_id] = None
+
+                # Long format, indexed on time and feature execution
+                frames[name] = frame.rename_axis(index='time', columns='feature_execution_id').stack()
+
+            # Single write, to the active version of each feature execution
+            versions = {fe.id: fe.result_version for fe in feature_executions}
+            if len(outputs) > 0:
+                data = pd.concat(frames, axis=1)[outputs]
+                data = pd.DataFrame({'outputs': data.to_numpy(dtype=float).tolist()}, index=data.index).reset_index()
+                data['version'] = data['feature_execution_id'].map(versions)
+                FeatureImplementation.__write_outputs(data)
+            else:
+                data = frames['result'].rename('result').reset_index()
+                data['version'] = data['feature_execution_id'].map(versions)
+                FeatureImplementation.__write_results(data)
+        else:
+            self.__log.debug(f"No candles available to calculate {self._feature}.")
+
+    def __execute_incremental_batch(self, feature_executions: List[ft_models.FeatureExecution]):
+        """
+        Executes the feature calculation for many feature executions using the incremental contract. Feature
+        executions that don't have a state yet are initialised one at a time by execute_incremental. The others are
+        updated from their states, read in a single query, with their new candles read together from the candle window
+        cache. Their results are saved in a single bulk upsert and their states in a single bulk update, in one
+        transaction, so that the states never run ahead of the results.
+
+        :param feature_executions: The feature executions to calculate
+        """
+        states = {state.feature_execution_id: state for state in
+                  ft_models.FeatureExecutionState.objects.filter(feature_execution__in=feature_executions)}
+        for feature_execution in feature_executions:
+            if feature_execution.id not in states:
+                self.execute_incremental(feature_execution)
+
+        continuing = [fe for fe in feature_executions if fe.id in states]
+        if len(continuing) == 0:
+            return
+
+        # The new candles for each, read together
+        feds = {fe_id: (dss_id, period) for fe_id, dss_id, period in
+                ft_models.FeatureExecutionDataSourceSymbol.objects.filter(feature_execution__in=continuing).
+                values_list('feature_execution_id', 'datasource_symbol_id', 'candle_period')}
+        windows = CandleWindowCache.get_many([(*feds[fe.id], states[fe.id].time) for fe in continuing
+                                              if fe.id in feds])
+
+        results = []
+        updated = []
+        for feature_execution in continuing:
+            state_model = states[feature_execution.id]
+            candles = windows[feds[feature_execution.id]] if feature_execution.id in feds else pd.DataFrame()
+            new_candles = candles[candles.index > state_model.time] if len(candles.index) > 0 else candles
+            if len(new_candles.index) == 0:
+                continue
+
+            state, execution_results = self.update(feature_execution, FeatureImplementation.__deserialise_state(
+                bytes(state_model.state)), new_candles)
+            results.append((feature_execution, execution_results))
+            state_model.time = new_candles.index.max()
+            state_model.state = FeatureImplementation.__serialise_state(state)
+            updated.append(state_model)
+
+        if len(updated) > 0:
+            self.__log.debug(f"Updating {self._feature} for {len(updated)} feature executions.")
+            with transaction.atomic():
+                FeatureImplementation.__save_many_results(results)
+                ft_models.FeatureExecutionState.objects.bulk_update(updated, ['time', 'state'])
+        else:
+            self.__log.debug(f"Feature calculations up to date. No new features calculated for {self._feature}.")
+
+    def execute_incremental(self, feature_execution: ft_models.FeatureExecution):
+        """
+        Executes the feature calculation for a single feature execution using the incremental contract. The state is
+        loaded from the last run, updated with only the candles that have arrived since, and persisted along with the
+        results. If there is no state, it is initialised from the candles used to calculate the existing results.
+        Incremental features are calculated over a single datasource symbol.
+
+        :param feature_execution: The feature execution to calculate
+        """
+        feds = feature_execution.featureexecutiondatasourcesymbol_set.first()
+        if feds is None:
+            self.__log.warning(f"No datasource symbol for {feature_execution}. Feature not calculated.")
+            return
+
+        state_model = ft_models.FeatureExecutionState.objects.filter(feature_execution=feature_execution).first()
+
+        if state_model is not None:
+            # Continue from the last run
+            state = FeatureImplementation.__deserialise_state(bytes(state_model.state))
+            new_candles = FeatureImplementation.get_new_candles(feds, state_model.time)
+        else:
+            # Initialise from the candles that already have results and are within the calculation period of the
+            # first candle that doesn't.
+            data = FeatureImplementation.get_data(feds)
+            if data is None:
+                new_candles = pd.DataFrame()
+                state = None
+            else:
+                new_candles = data[data['result'].isna()]
+                state = self.init_state(feature_execution, data[data['result'].notna()])
+            state_model = ft_models.FeatureExecutionState(feature_execution=feature_execution)
+
+        if len(new_candles.index) > 0:
+            state, results = self.update(feature_execution, state, new_candles)
+
+            # Save the results and the state together so that the state never runs ahead of the results
+            with transaction.atomic():
+                FeatureImplementation.save_results(feature_execution, results)
+                state_model.time = new_candles.index.max()
+                state_model.state = FeatureImplementation.__serialise_state(state)
+                state_model.save()
+        else:
+            self.__log.debug(f"Feature calculations up to date. No new features calculated for {feature_execution}.")
+
+    def calculate_chunk(self, feature_execution: ft_models.FeatureExecution, from_date: datetime,
+                        to_date: datetime) -> Union[pd.Series, pd.DataFrame]:
+        """
+        Backfillable features only. Calculates the feature for the candles in a date range, independently of any results
+        already calculated. The candles in the calculation period before the range are loaded to warm up the
+        calculation. Vectorised features are calculated using calculate_panel, incremental features from a new state.
+        :param feature_execution: The single symbol feature execution to calculate
+        :param from_date: The time of the first candle to calculate
+        :param to_date: Calculate up to, but not including, this time
+        :return: Series of results for the candles in the range, indexed on candle time. For features with multiple
+            outputs, a dataframe indexed on candle time with a column for each output.
+        """
+        warm_up_date = from_date - pd.to_timedelta(self._feature.calculation_period)
+        outputs = self._feature.output_names
+
+        if self.vectorised:
+            panel = FeatureImplementation.get_panel([feature_execution], {feature_execution.id: warm_up_date}, to_date)
+            if panel is None:
+                return pd.Series(dtype=float)
+
+            results = self.calculate_panel(panel)
+            has_candle = panel['bid_close'][feature_execution.id].notna()
+            results = pd.DataFrame({output: results[output][feature_execution.id] for output in outputs}) \
+                if len(outputs) > 0 else results[feature_execution.id]
+            results = results[has_candle]
+        else:
+            feds = feature_execution.featureexecutiondatasourcesymbol_set.first()
+            if feds is None:
+                self.__log.warning(f"No datasource symbol for {feature_execution}. Chunk not calculated.")
+                return pd.Series(dtype=float)
+
+            candles = FeatureImplementation.get_candles(feds, warm_up_date, to_date)
+            if len(candles.index) == 0:
+                return pd.Series(dtype=float)
+
+            state = self.init_state(feature_execution, candles.iloc[0:0])
+            _, results = self.update(feature_execution, state, candles)
+
+        return results[results.index >= from_date]
+
+    def execute_backfill_chunk(self, chunk: ft_models.FeatureExecutionBackfillChunk):
+        """
+        Calculates a backfill chunk and saves its results. The chunk is marked complete in the same transaction as the
+        results are saved, so a chunk that fails can be calculated again. Features that aren't backfillable are
+        calculated in full, into the backfill version, by execute.
+        :param chunk:
+        """
+        feature_execution = chunk.backfill.feature_execution
+        self.__log.debug(f"Calculating backfill chunk {chunk}.")
+
+        if self.backfillable:
+            results = self.calculate_chunk(feature_execution, chunk.from_date, chunk.to_date)
+
+            with transaction.atomic():
+                if len(results.index) > 0:
+                    FeatureImplementation.save_results(feature_execution, results, version=chunk.backfill.version)
+                chunk.complete = True
+                chunk.save()
+        else:
+            # Can't be calculated in chunks, so the backfill is a single chunk, calculated by execute as if the backfill
+            # version were active
+            feature_execution = copy.copy(feature_execution)
+            feature_execution.result_version = chunk.backfill.version
+
+            with transaction.atomic():
+                self.execute(feature_execution)
+                chunk.complete = True
+                chunk.save()
+
+    @staticmethod
+    def __serialise_state(state: any) -> bytes:
+        """
+        Serialises an incremental feature state for storage
+        :param state:
+        :return:
+        """
+        return zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def __deserialise_state(data: bytes) -> any:
+        """
+        Deserialises an incremental feature state from storage
+        :param data:
+        :return:
+        """
+        return pickle.loads(zlib.decompress(data))
@@ -0,0 +1,115 @@
+"""
+The dependency graph between feature executions. Features can be calculated over the results of other features. This
+is declared on the Feature (input_features) and bound to specific upstream feature executions on the FeatureExecution
+(input_executions).
+"""
+import logging
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Set
+
+from feature import models as ft_models
+
+
+class FeatureDependencyCycleError(Exception):
+    """
+    An exception that is raised if the feature execution dependencies contain a cycle and cannot be ordered.
+    """
+    pass
+
+
+class FeatureExecutionGraph:
+    """
+    A directed acyclic graph of feature executions, with edges from each input execution to the executions that are
+    calculated from it. All edges are loaded in a single query when the graph is created.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    def __init__(self) -> None:
+        """
+        Loads the graph edges
+        """
+        # Upstream (inputs) and downstream (dependents) adjacency for each feature execution id
+        self.__inputs: Dict[int, Set[int]] = defaultdict(set)
+        self.__dependents: Dict[int, Set[int]] = defaultdict(set)
+
+        through = ft_models.FeatureExecution.input_executions.through
+        for dependent_id, input_id in through.objects.values_list('from_featureexecution_id',
+                                                                  'to_featureexecution_id'):
+            self.__inputs[dependent_id].add(input_id)
+            self.__dependents[input_id].add(dependent_id)
+
+    def inputs(self, feature_execution_id: int) -> Set[int]:
+        """
+        Returns the ids of the feature executions that the specified feature execution is calculated from
+        :param feature_execution_id:
+        :return:
+        """
+        return set(self.__inputs[feature_execution_id])
+
+    def dependents(self, feature_execution_id: int) -> Set[int]:
+        """
+        Returns the ids of the feature executions calculated directly from the specified feature execution
+        :param feature_execution_id:
+        :return:
+        """
+        return set(self.__dependents[feature_execution_id])
+
+    def descendants(self, feature_execution_ids: Iterable[int]) -> Set[int]:
+        """
+        Returns the ids of all feature executions calculated directly or indirectly from the specified feature
+        executions. Doesn't include the specified feature executions unless they are also descendants of one another.
+        :param feature_execution_ids:
+        :return:
+        """
+        found = set()
+        queue = deque(feature_execution_ids)
+        while len(queue) > 0:
+            for dependent_id in self.__dependents[queue.popleft()]:
+                if dependent_id not in found:
+                    found.add(dependent_id)
+                    queue.append(dependent_id)
+
+        return found
+
+    def topological_levels(self, feature_execution_ids: Iterable[int]) -> List[List[int]]:
+        """
+        Groups the specified feature executions into levels so that every execution is in a later level than any of its
+        inputs in the set. Executions in the same level don't depend on each other and can be calculated together.
+        :param feature_execution_ids:
+        :return: List of levels in calculation order, each a sorted list of feature execution ids.
+        :raises FeatureDependencyCycleError: If the feature executions depend on each other in a cycle.
+        """
+        nodes = set(feature_execution_ids)
+
+        # Kahn's algorithm, a level at a time, considering only the edges between the nodes being ordered
+        num_inputs = {node: len(self.__inputs[node] & nodes) for node in nodes}
+        level = sorted(node for node in nodes if num_inputs[node] == 0)
+        levels = []
+        while len(level) > 0:
+            levels.append(level)
+            next_level = []
+            for node in level:
+                for dependent_id in self.__dependents[node] & nodes:
+                    num_inputs[dependent_id] -= 1
+                    if num_inputs[dependent_id] == 0:
+                        next_level.append(dependent_id)
+            level = sorted(next_level)
+
+        ordered = [node for level in levels for node in level]
+        if len(ordered) != len(nodes):
+            cycle = sorted(nodes - set(ordered))
+            raise FeatureDependencyCycleError(f'Feature executions {cycle} depend on each other in a cycle and cannot '
+                                              f'be calculated.')
+
+        return levels
+
+    def topological_order(self, feature_execution_ids: Iterable[int]) -> List[int]:
+        """
+        Orders the specified feature executions so that every execution comes after any of its inputs in the set.
+        :param feature_execution_ids:
+        :return: List of feature execution ids in calculation order.
+        :raises FeatureDependencyCycleError: If the feature executions depend on each other in a cycle.
+        """
+        return [node for level in self.topological_levels(feature_execution_ids) for node in level]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-19 04:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feature', '0004_alter_feature_calculation_frequency'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='feature',
+            name='name',
+            field=models.CharField(max_length=30, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='featureexecution',
+            name='name',
+            field=models.CharField(max_length=30, unique=True),
+        ),
+        migrations.CreateModel(
+            name='FeatureExecutionState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('state', models.BinaryField()),
+                ('feature_execution', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='feature.featureexecution')),
+            ],
+        ),
+    ]
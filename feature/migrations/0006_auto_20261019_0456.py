@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 04:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feature', '0005_auto_20261019_0454'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feature',
+            name='input_features',
+            field=models.ManyToManyField(blank=True, related_name='dependent_features', to='feature.Feature'),
+        ),
+        migrations.AddField(
+            model_name='featureexecution',
+            name='input_executions',
+            field=models.ManyToManyField(blank=True, related_name='dependent_executions', to='feature.FeatureExecution'),
+        ),
+    ]
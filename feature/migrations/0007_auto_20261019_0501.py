@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:01
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feature', '0006_auto_20261019_0456'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feature',
+            name='outputs',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.CreateModel(
+            name='FeatureExecutionOutput',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('outputs', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), size=None)),
+                ('feature_execution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='feature.featureexecution')),
+            ],
+            options={
+                'unique_together': {('feature_execution', 'time')},
+            },
+        ),
+    ]
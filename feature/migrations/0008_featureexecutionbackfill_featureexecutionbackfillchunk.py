@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feature', '0007_auto_20261019_0501'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureExecutionBackfill',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_date', models.DateTimeField()),
+                ('to_date', models.DateTimeField()),
+                ('chunk_size', models.CharField(max_length=6)),
+                ('complete', models.BooleanField(default=False)),
+                ('feature_execution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='feature.featureexecution')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FeatureExecutionBackfillChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_date', models.DateTimeField()),
+                ('to_date', models.DateTimeField()),
+                ('complete', models.BooleanField(default=False)),
+                ('backfill', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='feature.featureexecutionbackfill')),
+            ],
+            options={
+                'unique_together': {('backfill', 'from_date')},
+            },
+        ),
+    ]
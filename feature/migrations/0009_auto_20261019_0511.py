@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feature', '0008_featureexecutionbackfill_featureexecutionbackfillchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='featureexecution',
+            name='result_version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='featureexecutionbackfill',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='featureexecutionoutput',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='featureexecutionresult',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='featureexecutionoutput',
+            unique_together={('feature_execution', 'version', 'time')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='featureexecutionresult',
+            unique_together={('feature_execution', 'version', 'time')},
+        ),
+    ]
@@ -4,7 +4,8 @@ import logging
 import pandas as pd
 from django_celery_beat import models as cm
 
-from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.db import models, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
@@ -35,12 +36,63 @@ class Feature(models.Model):
     # parameters. e.g. '{"day_of_week": "mon-fri", "hour": 23, "minute": 0}'
     calculation_frequency = models.CharField(max_length=255)
 
+    # Names of the outputs for features that calculate more than one result per candle (e.g. 'upper,middle,lower' for
+    # Bollinger bands), comma separated. Results for these features are stored as FeatureExecutionOutput. Blank for
+    # features with a single result, stored as FeatureExecutionResult.
+    outputs = models.CharField(max_length=255, blank=True)
+
+    # Features that this feature is calculated from. Results for the input features are bound to each feature execution
+    # through its input_executions.
+    input_features = models.ManyToManyField('self', symmetrical=False, blank=True, related_name='dependent_features')
+
     # Active.
     active = models.BooleanField(default=True)
 
     # The periodic task to calculate the feature
     task = models.OneToOneField(cm.PeriodicTask, on_delete=models.CASCADE, null=True, blank=True)
 
+    # The calculation period when loaded from or last saved to the database. If it changes, the results are recomputed.
+    # None if not known, e.g. for new or deferred features.
+    __loaded_calculation_period = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Records the calculation period when loaded, so that changes to it can be detected on save.
+        """
+        instance = super().from_db(db, field_names, values)
+        if 'calculation_period' in field_names:
+            instance.__loaded_calculation_period = values[field_names.index('calculation_period')]
+
+        return instance
+
+    @property
+    def recompute_required(self):
+        """
+        Returns whether the parameters that results are calculated with have changed since this feature was loaded, so
+        that the results need to be recomputed.
+        :return:
+        """
+        return self.id is not None and self.__loaded_calculation_period is not None and \
+            self.calculation_period != self.__loaded_calculation_period
+
+    @property
+    def output_names(self):
+        """
+        Returns the list of output names. Empty for features with a single result.
+        :return:
+        """
+        return [output.strip() for output in self.outputs.split(',') if output.strip() != '']
+
+    @property
+    def result_model(self):
+        """
+        Returns the model that results for this feature are stored in. FeatureExecutionOutput for features with named
+        outputs, otherwise FeatureExecutionResult.
+        :return:
+        """
+        return FeatureExecutionOutput if len(self.output_names) > 0 else FeatureExecutionResult
+
     @property
     def task_name(self):
         """
@@ -71,6 +123,30 @@ class Feature(models.Model):
 
         self.save()
 
+    def recompute(self):
+        """
+        Starts a background task to recompute the results for all executions of this feature into a new version, once
+        the current transaction commits, so that the task reads the saved feature.
+        :return:
+        """
+        from feature import tasks  # Imported when needed, due to circular dependency
+
+        feature_id = self.id
+        transaction.on_commit(lambda: tasks.recompute_feature.delay(feature_id))
+        self.__loaded_calculation_period = self.calculation_period
+
+    def save(self, *args, **kwargs):
+        """
+        Override save to record the calculation period saved, once the post save receiver has checked whether the
+        results need to be recomputed
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        super().save(*args, **kwargs)
+        if 'calculation_period' not in self.get_deferred_fields():
+            self.__loaded_calculation_period = self.calculation_period
+
     def delete(self, *args, **kwargs):
         """
         Override delete to delete the feature execution calculation task when we delete the feature execution
@@ -105,11 +181,21 @@ class FeatureExecution(models.Model):
     # The name of this feature execution
     name = models.CharField(max_length=30, unique=True)
 
+    # The feature executions whose results this feature execution is calculated from. These should be executions of the
+    # feature's input_features.
+    input_executions = models.ManyToManyField('self', symmetrical=False, blank=True,
+                                              related_name='dependent_executions')
+
+    # The version of the results that is active. Results are recomputed into a new version when the feature parameters
+    # change, and the new version made active once complete.
+    result_version = models.IntegerField(default=0)
+
     # Active.
     active = models.BooleanField(default=True)
 
     def __repr__(self):
-        return f"FeatureExecution(feature={self.feature}, name={self.name}, active={self.active}"
+        return f"FeatureExecution(feature={self.feature}, name={self.name}, result_version={self.result_version}, " \
+               f"active={self.active}"
 
     def __str__(self):
         return f"{self.name}"
@@ -154,6 +240,9 @@ class FeatureExecutionResult(models.Model):
     # The feature execution
     feature_execution = models.ForeignKey(FeatureExecution, on_delete=models.CASCADE)
 
+    # The version of the results that this result belongs to
+    version = models.IntegerField(default=0)
+
     # The candle time that this result was calculated for
     time = models.DateTimeField()
 
@@ -161,16 +250,137 @@ class FeatureExecutionResult(models.Model):
     result = models.DecimalField(max_digits=12, decimal_places=6)
 
     class Meta:
-        unique_together = ('feature_execution', 'time',)
+        unique_together = ('feature_execution', 'version', 'time',)
 
     def __repr__(self):
-        return f"FeatureExecutionResult(feature_execution={self.feature_execution}, time={self.time}, " \
-               f"result={self.result}"
+        return f"FeatureExecutionResult(feature_execution={self.feature_execution}, version={self.version}, " \
+               f"time={self.time}, result={self.result}"
 
     def __str__(self):
         return f"FeatureExecution: {self.feature_execution} time: {self.time} result: {self.result}."
 
 
+class FeatureExecutionOutput(models.Model):
+    """
+    The results of a single feature calculation for a FeatureExecution of a feature with multiple named outputs. All
+    outputs for the candle are stored as float64 in a single row, in the order of the feature's output_names.
+    """
+    # The feature execution
+    feature_execution = models.ForeignKey(FeatureExecution, on_delete=models.CASCADE)
+
+    # The version of the results that these results belong to
+    version = models.IntegerField(default=0)
+
+    # The candle time that these results were calculated for
+    time = models.DateTimeField()
+
+    # The results, one for each output
+    outputs = ArrayField(models.FloatField())
+
+    class Meta:
+        unique_together = ('feature_execution', 'version', 'time',)
+
+    def __repr__(self):
+        return f"FeatureExecutionOutput(feature_execution={self.feature_execution}, version={self.version}, " \
+               f"time={self.time}, outputs={self.outputs}"
+
+    def __str__(self):
+        return f"FeatureExecution: {self.feature_execution} time: {self.time} outputs: {self.outputs}."
+
+
+class FeatureExecutionState(models.Model):
+    """
+    The persisted state of an incremental feature calculation for a FeatureExecution. Contains whatever the feature
+    implementation needs to continue calculating from the last candle it processed (e.g. running sums or a ring buffer
+    of the candles in the calculation period), so that each run only needs to read and process new candles.
+    """
+    # The feature execution
+    feature_execution = models.OneToOneField(FeatureExecution, on_delete=models.CASCADE)
+
+    # The time of the last candle that was processed into the state
+    time = models.DateTimeField()
+
+    # The serialised state
+    state = models.BinaryField()
+
+    def __repr__(self):
+        return f"FeatureExecutionState(feature_execution={self.feature_execution}, time={self.time}"
+
+    def __str__(self):
+        return f"FeatureExecution: {self.feature_execution} state time: {self.time}."
+
+
+class FeatureExecutionBackfill(models.Model):
+    """
+    A backfill of the history for a FeatureExecution. The history is split into chunks that are calculated in parallel
+    and saved chunk by chunk, so that the memory required is bounded by the chunk size and the backfill can be resumed
+    from the chunks that haven't completed.
+    """
+    # The feature execution
+    feature_execution = models.ForeignKey(FeatureExecution, on_delete=models.CASCADE)
+
+    # The time of the first candle to calculate
+    from_date = models.DateTimeField()
+
+    # The time to calculate up to, but not including. Just after the last candle available when the backfill was
+    # created. Later candles are calculated by the feature task once the backfill is complete.
+    to_date = models.DateTimeField()
+
+    # The size of each chunk. A number followed by any valid pandas timeseries offset alias.
+    chunk_size = models.CharField(max_length=6)
+
+    # The version of the results to calculate. If this isn't the feature execution's active result version, the
+    # backfill is a recompute and this version is made active once the backfill is complete.
+    version = models.IntegerField(default=0)
+
+    # Whether all chunks have been calculated
+    complete = models.BooleanField(default=False)
+
+    @property
+    def progress(self):
+        """
+        Returns the number of chunks completed and the total number of chunks
+        :return:
+        """
+        return self.chunks.filter(complete=True).count(), self.chunks.count()
+
+    def __repr__(self):
+        return f"FeatureExecutionBackfill(feature_execution={self.feature_execution}, from_date={self.from_date}, " \
+               f"to_date={self.to_date}, chunk_size={self.chunk_size}, version={self.version}, " \
+               f"complete={self.complete}"
+
+    def __str__(self):
+        return f"FeatureExecution: {self.feature_execution} backfill from {self.from_date} to {self.to_date}."
+
+
+class FeatureExecutionBackfillChunk(models.Model):
+    """
+    A chunk of a FeatureExecutionBackfill. Calculated from the candles in the chunk and the calculation period before
+    it. Only the results for the candles in the chunk are saved.
+    """
+    # The backfill
+    backfill = models.ForeignKey(FeatureExecutionBackfill, on_delete=models.CASCADE, related_name='chunks')
+
+    # The time of the first candle in the chunk
+    from_date = models.DateTimeField()
+
+    # The time up to, but not including, which the chunk is calculated
+    to_date = models.DateTimeField()
+
+    # Whether the results for the chunk have been calculated and saved
+    complete = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('backfill', 'from_date',)
+
+    def __repr__(self):
+        return f"FeatureExecutionBackfillChunk(backfill={self.backfill}, from_date={self.from_date}, " \
+               f"to_date={self.to_date}, complete={self.complete}"
+
+    def __str__(self):
+        return f"{self.backfill} Chunk from {self.from_date} to {self.to_date}."
+
+
 @receiver(post_save, sender=Feature)
 def save_feature_receiver(sender, instance, created, **kwargs):
     if created:
@@ -179,3 +389,7 @@ def save_feature_receiver(sender, instance, created, **kwargs):
         if instance.task is not None:
             instance.task.enabled = instance.active
             instance.task.save()
+
+        # Recompute the results if the parameters that they were calculated with have changed
+        if instance.recompute_required:
+            instance.recompute()
@@ -0,0 +1,226 @@
+"""
+The read path for feature results. Serves time range slices of results for one or many feature executions, backed by
+an in-process LRU cache of the most recent results for each feature execution.
+"""
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.cache import caches
+
+from feature import feature as ft
+from feature import models as ft_models
+
+
+class FeatureResultStore:
+    """
+    Reads feature results. The most recent results (the tail) for each feature execution read are held in an
+    in-process LRU cache, so repeated reads of recent results don't query the database. When new results are written,
+    invalidate must be called. The next read then only retrieves the results written since the tail was cached.
+
+    Invalidation is recorded as a version in the ALGOBUILDER_INVALIDATION_CACHE, shared by all processes, so writes in
+    one process invalidate the tails cached in all of them. Changes to existing results are also recorded as a reset generation in a
+    separate key, so that a tail cached before a change is read again even if new results were written after it.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    # Cached tails. Feature execution id to dict of times, values, start (the time from which the tail is complete),
+    # version and reset generation. Most recently used last.
+    __tails = OrderedDict()
+
+    # Lock for the tails
+    __lock = threading.Lock()
+
+    # The earliest time. Used as the start of tails that contain all results.
+    __min_time = np.datetime64(np.iinfo(np.int64).min + 1, 'ns')
+
+    @staticmethod
+    def get(feature_executions: Iterable[ft_models.FeatureExecution], from_date: datetime = None,
+            to_date: datetime = None) -> pd.DataFrame:
+        """
+        Gets the results for the feature executions between the dates, aligned on time.
+        :param feature_executions:
+        :param from_date: Optional. Only results from this date.
+        :param to_date: Optional. Only results up to and including this date.
+        :return: Dataframe indexed on time (UTC) with a column for each feature execution, named by the feature
+            execution name. Features with multiple outputs have a column for each output, named feature execution
+            name.output name. Times where a feature execution has no result are NaN.
+        """
+        feature_executions = list(feature_executions)
+
+        # Read the versions for all feature executions at once, as each read of the invalidation cache may be a query
+        versions = FeatureResultStore.__versions([feature_execution.id for feature_execution in feature_executions])
+
+        frames = []
+        for feature_execution in feature_executions:
+            times, values = FeatureResultStore.__get_arrays(feature_execution, from_date, to_date,
+                                                            *versions[feature_execution.id])
+            outputs = feature_execution.feature.output_names
+            columns = [f'{feature_execution.name}.{output}' for output in outputs] if len(outputs) > 0 \
+                else [feature_execution.name]
+            frames.append(pd.DataFrame(values, index=pd.DatetimeIndex(times, tz='UTC', name='time'),
+                                       columns=columns))
+
+        return pd.concat(frames, axis=1).sort_index() if len(frames) > 0 else pd.DataFrame()
+
+    @staticmethod
+    def get_arrays(feature_execution: ft_models.FeatureExecution, from_date: datetime = None,
+                   to_date: datetime = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gets the results for a feature execution between the dates as numpy arrays, from the cached tail if it covers
+        the dates.
+        :param feature_execution:
+        :param from_date: Optional. Only results from this date.
+        :param to_date: Optional. Only results up to and including this date.
+        :return: Tuple of a datetime64[ns] array of times in UTC, sorted, and a float64 array of results with a row for
+            each time and a column for each output.
+        """
+        return FeatureResultStore.__get_arrays(feature_execution, from_date, to_date,
+                                               *FeatureResultStore.__versions([feature_execution.id])[feature_execution.id])
+
+    @staticmethod
+    def __get_arrays(feature_execution: ft_models.FeatureExecution, from_date: datetime, to_date: datetime,
+                     version: str, generation: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gets the results for a feature execution between the dates, given its current version and reset generation.
+        """
+        start = FeatureResultStore.__min_time if from_date is None else FeatureResultStore.__to_datetime64(from_date)
+
+        with FeatureResultStore.__lock:
+            tail = FeatureResultStore.__tails.get(feature_execution.id)
+            if tail is not None:
+                FeatureResultStore.__tails.move_to_end(feature_execution.id)
+
+        if tail is not None and (tail['generation'] != generation or (tail['version'] != version and version is None)):
+            # Existing results have changed, or the version was evicted from the invalidation cache. Read the tail
+            # again.
+            tail = None
+        elif tail is not None and tail['version'] != version:
+            # New results have been written. Extend the tail with them.
+            after = tail['times'][-1] if len(tail['times']) > 0 else None
+            times, values = ft.FeatureImplementation.get_results(
+                feature_execution, from_date=None if after is None else pd.Timestamp(after, tz='UTC'))
+            if after is not None:
+                times, values = times[times > after], values[times > after]
+            tail = FeatureResultStore.__cache_tail(feature_execution.id, np.concatenate([tail['times'], times]),
+                                                   np.concatenate([tail['values'], values]), tail['start'], version,
+                                                   generation)
+
+        if tail is None or start < tail['start']:
+            # Not cached or the cached tail doesn't go back far enough. Cache from the from date.
+            FeatureResultStore.__log.debug(f"Reading results for {feature_execution} from {from_date}.")
+            times, values = ft.FeatureImplementation.get_results(feature_execution, from_date=from_date)
+            tail = FeatureResultStore.__cache_tail(feature_execution.id, times, values, start, version, generation)
+
+            # If the tail was trimmed, it won't cover the from date, so serve these directly
+            if start < tail['start']:
+                return FeatureResultStore.__slice(times, values, start, to_date)
+
+        return FeatureResultStore.__slice(tail['times'], tail['values'], start, to_date)
+
+    @staticmethod
+    def invalidate(feature_execution_ids: Iterable[int], reset: bool = False):
+        """
+        Records that results have been written for the feature executions, so that cached tails are updated on their
+        next read.
+        :param feature_execution_ids:
+        :param reset: False if only new results, later than those already saved, were written. The cached tails are
+            extended with them. True if earlier results were written, changed or deleted. The cached tails are read
+            again.
+        """
+        versions = {}
+        for fe_id in feature_execution_ids:
+            versions[FeatureResultStore.__version_key(fe_id)] = uuid.uuid4().hex
+            if reset:
+                versions[FeatureResultStore.__generation_key(fe_id)] = uuid.uuid4().hex
+
+        caches[settings.ALGOBUILDER_INVALIDATION_CACHE].set_many(versions, timeout=None)
+
+    @staticmethod
+    def clear(feature_execution_ids: Iterable[int] = None):
+        """
+        Removes the cached tails for the feature executions in this process. Required when existing results are changed
+        or deleted rather than new results written.
+        :param feature_execution_ids: Optional. If not provided, all cached tails are removed.
+        """
+        with FeatureResultStore.__lock:
+            if feature_execution_ids is None:
+                FeatureResultStore.__tails.clear()
+            else:
+                for fe_id in feature_execution_ids:
+                    FeatureResultStore.__tails.pop(fe_id, None)
+
+    @staticmethod
+    def __cache_tail(feature_execution_id: int, times: np.ndarray, values: np.ndarray, start: np.datetime64,
+                     version: str, generation: str) -> Dict:
+        """
+        Caches the tail for a feature execution, trimmed to the maximum number of rows, evicting the least recently
+        used tails if there are too many.
+        :return: The tail.
+        """
+        max_rows = settings.ALGOBUILDER_FEATURE_RESULT_CACHE_ROWS
+        if len(times) > max_rows:
+            times, values = times[-max_rows:], values[-max_rows:]
+            start = times[0]
+
+        tail = {'times': times, 'values': values, 'start': start, 'version': version, 'generation': generation}
+        with FeatureResultStore.__lock:
+            FeatureResultStore.__tails[feature_execution_id] = tail
+            FeatureResultStore.__tails.move_to_end(feature_execution_id)
+            while len(FeatureResultStore.__tails) > settings.ALGOBUILDER_FEATURE_RESULT_CACHE_EXECUTIONS:
+                FeatureResultStore.__tails.popitem(last=False)
+
+        return tail
+
+    @staticmethod
+    def __slice(times: np.ndarray, values: np.ndarray, start: np.datetime64,
+                to_date: datetime) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Slices sorted results from the start to the to date.
+        """
+        first = np.searchsorted(times, start, side='left')
+        last = len(times) if to_date is None else \
+            np.searchsorted(times, FeatureResultStore.__to_datetime64(to_date), side='right')
+
+        return times[first:last], values[first:last]
+
+    @staticmethod
+    def __versions(feature_execution_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        """
+        Gets the current result version and reset generation for the feature executions. None for those never
+        invalidated or reset.
+        """
+        keys = [(fe_id, FeatureResultStore.__version_key(fe_id), FeatureResultStore.__generation_key(fe_id))
+                for fe_id in feature_execution_ids]
+        versions = caches[settings.ALGOBUILDER_INVALIDATION_CACHE].get_many(
+            [key for _, version_key, generation_key in keys for key in [version_key, generation_key]])
+
+        return {fe_id: (versions.get(version_key), versions.get(generation_key))
+                for fe_id, version_key, generation_key in keys}
+
+    @staticmethod
+    def __version_key(feature_execution_id: int) -> str:
+        return f"feature_result_store_version_{feature_execution_id}"
+
+    @staticmethod
+    def __generation_key(feature_execution_id: int) -> str:
+        return f"feature_result_store_generation_{feature_execution_id}"
+
+    @staticmethod
+    def __to_datetime64(date: datetime) -> np.datetime64:
+        """
+        Converts a datetime to a UTC datetime64[ns] for comparison with result times.
+        """
+        timestamp = pd.Timestamp(date)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+
+        return timestamp.to_datetime64()
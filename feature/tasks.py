@@ -1,12 +1,19 @@
 import logging
-from celery import shared_task
+import pandas as pd
+from celery import group, shared_task
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Max, Min
 from feature import feature
+from feature import graph
+from feature import store
 
 
 @shared_task(name='calculate_feature', queue='feature')
 def calculate_feature(feature_id: int):
     """
-    Executes the feature calculation for all feature_executions attached to the specified feature
+    Executes the feature calculation for all feature_executions attached to the specified feature, then for any feature
+    executions calculated from them whose inputs have advanced.
     :param feature_id:
     :return:
     """
@@ -21,17 +28,331 @@ def calculate_feature(feature_id: int):
     # Continue if active
     if feature_model.active:
         log.debug(f"Running task to calculate feature {feature_model.name}.")
-        # Get the implementation
-        feature_impl = feature.FeatureImplementation.instance(feature_model.name)
 
-        # Execute all active feature executions
+        # Execute all active feature executions, then their dependents.
+        feature_executions = []
         for feature_execution in feature_model.featureexecution_set.all():
             if feature_execution.active:
-                # Execute
-                log.debug(f"Running FeatureExecution {feature_execution}.")
-                feature_impl.execute(feature_execution)
+                feature_executions.append(feature_execution.id)
             else:
                 log.debug(f"Not running FeatureExecution {feature_execution}. It is inactive.")
+
+        calculate_feature_executions(feature_executions)
     else:
         log.debug(f"Task to calculate feature {feature_model.name} did not run as feature is inactive.")
 
+
+def calculate_feature_executions(feature_execution_ids):
+    """
+    Calculates the specified feature executions and every active feature execution downstream of them in the feature
+    dependency graph. Executions are calculated a level of the graph at a time so that inputs are always calculated
+    first. Within a level, the executions of each feature are calculated together in a batch. Downstream executions are
+    only calculated when the latest result of one of their inputs is later than their own.
+    :param feature_execution_ids: The feature executions to calculate.
+    :return:
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    # Order the requested executions and their descendants
+    dependency_graph = graph.FeatureExecutionGraph()
+    requested = set(feature_execution_ids)
+    levels = dependency_graph.topological_levels(requested | dependency_graph.descendants(requested))
+    feature_executions = models.FeatureExecution.objects.select_related('feature').\
+        in_bulk([fe_id for level in levels for fe_id in level])
+
+    # Latest result times for all executions in the plan, then kept up to date as we calculate
+    last_times = feature.FeatureImplementation.get_last_result_times(list(feature_executions.keys()))
+
+    # Executions whose active version is being backfilled aren't calculated until the backfill is complete. Those being
+    # recomputed into a new version continue to be calculated in their active version.
+    backfilling = set(models.FeatureExecutionBackfill.objects.filter(
+        feature_execution_id__in=feature_executions.keys(), complete=False,
+        version=F('feature_execution__result_version')).values_list('feature_execution_id', flat=True))
+
+    # One implementation per feature
+    implementations = {}
+
+    for level in levels:
+        # The executions to calculate in this level, batched by feature
+        batches = {}
+        for feature_execution_id in level:
+            feature_execution = feature_executions[feature_execution_id]
+
+            if feature_execution_id not in requested:
+                # Downstream. Only calculate if active and one of its inputs has advanced past its own results.
+                if not feature_execution.active or not feature_execution.feature.active:
+                    log.debug(f"Not running dependent FeatureExecution {feature_execution}. It is inactive.")
+                    continue
+
+                own_time = last_times.get(feature_execution_id)
+                input_times = [last_times.get(input_id) for input_id in dependency_graph.inputs(feature_execution_id)]
+                if not any(t is not None and (own_time is None or t > own_time) for t in input_times):
+                    log.debug(f"Not running dependent FeatureExecution {feature_execution}. Inputs have not advanced.")
+                    continue
+
+            if feature_execution_id in backfilling:
+                log.debug(f"Not running FeatureExecution {feature_execution}. It is being backfilled.")
+                continue
+
+            batches.setdefault(feature_execution.feature_id, []).append(feature_execution)
+
+        for feature_id, batch in batches.items():
+            # Get the implementation
+            if feature_id not in implementations:
+                implementations[feature_id] = feature.FeatureImplementation.instance(batch[0].feature.name)
+
+            # Backfill the history of executions that haven't been calculated before in chunks, rather than calculating
+            # it all at once. They are removed from the batch.
+            if implementations[feature_id].backfillable:
+                batch[:] = [fe for fe in batch if fe.id in last_times or not start_backfill(fe)]
+
+            # Execute
+            if len(batch) > 0:
+                log.debug(f"Running FeatureExecutions {batch}.")
+                implementations[feature_id].execute_batch(batch)
+
+        # Update the latest result times for the executions calculated in this level, and invalidate their cached
+        # results
+        calculated = [fe.id for batch in batches.values() for fe in batch]
+        store.FeatureResultStore.invalidate(calculated)
+        last_times.update(feature.FeatureImplementation.get_last_result_times(calculated))
+
+
+def start_backfill(feature_execution) -> bool:
+    """
+    Starts a backfill for a single symbol feature execution if the history of candles to calculate is longer than a
+    backfill chunk.
+    :param feature_execution:
+    :return: True if a backfill was started.
+    """
+    first, last = feature.FeatureImplementation.get_candle_range(feature_execution)
+    started = first is not None and last - first > pd.to_timedelta(settings.ALGOBUILDER_FEATURE_BACKFILL_CHUNK_SIZE)
+    if started:
+        log = logging.getLogger(__name__)
+        log.debug(f"Backfilling FeatureExecution {feature_execution} from {first} to {last}.")
+        create_backfill(feature_execution, first, last + pd.Timedelta(microseconds=1))
+        backfill_feature_execution.delay(feature_execution.id)
+
+    return started
+
+
+def create_backfill(feature_execution, from_date, to_date, version=None, chunked=True):
+    """
+    Creates a backfill for a feature execution, split into chunks of the configured size.
+    :param feature_execution:
+    :param from_date: The time of the first candle to calculate
+    :param to_date: Calculate up to, but not including, this time
+    :param version: Optional. The version of the results to calculate. Defaults to the active version.
+    :param chunked: Optional. False for a single chunk, for features that aren't backfillable.
+    :return: The backfill
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    chunk_size = settings.ALGOBUILDER_FEATURE_BACKFILL_CHUNK_SIZE
+    version = feature_execution.result_version if version is None else version
+    backfill = models.FeatureExecutionBackfill.objects.create(feature_execution=feature_execution, from_date=from_date,
+                                                              to_date=to_date, chunk_size=chunk_size, version=version)
+
+    starts = pd.date_range(start=from_date, end=to_date, freq=pd.to_timedelta(chunk_size), closed='left') if chunked \
+        else pd.DatetimeIndex([from_date])
+    ends = list(starts[1:]) + [to_date]
+    models.FeatureExecutionBackfillChunk.objects.bulk_create(
+        [models.FeatureExecutionBackfillChunk(backfill=backfill, from_date=start, to_date=end)
+         for start, end in zip(starts, ends)])
+
+    return backfill
+
+
+@shared_task(name='backfill_feature_execution', queue='feature')
+def backfill_feature_execution(feature_execution_id: int):
+    """
+    Calculates the chunks of the incomplete backfill for a feature execution that have not yet completed, in parallel.
+    Run again to resume a backfill that was interrupted.
+    :param feature_execution_id:
+    :return:
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    backfill = models.FeatureExecutionBackfill.objects.filter(feature_execution_id=feature_execution_id,
+                                                              complete=False).first()
+    if backfill is not None:
+        chunk_ids = list(backfill.chunks.filter(complete=False).values_list('id', flat=True))
+        log.debug(f"Calculating {len(chunk_ids)} chunks for {backfill}.")
+        group(backfill_feature_execution_chunk.s(chunk_id) for chunk_id in chunk_ids).apply_async()
+    else:
+        log.debug(f"No incomplete backfill for feature execution id {feature_execution_id}.")
+
+
+@shared_task(name='backfill_feature_execution_chunk', queue='feature')
+def backfill_feature_execution_chunk(chunk_id: int):
+    """
+    Calculates a backfill chunk. Completes the backfill if this was the last chunk.
+    :param chunk_id:
+    :return:
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    chunk = models.FeatureExecutionBackfillChunk.objects.select_related('backfill__feature_execution__feature').\
+        get(id=chunk_id)
+    if chunk.complete:
+        log.debug(f"Backfill chunk {chunk} has already been calculated.")
+        return
+
+    feature_execution = chunk.backfill.feature_execution
+    feature.FeatureImplementation.instance(feature_execution.feature.name).execute_backfill_chunk(chunk)
+
+    # Complete the backfill once all chunks have been calculated. Results were saved out of time order, so cached
+    # results are read again. If the backfill was a recompute, its version replaces the active version. The last chunks
+    # may complete at the same time, so only the one that marks the backfill complete completes it.
+    backfill = chunk.backfill
+    if not backfill.chunks.filter(complete=False).exists() and \
+            models.FeatureExecutionBackfill.objects.filter(id=backfill.id, complete=False).update(complete=True) == 1:
+        if backfill.version != feature_execution.result_version:
+            activate_result_version(feature_execution, backfill.version)
+        else:
+            store.FeatureResultStore.invalidate([feature_execution.id], reset=True)
+        log.debug(f"Backfill {backfill} complete.")
+
+
+@shared_task(name='recompute_feature', queue='feature')
+def recompute_feature(feature_id: int):
+    """
+    Recomputes the results for all executions of a feature into a new version, in the background. Used when the
+    parameters that the results were calculated with change. The current results remain available until the new
+    version is complete and made active. Feature executions calculated from them are then recomputed in turn.
+    :param feature_id:
+    :return:
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    feature_model = models.Feature.objects.get(id=feature_id)
+    implementation = feature.FeatureImplementation.instance(feature_model.name)
+
+    for feature_execution in feature_model.featureexecution_set.all():
+        start_recompute(feature_execution, implementation)
+
+
+def start_recompute(feature_execution, implementation):
+    """
+    Starts recomputing the results for a feature execution into a new version, as a backfill. Backfillable features are
+    backfilled in chunks over the candles available, others in a single chunk from their first result. The new version
+    replaces the active version once the backfill is complete. If nothing has been calculated, there is nothing to
+    recompute, so the new version is made active now and is calculated by the feature task.
+    :param feature_execution:
+    :param implementation: The implementation of the feature execution's feature
+    :return:
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    # Any recompute already in progress is superseded
+    superseded = models.FeatureExecutionBackfill.objects.filter(feature_execution=feature_execution, complete=False,
+                                                                version__gt=feature_execution.result_version)
+    models.FeatureExecutionBackfillChunk.objects.filter(backfill__in=superseded).update(complete=True)
+    superseded.update(complete=True)
+
+    version = next_result_version(feature_execution)
+    if implementation.backfillable:
+        first, last = feature.FeatureImplementation.get_candle_range(feature_execution)
+    else:
+        times = feature_execution.feature.result_model.objects.filter(
+            feature_execution=feature_execution, version=feature_execution.result_version).\
+            aggregate(first=Min('time'), last=Max('time'))
+        first, last = times['first'], times['last']
+
+    if first is not None:
+        log.debug(f"Recomputing FeatureExecution {feature_execution} into version {version}.")
+        create_backfill(feature_execution, first, last + pd.Timedelta(microseconds=1), version=version,
+                        chunked=implementation.backfillable)
+        backfill_feature_execution.delay(feature_execution.id)
+    else:
+        log.debug(f"Nothing to recompute for FeatureExecution {feature_execution}. Activating version {version}.")
+        activate_result_version(feature_execution, version)
+
+
+def next_result_version(feature_execution) -> int:
+    """
+    Returns a result version for a feature execution that hasn't been used before.
+    :param feature_execution:
+    :return:
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    last_backfill = models.FeatureExecutionBackfill.objects.filter(feature_execution=feature_execution).\
+        aggregate(version=Max('version'))['version']
+
+    return max(feature_execution.result_version, -1 if last_backfill is None else last_backfill) + 1
+
+
+def activate_result_version(feature_execution, version: int):
+    """
+    Makes a version of the results for a feature execution active. The state of incremental features, calculated with
+    the previous version, is deleted and the inactive results are deleted in the background. Feature executions
+    calculated directly from this one are recomputed from it into new versions, keeping their active versions until
+    then. Their own dependents are recomputed in turn as each completes.
+    :param feature_execution:
+    :param version:
+    :return:
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    with transaction.atomic():
+        models.FeatureExecution.objects.filter(id=feature_execution.id).update(result_version=version)
+        models.FeatureExecutionState.objects.filter(feature_execution=feature_execution).delete()
+    feature_execution.result_version = version
+
+    log.debug(f"Activated result version {version} for FeatureExecution {feature_execution}.")
+    store.FeatureResultStore.invalidate([feature_execution.id], reset=True)
+    delete_inactive_results.delay(feature_execution.id)
+
+    # One implementation per feature
+    implementations = {}
+    for dependent in models.FeatureExecution.objects.select_related('feature').filter(
+            id__in=graph.FeatureExecutionGraph().dependents(feature_execution.id)):
+        if dependent.feature_id not in implementations:
+            implementations[dependent.feature_id] = feature.FeatureImplementation.instance(dependent.feature.name)
+        start_recompute(dependent, implementations[dependent.feature_id])
+
+
+@shared_task(name='delete_inactive_results', queue='feature')
+def delete_inactive_results(feature_execution_id: int):
+    """
+    Deletes the results for a feature execution that aren't in its active version, or in the version being calculated
+    by an incomplete backfill. Deleted in batches so that large deletes don't hold long locks.
+    :param feature_execution_id:
+    :return:
+    """
+    from feature import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    feature_execution = models.FeatureExecution.objects.get(id=feature_execution_id)
+    keep = [feature_execution.result_version] + list(models.FeatureExecutionBackfill.objects.filter(
+        feature_execution=feature_execution, complete=False).values_list('version', flat=True))
+    batch_size = settings.ALGOBUILDER_FEATURE_DELETE_BATCH_SIZE
+
+    for result_model in [models.FeatureExecutionResult, models.FeatureExecutionOutput]:
+        table = result_model.objects.model._meta.db_table
+        sql = f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE feature_execution_id = %s AND " \
+              f"NOT version = ANY(%s) LIMIT %s)"
+        deleted = batch_size
+        while deleted == batch_size:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [feature_execution_id, keep, batch_size])
+                deleted = cursor.rowcount
+            log.debug(f"Deleted {deleted} inactive results from {table} for {feature_execution}.")
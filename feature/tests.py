@@ -1,13 +1,23 @@
 from random import random
 
-from django.test import TestCase
+import numpy as np
+import pandas as pd
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django_celery_beat.models import PeriodicTask
 from plugin import models as plugin_models
 from feature import models
 from pricedata import models as pd_models
+from pricedata.cache import CandleWindowCache
 from datetime import datetime, timedelta
 import pytz
 from feature import feature as ft
+from feature import graph
+from feature import store
+from feature import tasks
+from unittest.mock import patch, MagicMock
 
 
 class FeatureTests(TestCase):
@@ -93,6 +103,9 @@ class FeatureImplementationTests(TestCase):
                                                                         datasource_symbol=self.dss, candle_period='1S')
         feature_execution_dss.save()
 
+        # Candles are cached in the process, so don't share them between tests
+        CandleWindowCache.clear()
+
     def test_get_data_from_date(self):
         """
         Test that the from date gets the first date available for a candle when no features have been calculated, and
@@ -155,3 +168,567 @@ class FeatureImplementationTests(TestCase):
             get_data(feature_execution_datasource_symbol=self.feature_execution.featureexecutiondatasourcesymbol_set.
                      all()[0])
         self.assertIsNone(data)
+
+    def test_execute_incremental(self):
+        """
+        Test that an incremental feature persists its state between runs and only processes new candles.
+        :return:
+        """
+        # An incremental feature that counts the candles it has processed. The state is the count so far.
+        class CountingFeature(ft.FeatureImplementation):
+            processed = 0
+
+            def init_state(self, feature_execution, history):
+                return len(history.index)
+
+            def update(self, feature_execution, state, new_candles):
+                self.processed += len(new_candles.index)
+                counts = [state + i + 1 for i in range(0, len(new_candles.index))]
+                return state + len(new_candles.index), pd.Series(counts, index=new_candles.index)
+
+        feature_impl = CountingFeature(self.feature_execution.feature)
+        self.assertTrue(feature_impl.incremental)
+
+        # First run will initialise the state and calculate all 1000 candles
+        feature_impl.execute(self.feature_execution)
+        self.assertEqual(feature_impl.processed, 1000)
+        self.assertEqual(len(models.FeatureExecutionResult.objects.filter(feature_execution=self.feature_execution)),
+                         1000)
+        state = models.FeatureExecutionState.objects.get(feature_execution=self.feature_execution)
+        self.assertEqual(state.time, datetime(2020, 1, 1, 0, 16, 40, 0, pytz.UTC))
+
+        # Add 10 candles. Only these should be processed and the count should continue from the state.
+        time = state.time
+        for i in range(0, 10):
+            time = time + timedelta(seconds=1)
+            pd_models.Candle(datasource_symbol=self.dss, time=time, period='1S', bid_open=1, bid_high=1, bid_low=1,
+                             bid_close=1, ask_open=1, ask_high=1, ask_low=1, ask_close=1, volume=i).save()
+
+        feature_impl.execute(self.feature_execution)
+        self.assertEqual(feature_impl.processed, 1010)
+        last = models.FeatureExecutionResult.objects.filter(feature_execution=self.feature_execution).latest('time')
+        self.assertEqual(last.time, time)
+        self.assertEqual(last.result, 1010)
+
+        # Nothing new, nothing processed
+        feature_impl.execute(self.feature_execution)
+        self.assertEqual(feature_impl.processed, 1010)
+
+        # A feature execution without a datasource symbol is skipped, for runs and backfill chunks
+        no_symbol = models.FeatureExecution(feature=self.feature_execution.feature, name="no_symbol")
+        no_symbol.save()
+        feature_impl.execute(no_symbol)
+        self.assertEqual(len(feature_impl.calculate_chunk(no_symbol, state.time, time).index), 0)
+        self.assertEqual(feature_impl.processed, 1010)
+        self.assertFalse(models.FeatureExecutionState.objects.filter(feature_execution=no_symbol).exists())
+
+    def test_execute_batch(self):
+        """
+        Test that a vectorised feature is calculated from a panel of candles and that only candles without results are
+        saved.
+        :return:
+        """
+        # A vectorised feature that doubles the bid close. Records the number of times in each panel.
+        class DoublingFeature(ft.FeatureImplementation):
+            panel_sizes = []
+
+            def calculate_panel(self, panel):
+                self.panel_sizes.append(len(panel.index))
+                return panel['bid_close'] * 2
+
+        feature_impl = DoublingFeature(self.feature_execution.feature)
+        self.assertTrue(feature_impl.vectorised)
+        self.assertFalse(feature_impl.incremental)
+
+        feature_impl.execute_batch([self.feature_execution])
+        results = models.FeatureExecutionResult.objects.filter(feature_execution=self.feature_execution)
+        self.assertEqual(len(results), 1000)
+        candle = pd_models.Candle.objects.get(datasource_symbol=self.dss, time=results[0].time)
+        self.assertAlmostEqual(float(results[0].result), float(candle.bid_close) * 2, places=5)
+
+        # Add 10 candles. The panel should contain them and the calculation period (1 minute) before them.
+        time = results.latest('time').time
+        for i in range(0, 10):
+            time = time + timedelta(seconds=1)
+            pd_models.Candle(datasource_symbol=self.dss, time=time, period='1S', bid_open=1, bid_high=1, bid_low=1,
+                             bid_close=1, ask_open=1, ask_high=1, ask_low=1, ask_close=1, volume=i).save()
+
+        feature_impl.execute_batch([self.feature_execution])
+        self.assertEqual(feature_impl.panel_sizes[-1], 71)
+        self.assertEqual(len(models.FeatureExecutionResult.objects.filter(feature_execution=self.feature_execution)),
+                         1010)
+
+    def test_execute_batch_incremental(self):
+        """
+        Test that incremental feature executions are updated together, with the same number of queries however many
+        feature executions there are.
+        :return:
+        """
+        class CountingFeature(ft.FeatureImplementation):
+            def init_state(self, feature_execution, history):
+                return len(history.index)
+
+            def update(self, feature_execution, state, new_candles):
+                counts = [state + i + 1 for i in range(0, len(new_candles.index))]
+                return state + len(new_candles.index), pd.Series(counts, index=new_candles.index)
+
+        feature_executions = [self.feature_execution]
+        for name in ['test2', 'test3']:
+            feature_execution = models.FeatureExecution(feature=self.feature_execution.feature, name=name)
+            feature_execution.save()
+            models.FeatureExecutionDataSourceSymbol(feature_execution=feature_execution, datasource_symbol=self.dss,
+                                                    candle_period='1S').save()
+            feature_executions.append(feature_execution)
+
+        feature_impl = CountingFeature(self.feature_execution.feature)
+        feature_impl.execute_batch(feature_executions)
+        self.assertEqual(len(models.FeatureExecutionState.objects.all()), 3)
+
+        # Add candles, then update all of the feature executions, then add more and update one
+        time = datetime(2020, 1, 1, 0, 16, 40, 0, pytz.UTC)
+        queries = []
+        for executions in [feature_executions, feature_executions[0:1]]:
+            for i in range(0, 10):
+                time = time + timedelta(seconds=1)
+                pd_models.Candle(datasource_symbol=self.dss, time=time, period='1S', bid_open=1, bid_high=1,
+                                 bid_low=1, bid_close=1, ask_open=1, ask_high=1, ask_low=1, ask_close=1,
+                                 volume=i).save()
+            with CaptureQueriesContext(connection) as context:
+                feature_impl.execute_batch(executions)
+            queries.append(len(context.captured_queries))
+
+        self.assertEqual(queries[0], queries[1])
+        for feature_execution, count in zip(feature_executions, [1020, 1010, 1010]):
+            last = models.FeatureExecutionResult.objects.filter(feature_execution=feature_execution).latest('time')
+            self.assertEqual(last.result, count)
+            state = models.FeatureExecutionState.objects.get(feature_execution=feature_execution)
+            self.assertEqual(state.time, last.time)
+
+    def test_multiple_outputs(self):
+        """
+        Test that features with multiple outputs store them together as floats and that they can be read back as numpy
+        arrays.
+        :return:
+        """
+        # A vectorised feature with two outputs, the bid low and bid high
+        class RangeFeature(ft.FeatureImplementation):
+            def calculate_panel(self, panel):
+                return pd.concat({'low': panel['bid_low'], 'high': panel['bid_high']}, axis=1)
+
+        feature = self.feature_execution.feature
+        feature.outputs = 'low, high'
+        feature.save()
+        self.assertEqual(feature.output_names, ['low', 'high'])
+        self.assertEqual(feature.result_model, models.FeatureExecutionOutput)
+
+        RangeFeature(feature).execute_batch([self.feature_execution])
+        self.assertEqual(len(models.FeatureExecutionOutput.objects.all()), 1000)
+        self.assertEqual(len(models.FeatureExecutionResult.objects.all()), 0)
+
+        # Read them back
+        times, values = ft.FeatureImplementation.get_results(self.feature_execution)
+        self.assertEqual(values.shape, (1000, 2))
+        candles = pd.DataFrame(list(pd_models.Candle.objects.filter(datasource_symbol=self.dss).
+                                    values('time', 'bid_low', 'bid_high'))).set_index('time').sort_index()
+        self.assertTrue((times == candles.index.tz_convert(None).to_numpy()).all())
+        self.assertTrue((abs(values[:, 1] - candles['bid_high'].astype(float).to_numpy()) < 0.000001).all())
+
+        # Read a range
+        times, values = ft.FeatureImplementation.get_results(self.feature_execution,
+                                                             from_date=datetime(2020, 1, 1, 0, 1, 0, 0, pytz.UTC),
+                                                             to_date=datetime(2020, 1, 1, 0, 1, 59, 0, pytz.UTC))
+        self.assertEqual(values.shape, (60, 2))
+
+        # Calculated, so nothing left to get
+        self.assertIsNone(ft.FeatureImplementation.get_data(
+            self.feature_execution.featureexecutiondatasourcesymbol_set.all()[0]))
+
+    @override_settings(ALGOBUILDER_FEATURE_BACKFILL_CHUNK_SIZE='5M')
+    def test_backfill(self):
+        """
+        Test that a new feature execution is backfilled in chunks, that the feature isn't calculated until the backfill
+        is complete and that the results are the same as calculating the whole history at once.
+        :return:
+        """
+        # A vectorised moving average
+        class MeanFeature(ft.FeatureImplementation):
+            def calculate_panel(self, panel):
+                return panel['bid_close'].rolling(pd.to_timedelta(self._feature.calculation_period)).mean()
+
+        feature_impl = MeanFeature(self.feature_execution.feature)
+        self.assertTrue(feature_impl.backfillable)
+
+        # 1000 seconds of candles, in 4 chunks of 5 minutes. Nothing calculated yet.
+        with patch('feature.feature.FeatureImplementation.instance', return_value=feature_impl), \
+                patch('feature.tasks.backfill_feature_execution.delay') as delay:
+            tasks.calculate_feature_executions([self.feature_execution.id])
+            delay.assert_called_once_with(self.feature_execution.id)
+            backfill = models.FeatureExecutionBackfill.objects.get(feature_execution=self.feature_execution)
+            chunks = list(backfill.chunks.order_by('from_date'))
+            self.assertEqual(len(chunks), 4)
+            self.assertEqual(chunks[1].from_date, datetime(2020, 1, 1, 0, 5, 1, 0, pytz.UTC))
+            self.assertEqual(len(models.FeatureExecutionResult.objects.all()), 0)
+
+            # Calculate some chunks, out of order. Only those results are saved and the feature isn't calculated.
+            tasks.backfill_feature_execution_chunk(chunks[2].id)
+            tasks.backfill_feature_execution_chunk(chunks[0].id)
+            self.assertEqual(backfill.progress, (2, 4))
+            tasks.calculate_feature_executions([self.feature_execution.id])
+            self.assertEqual(len(models.FeatureExecutionResult.objects.all()), 600)
+
+            # Resuming only calculates the remaining chunks
+            with patch('feature.tasks.group') as chunk_group:
+                tasks.backfill_feature_execution(self.feature_execution.id)
+                self.assertEqual(len(list(chunk_group.call_args[0][0])), 2)
+            tasks.backfill_feature_execution_chunk(chunks[1].id)
+            tasks.backfill_feature_execution_chunk(chunks[3].id)
+
+        backfill.refresh_from_db()
+        self.assertTrue(backfill.complete)
+
+        # Same as calculating over all the candles
+        candles = pd.DataFrame(list(pd_models.Candle.objects.filter(datasource_symbol=self.dss).
+                                    values('time', 'bid_close'))).set_index('time').sort_index()
+        expected = candles['bid_close'].astype(float).rolling('1min').mean()
+        times, values = ft.FeatureImplementation.get_results(self.feature_execution)
+        self.assertEqual(len(times), 1000)
+        self.assertTrue((abs(values[:, 0] - expected.to_numpy()) < 0.000001).all())
+
+    @override_settings(ALGOBUILDER_FEATURE_DELETE_BATCH_SIZE=300)
+    def test_recompute(self):
+        """
+        Test that changing the calculation period recomputes the results into a new version, that the old version is
+        used until the new one is complete and that the old version is then deleted.
+        :return:
+        """
+        # A vectorised moving average
+        class MeanFeature(ft.FeatureImplementation):
+            def calculate_panel(self, panel):
+                return panel['bid_close'].rolling(pd.to_timedelta(self._feature.calculation_period)).mean()
+
+        feature = self.feature_execution.feature
+        feature_impl = MeanFeature(feature)
+        feature_impl.execute_batch([self.feature_execution])
+        candles = pd.DataFrame(list(pd_models.Candle.objects.filter(datasource_symbol=self.dss).
+                                    values('time', 'bid_close'))).set_index('time').sort_index()['bid_close']
+
+        # Changing the calculation period starts a recompute
+        with patch('feature.tasks.recompute_feature.delay') as recompute:
+            with self.captureOnCommitCallbacks(execute=True):
+                feature.calculation_period = '2M'
+                feature.save()
+                recompute.assert_not_called()
+            recompute.assert_called_once_with(feature.id)
+
+            # Saving again doesn't start another, and features loaded without the calculation period don't query it
+            models.Feature.objects.get(id=feature.id).save()
+            deferred = models.Feature.objects.only('id', 'name').get(id=feature.id)
+            deferred.save()
+            self.assertIn('calculation_period', deferred.get_deferred_fields())
+            recompute.assert_called_once_with(feature.id)
+
+        with patch('feature.feature.FeatureImplementation.instance', return_value=feature_impl), \
+                patch('feature.tasks.backfill_feature_execution.delay'), \
+                patch('feature.tasks.delete_inactive_results.delay') as delete:
+            tasks.recompute_feature(feature.id)
+            backfill = models.FeatureExecutionBackfill.objects.get(feature_execution=self.feature_execution)
+            self.assertEqual(backfill.version, 1)
+
+            # Until the recompute is complete, the original results are active and still calculated
+            self.feature_execution.refresh_from_db()
+            self.assertEqual(self.feature_execution.result_version, 0)
+            times, values = ft.FeatureImplementation.get_results(self.feature_execution)
+            expected = candles.astype(float).rolling('1min').mean()
+            self.assertTrue((abs(values[:, 0] - expected.to_numpy()) < 0.000001).all())
+            with patch.object(feature_impl, 'execute_batch') as execute_batch:
+                tasks.calculate_feature_executions([self.feature_execution.id])
+                execute_batch.assert_called_once()
+
+            # Complete the recompute. The new version is active and the old version deleted.
+            for chunk in backfill.chunks.all():
+                tasks.backfill_feature_execution_chunk(chunk.id)
+            delete.assert_called_once_with(self.feature_execution.id)
+
+            # A chunk completing again, e.g. a retried task, doesn't complete the backfill again
+            chunk = backfill.chunks.first()
+            models.FeatureExecutionBackfillChunk.objects.filter(id=chunk.id).update(complete=False)
+            with patch('feature.store.FeatureResultStore.invalidate') as invalidate:
+                tasks.backfill_feature_execution_chunk(chunk.id)
+                invalidate.assert_not_called()
+            delete.assert_called_once_with(self.feature_execution.id)
+
+        self.feature_execution.refresh_from_db()
+        self.assertEqual(self.feature_execution.result_version, 1)
+        times, values = ft.FeatureImplementation.get_results(self.feature_execution)
+        expected = candles.astype(float).rolling('2min').mean()
+        self.assertEqual(len(times), 1000)
+        self.assertTrue((abs(values[:, 0] - expected.to_numpy()) < 0.000001).all())
+
+        self.assertEqual(len(models.FeatureExecutionResult.objects.all()), 2000)
+        tasks.delete_inactive_results(self.feature_execution.id)
+        self.assertEqual(len(models.FeatureExecutionResult.objects.all()), 1000)
+
+    def test_recompute_dependents(self):
+        """
+        Test that a feature execution calculated from a recomputed one keeps its results until it has been recomputed
+        from the new version, which is done once the recompute of its input is complete.
+        :return:
+        """
+        # A vectorised moving average, and a signal calculated from it that can't be backfilled
+        class MeanFeature(ft.FeatureImplementation):
+            def calculate_panel(self, panel):
+                return panel['bid_close'].rolling(pd.to_timedelta(self._feature.calculation_period)).mean()
+
+        class SignalFeature(ft.FeatureImplementation):
+            def execute(self, feature_execution):
+                data = ft.FeatureImplementation.get_input_data(feature_execution)
+                if data is not None:
+                    data = data[data['result'].isnull()]
+                    ft.FeatureImplementation.save_results(feature_execution, data['test'].astype(float) * 2)
+
+        feature = self.feature_execution.feature
+        signal = models.Feature(name="signal", pluginclass=self.plugin_class, calculation_frequency='{"minute": "*"}',
+                                calculation_period='1M')
+        signal.save()
+        signal.input_features.add(feature)
+        signal_execution = models.FeatureExecution(feature=signal, name="signal")
+        signal_execution.save()
+        signal_execution.input_executions.add(self.feature_execution)
+
+        implementations = {feature.name: MeanFeature(feature), signal.name: SignalFeature(signal)}
+        implementations[feature.name].execute_batch([self.feature_execution])
+        implementations[signal.name].execute(signal_execution)
+        times, old_values = ft.FeatureImplementation.get_results(signal_execution)
+        self.assertEqual(len(times), 1000)
+
+        with patch('feature.feature.FeatureImplementation.instance', side_effect=lambda name: implementations[name]), \
+                patch('feature.tasks.backfill_feature_execution.delay'), \
+                patch('feature.tasks.delete_inactive_results.delay') as delete:
+            feature.calculation_period = '2M'
+            feature.save()
+            tasks.recompute_feature(feature.id)
+            for chunk in models.FeatureExecutionBackfillChunk.objects.filter(
+                    backfill__feature_execution=self.feature_execution):
+                tasks.backfill_feature_execution_chunk(chunk.id)
+            self.feature_execution.refresh_from_db()
+            self.assertEqual(self.feature_execution.result_version, 1)
+
+            # The signal is being recomputed from the new version of its input. Until then it keeps its old results.
+            backfill = models.FeatureExecutionBackfill.objects.get(feature_execution=signal_execution)
+            self.assertEqual((backfill.version, backfill.chunks.count()), (1, 1))
+            signal_execution.refresh_from_db()
+            self.assertEqual(signal_execution.result_version, 0)
+            times, values = ft.FeatureImplementation.get_results(signal_execution)
+            self.assertTrue((values == old_values).all())
+            delete.assert_called_once_with(self.feature_execution.id)
+
+            # Once recomputed, the new version is active and the old version deleted
+            tasks.backfill_feature_execution_chunk(backfill.chunks.get().id)
+            delete.assert_called_with(signal_execution.id)
+
+        signal_execution.refresh_from_db()
+        self.assertEqual(signal_execution.result_version, 1)
+        times, values = ft.FeatureImplementation.get_results(signal_execution)
+        input_times, input_values = ft.FeatureImplementation.get_results(self.feature_execution)
+        self.assertEqual(len(times), 1000)
+        self.assertTrue((abs(values - input_values * 2) < 0.000001).all())
+        self.assertFalse((values == old_values).all())
+
+    def test_get_results(self):
+        """
+        Test that single results are read back as a single column of floats
+        :return:
+        """
+        time = datetime(2020, 1, 1, 0, 0, 0, 0, pytz.UTC)
+        for i in range(0, 10):
+            models.FeatureExecutionResult(feature_execution=self.feature_execution, time=time + timedelta(seconds=i),
+                                          result=i / 4).save()
+
+        times, values = ft.FeatureImplementation.get_results(self.feature_execution)
+        self.assertEqual(values.shape, (10, 1))
+        self.assertEqual(values.dtype, np.float64)
+        self.assertEqual(values[9, 0], 2.25)
+        self.assertEqual(times[0], np.datetime64('2020-01-01T00:00:00'))
+
+    def test_result_store(self):
+        """
+        Test that the result store serves repeated reads from its cache and only reads new results once invalidated
+        :return:
+        """
+        time = datetime(2020, 1, 1, 0, 0, 0, 0, pytz.UTC)
+        for i in range(0, 10):
+            models.FeatureExecutionResult(feature_execution=self.feature_execution, time=time + timedelta(seconds=i),
+                                          result=i).save()
+        store.FeatureResultStore.clear()
+
+        # First read from the database, then from the cache. Each read also reads the version of the cached tail from
+        # the invalidation cache, a database cache
+        results = store.FeatureResultStore.get([self.feature_execution], from_date=time + timedelta(seconds=5))
+        self.assertEqual(list(results[self.feature_execution.name]), [5, 6, 7, 8, 9])
+        with self.assertNumQueries(1):
+            results = store.FeatureResultStore.get([self.feature_execution], from_date=time + timedelta(seconds=6),
+                                                   to_date=time + timedelta(seconds=8))
+        self.assertEqual(list(results[self.feature_execution.name]), [6, 7, 8])
+
+        # Once invalidated, only the new result is read
+        models.FeatureExecutionResult(feature_execution=self.feature_execution, time=time + timedelta(seconds=10),
+                                      result=10).save()
+        store.FeatureResultStore.invalidate([self.feature_execution.id])
+        with self.assertNumQueries(2):
+            times, values = store.FeatureResultStore.get_arrays(self.feature_execution,
+                                                                from_date=time + timedelta(seconds=8))
+        self.assertEqual(list(values[:, 0]), [8, 9, 10])
+
+        # Reading from before the cached tail goes back to the database
+        results = store.FeatureResultStore.get([self.feature_execution])
+        self.assertEqual(len(results.index), 11)
+        self.assertEqual(results.index[0], time)
+
+        # An existing result is changed, then a new result written, before the next read. The tail is read again.
+        models.FeatureExecutionResult.objects.filter(feature_execution=self.feature_execution,
+                                                     time=time + timedelta(seconds=9)).update(result=99)
+        store.FeatureResultStore.invalidate([self.feature_execution.id], reset=True)
+        models.FeatureExecutionResult(feature_execution=self.feature_execution, time=time + timedelta(seconds=11),
+                                      result=11).save()
+        store.FeatureResultStore.invalidate([self.feature_execution.id])
+        results = store.FeatureResultStore.get([self.feature_execution], from_date=time + timedelta(seconds=8))
+        self.assertEqual(list(results[self.feature_execution.name]), [8, 99, 10, 11])
+
+
+class FeatureGraphTests(TestCase):
+    """
+    Tests the feature dependency graph, loading of input feature results and calculation of dependent features.
+    """
+
+    def setUp(self) -> None:
+        """
+        Create a chain of features and executions, price -> ma -> signal, with a second input, volatility, to signal.
+        :return:
+        """
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        plugin_class.save()
+
+        self.executions = {}
+        for name in ['ma', 'volatility', 'signal']:
+            feature = models.Feature(name=name, pluginclass=plugin_class, calculation_frequency='{"minute": "*"}',
+                                     calculation_period='2S')
+            feature.save()
+            self.executions[name] = models.FeatureExecution(feature=feature, name=f'{name}_exec')
+            self.executions[name].save()
+
+        signal = self.executions['signal']
+        signal.feature.input_features.add(self.executions['ma'].feature, self.executions['volatility'].feature)
+        signal.input_executions.add(self.executions['ma'], self.executions['volatility'])
+
+    def __add_results(self, name, num, start=0):
+        """
+        Adds num 1 second results to the named execution
+        """
+        time = datetime(2020, 1, 1, 0, 0, 0, 0, pytz.UTC)
+        for i in range(start, start + num):
+            models.FeatureExecutionResult(feature_execution=self.executions[name], time=time + timedelta(seconds=i),
+                                          result=i).save()
+
+    def test_topological_order(self):
+        """
+        Inputs should be ordered before the executions calculated from them and cycles should be detected.
+        :return:
+        """
+        ids = {name: fe.id for name, fe in self.executions.items()}
+        dependency_graph = graph.FeatureExecutionGraph()
+        self.assertEqual(dependency_graph.descendants([ids['ma']]), {ids['signal']})
+        order = dependency_graph.topological_order(ids.values())
+        self.assertLess(order.index(ids['ma']), order.index(ids['signal']))
+        self.assertLess(order.index(ids['volatility']), order.index(ids['signal']))
+
+        # Make ma depend on signal
+        self.executions['ma'].input_executions.add(self.executions['signal'])
+        self.assertRaises(graph.FeatureDependencyCycleError, graph.FeatureExecutionGraph().topological_order,
+                          ids.values())
+
+    def test_get_input_data(self):
+        """
+        Input data should contain a column per input execution, only for times where all inputs have results, and from
+        the calculation period before the first time not yet calculated.
+        :return:
+        """
+        self.__add_results('ma', 10)
+        self.__add_results('volatility', 8)
+        data = ft.FeatureImplementation.get_input_data(self.executions['signal'])
+        self.assertEqual(len(data.index), 8)
+        self.assertEqual(set(data.columns), {'ma_exec', 'volatility_exec', 'result'})
+
+        # Calculate the first 5. We should get the 2 seconds of calculated data before the first uncalculated result.
+        self.__add_results('signal', 5)
+        data = ft.FeatureImplementation.get_input_data(self.executions['signal'])
+        self.assertEqual(len(data.index), 5)
+        self.assertEqual(len(data[data['result'].notnull()]), 2)
+
+    def test_get_input_data_multiple_outputs(self):
+        """
+        A dependent feature with multiple outputs, calculated from an input with multiple outputs, should get a column
+        per input output and only calculate the times that it hasn't already calculated.
+        :return:
+        """
+        class SignalFeature(ft.FeatureImplementation):
+            def execute(self, feature_execution):
+                data = ft.FeatureImplementation.get_input_data(feature_execution)
+                data = data[data['result'].isnull()]
+                ma = data['ma_exec'].astype(float)
+                results = pd.DataFrame({'buy': ma + data['volatility_exec.low'],
+                                        'sell': ma + data['volatility_exec.high']}, index=data.index)
+                ft.FeatureImplementation.save_results(feature_execution, results)
+
+        for name, outputs in [('volatility', 'low,high'), ('signal', 'buy,sell')]:
+            self.executions[name].feature.outputs = outputs
+            self.executions[name].feature.save()
+            self.executions[name].refresh_from_db()
+
+        time = datetime(2020, 1, 1, 0, 0, 0, 0, pytz.UTC)
+        self.__add_results('ma', 10)
+        for i in range(0, 8):
+            models.FeatureExecutionOutput(feature_execution=self.executions['volatility'],
+                                          time=time + timedelta(seconds=i), outputs=[-i, i]).save()
+
+        data = ft.FeatureImplementation.get_input_data(self.executions['signal'])
+        self.assertEqual(set(data.columns), {'ma_exec', 'volatility_exec.low', 'volatility_exec.high', 'result'})
+        self.assertEqual(len(data.index), 8)
+
+        signal = SignalFeature(self.executions['signal'].feature)
+        signal.execute(self.executions['signal'])
+        results = models.FeatureExecutionOutput.objects.filter(feature_execution=self.executions['signal'])
+        self.assertEqual(results.count(), 8)
+        self.assertEqual(results.order_by('-time').first().outputs, [0, 14])
+
+        # Nothing new to calculate until the volatility results advance
+        self.assertIsNone(ft.FeatureImplementation.get_input_data(self.executions['signal']))
+        for i in range(8, 10):
+            models.FeatureExecutionOutput(feature_execution=self.executions['volatility'],
+                                          time=time + timedelta(seconds=i), outputs=[-i, i]).save()
+        signal.execute(self.executions['signal'])
+        self.assertEqual(results.count(), 10)
+
+    @patch('feature.feature.FeatureImplementation.instance')
+    def test_calculate_dependents(self, instance):
+        """
+        Calculating an input should calculate its dependents, but only when the inputs have advanced.
+        :return:
+        """
+        implementation = MagicMock()
+        instance.return_value = implementation
+
+        # The ma and volatility executions are ahead of signal. Calculating ma should also calculate signal.
+        self.__add_results('ma', 10)
+        self.__add_results('volatility', 10)
+        tasks.calculate_feature(self.executions['ma'].feature.id)
+        executed = [fe.name for c in implementation.execute_batch.call_args_list for fe in c.args[0]]
+        self.assertEqual(executed, ['ma_exec', 'signal_exec'])
+
+        # Signal is now up to date with its inputs. It should not be calculated again.
+        self.__add_results('signal', 10)
+        implementation.reset_mock()
+        tasks.calculate_feature(self.executions['ma'].feature.id)
+        executed = [fe.name for c in implementation.execute_batch.call_args_list for fe in c.args[0]]
+        self.assertEqual(executed, ['ma_exec'])
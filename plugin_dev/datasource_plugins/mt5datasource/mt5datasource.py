@@ -1,14 +1,16 @@
 
 import json
 import logging
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
-from typing import List, Dict, Tuple
+from typing import List, Dict
 
 import MetaTrader5
 
 from pricedata import datasource as ds
 from pricedata import models
+from pricedata.aggregation import TickAggregator
 
 
 class MT5DataSource(ds.DataSourceImplementation):
@@ -19,6 +21,15 @@ class MT5DataSource(ds.DataSourceImplementation):
     # Logger
     __log = logging.getLogger(__name__)
 
+    # Number of days of data to retrieve in the first window for each time period. Later windows are sized from the
+    # number of rows returned.
+    __period_batch_days = {'1S': 1 / 24, '5S': 1 / 24 * 5, '10S': 1 / 24 * 10, '15S': 1 / 24 * 15, '30S': 1, '1M': 1,
+                           '5M': 5, '10M': 10, '15M': 15, '30M': 30, '1H': 60, '3H': 60, '6H': 60, '12H': 60,
+                           '1D': 120, '1W': 120, '1MO': 120}
+
+    # The columns of the rates returned by MT5
+    __rates_columns = ['time', 'open', 'high', 'low', 'close', 'tick_volume', 'spread', 'real_volume']
+
     def __init__(self, datasource):
         # Super
         ds.DataSourceImplementation.__init__(self, datasource=datasource)
@@ -34,8 +45,20 @@ class MT5DataSource(ds.DataSourceImplementation):
         # Print data on MetaTrader 5 version
         self.__log.debug(MetaTrader5.version())
 
-    def __del__(self):
-        # shut down connection to the MetaTrader 5 terminal
+    def check_health(self) -> bool:
+        """
+        Checks that the MetaTrader 5 terminal is still running and connected to the trade server.
+        :return:
+        """
+        terminal_info = MetaTrader5.terminal_info()
+        return terminal_info is not None and terminal_info.connected
+
+    def shutdown(self):
+        """
+        Shuts down the connection to the MetaTrader 5 terminal. Called when the pooled instance is discarded, rather
+        than on garbage collection, as the connection is shared by all instances in the process.
+        :return:
+        """
         MetaTrader5.shutdown()
 
     def get_symbols(self) -> List[Dict[str, any]]:
@@ -125,132 +148,100 @@ class MT5DataSource(ds.DataSourceImplementation):
                                    'ask_close': prices['close'] + round((prices['spread'] * point), digits),
                                    'volume': prices['tick_volume']})
 
-            prices_dataframe['time'] = pd.to_datetime(prices_dataframe['time'], unit='s')
+            # Make time timezone aware. Times returned from MT5 are in UTC
+            prices_dataframe['time'] = pd.to_datetime(prices_dataframe['time'], unit='s').dt.tz_localize('UTC')
         else:
             # Get ticks from MT5
             ticks = self.__get_ticks(symbol, from_date, to_date, period)
-            self.__log.debug(f"{len(ticks)} ticks retrieved for {symbol}.")
-
-            try:
-                # Create dataframe from data and convert time in seconds to datetime format
-                ticks_dataframe = pd.DataFrame(ticks)
-                ticks_dataframe['time'] = pd.to_datetime(ticks_dataframe['time'], unit='s')
-
-                # Set the index, resample bid and ask columns, merge, then reset index
-                ticks_dataframe = ticks_dataframe.set_index('time')
-                ohlc_calcs = {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'count'}
-                bid_candles = ticks_dataframe['bid'].resample(period).agg(ohlc_calcs)
-                ask_candles = ticks_dataframe['ask'].resample(period).agg(ohlc_calcs)
-                prices_dataframe = pd.concat([bid_candles, ask_candles], axis=1)
-                prices_dataframe.reset_index(inplace=True)
-
-                # We should now have time and (open, high, low, close, volume) * 2, one for bid and one for ask.
-                # Add period, rename the columns, then delete the first volume column.
-                prices_dataframe.insert(1, 'period', period)
-                prices_dataframe.columns = ['time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close',
-                                            'bid_volume', 'ask_open', 'ask_high', 'ask_low', 'ask_close', 'volume']
-                prices_dataframe.drop('bid_volume', axis=1, inplace=True)  # First volume column
-
-                # Remove n/a
-                prices_dataframe = prices_dataframe.dropna()
-
-            except RecursionError as ex:
-                self.__log.warning("Error converting ticks to dataframe and resampling.", ex)
+
+            if ticks is not None and len(ticks.index) > 0:
+                self.__log.debug(f"{len(ticks.index)} ticks retrieved for {symbol}.")
+
+                # Aggregate the ticks into candles. Tick times are in ms since the epoch, UTC. Volume is the number of
+                # ticks. A trailing candle that isn't complete by the to date isn't returned, so that it is retrieved
+                # with all its ticks on the next run.
+                candles = TickAggregator.aggregate(ticks['time_msc'].to_numpy(dtype='int64') * 10**6,
+                                                   ticks['bid'].to_numpy(), ticks['ask'].to_numpy(), [period],
+                                                   complete_to=pd.Timestamp(to_date).value)
+                prices_dataframe = candles[period][self._prices_columns]
 
         # If the dataframe is None, create an empty one
         if prices_dataframe is None:
             prices_dataframe = pd.DataFrame(columns=self._prices_columns)
 
-        # Make time timezone aware. Times returned from MT5 are in UTC
-        if not prices_dataframe.empty:
-            prices_dataframe['time'] = prices_dataframe['time'].dt.tz_localize('UTC')
-
         return prices_dataframe
 
-    @staticmethod
-    def __get_batches(from_date: datetime, to_date: datetime, period: str) -> List[Tuple[datetime, datetime]]:
+    def get_ticks(self, symbol: str, from_date: datetime, to_date: datetime,
+                  symbol_info: Dict[str, any] = None) -> pd.DataFrame:
         """
-        Gets a list of from and to dates for batching of requests.
-        :param from_date: The from date
-        :param to_date: The to date
-        :param period: The period for the candles. Lower periods require smaller batch sizes.
-        :return: list of from date and to date pairs covering range of from and to dates, split into batches.
+        Gets ticks for the specified symbol from MT5.
+        :param symbol: The name of the symbol to get the ticks for.
+        :param from_date: Date from when to retrieve ticks
+        :param to_date: Date to retrieve ticks up to
+        :param symbol_info: Not required for MT5.
+
+        :return: Ticks for symbol as pandas dataframe containing the following columns: ['time', 'bid', 'ask']
         """
-        # Define number of days of data to retrieve on each run for each time period
-        period_batch_days = {'1S': 1 / 24, '5S': 1 / 24 * 5, '10S': 1 / 24 * 10, '15S': 1 / 24 * 15, '30S': 1, '1M': 1,
-                             '5M': 5, '10M': 10, '15M': 15, '30M': 30, '1H': 60, '3H': 60, '6H': 60, '12H': 60,
-                             '1D': 120, '1W': 120, '1MO': 120}
-
-        batches = []
-        last_batch_to = from_date  # for first run.
-        while last_batch_to < to_date:
-            # The first batch starts from from date. Subsequent batches start from 1ms past the last batches to date.
-            # Batches end earliest of the end date for the batch size or the to date.
-            batch_from = from_date if last_batch_to is None else (last_batch_to + timedelta(milliseconds=1))
-            batch_to = min(batch_from + timedelta(days=period_batch_days[period]), to_date)
-            batches.append((batch_from, batch_to))
-            last_batch_to = batch_to
-
-        return batches
+        ticks = self.__get_ticks(symbol, from_date, to_date, '1S')
+
+        if ticks is None or len(ticks.index) == 0:
+            return pd.DataFrame(columns=self._ticks_columns)
+
+        # Tick times are in ms since the epoch, UTC
+        return pd.DataFrame({'time': pd.to_datetime(ticks['time_msc'], unit='ms', utc=True), 'bid': ticks['bid'],
+                             'ask': ticks['ask']})[self._ticks_columns]
 
     def __get_rates(self, symbol: str, from_date: datetime, to_date: datetime, period: str,
                     timeframe: int) -> pd.DataFrame:
         """
-        Gets rates from MT5, handling batching
+        Gets rates from MT5, in windows
         :param symbol: The symbol to retrieve price data for
         :param from_date: The date to retrieve the price data from
         :param to_date: The date to retrieve the price data to
-        :param period: The period to retrieve. Used to calculate batch size
+        :param period: The period to retrieve. Used to calculate the first window size
         :param timeframe: The timeframe for the candles to retrieve
         :return: dataframe
         """
-        batches = MT5DataSource.__get_batches(from_date, to_date, period)
-
-        # The dataframe to contain the full dataset
-        data = None
-
-        for batch in batches:
-            # Get the data
-            prices = MetaTrader5.copy_rates_range(symbol, timeframe, batch[0], batch[1])
+        def fetch(window_from: datetime, window_to: datetime) -> np.ndarray:
+            prices = MetaTrader5.copy_rates_range(symbol, timeframe, window_from, window_to)
             if prices is None:
                 error = MetaTrader5.last_error()
                 raise ds.DataNotAvailableException(datasource=self._datasource.name, symbol=symbol,
                                                    period=period, from_date=from_date, to_date=to_date,
                                                    error_code=error[0], error_message=error[1])
-            else:
-                # Create or append to dataframe
-                data = pd.DataFrame(prices) if data is None else data.append(pd.DataFrame(prices))
+            return prices
 
-        # Remove any duplicates. Datasource can return refreshed candle if end time of previous batch and start time of
-        # current batch is within the same candle period.
+        # The MetaTrader5 package isn't thread safe, so windows are fetched one at a time
+        prices = self._fetch_batched(fetch, from_date, to_date, timedelta(days=self.__period_batch_days[period]),
+                                     max_workers=1)
+        data = pd.DataFrame(prices) if prices is not None else pd.DataFrame(columns=self.__rates_columns)
+
+        # Remove any duplicates. Datasource can return refreshed candle if end time of previous window and start time
+        # of current window is within the same candle period.
         data = data.drop_duplicates(subset=['time'], keep='last')
 
         return data
 
     def __get_ticks(self, symbol: str, from_date: datetime, to_date: datetime, period: str) -> pd.DataFrame:
         """
-        Gets ticks from MT5, handling batching
+        Gets ticks from MT5, in windows
         :param symbol: The symbol to retrieve tick data for
         :param from_date: The date to retrieve the price data from
         :param to_date: The date to retrieve the price data to
-        :param period: The period to retrieve. Used to calculate batch size
+        :param period: The period to retrieve. Used to calculate the first window size
         :return: dataframe
         """
-        batches = MT5DataSource.__get_batches(from_date, to_date, period)
-
-        # The dataframe to contain the full dataset
-        data = None
-
-        for batch in batches:
-            # Get the data
-            ticks = MetaTrader5.copy_ticks_range(symbol, batch[0], batch[1], MetaTrader5.COPY_TICKS_ALL)
+        def fetch(window_from: datetime, window_to: datetime) -> np.ndarray:
+            ticks = MetaTrader5.copy_ticks_range(symbol, window_from, window_to, MetaTrader5.COPY_TICKS_ALL)
             if ticks is None:
                 error = MetaTrader5.last_error()
                 raise ds.DataNotAvailableException(datasource=self._datasource.name, symbol=symbol,
                                                    period=period, from_date=from_date, to_date=to_date,
                                                    error_code=error[0], error_message=error[1])
-            else:
-                # Create or append to dataframe
-                data = pd.DataFrame(ticks) if data is None else data.append(pd.DataFrame(ticks))
+            return ticks
 
-        return data
+        # The MetaTrader5 package isn't thread safe, so windows are fetched one at a time
+        ticks = self._fetch_batched(fetch, from_date, to_date, timedelta(days=self.__period_batch_days[period]),
+                                    max_workers=1)
+
+        return pd.DataFrame(ticks) if ticks is not None else None
@@ -1,55 +1,85 @@
 import logging
 
-from algobuilder.utils import DatabaseUtility
+import numpy as np
+import pandas as pd
+
 from feature import feature as ft
-from feature import models
 
 
 class MovingAverage(ft.FeatureImplementation):
     """
-    Calculates a moving average
+    Calculates a moving average. Feature executions that haven't been calculated before are calculated together in one
+    vectorised pass. From then on, they are calculated incrementally. The state holds the bid close prices and times
+    for the candles within the calculation period of the last candle calculated, with their sum and count, so each run
+    only reads the new candles and only processes them and the candles that they move out of the calculation period.
+    The candles in the calculation period are still stored with the state on each run.
     """
 
     # Logger
     __log = logging.getLogger(__name__)
 
-    def execute(self, feature_execution):
+    def calculate_panel(self, panel):
+        """
+        Calculates the moving average for every feature execution in the panel in one pass.
+        :param panel:
+        :return: Moving averages, time x feature execution.
+        """
+        return panel['bid_close'].rolling(self._feature.calculation_period).mean()
+
+    def init_state(self, feature_execution, history):
         """
-        Executes the feature calculation for a single execution
+        Creates the state from the candles already calculated that fall within the calculation period.
         :param feature_execution:
-        :return:
+        :param history:
+        :return: dict containing the times (int64 nanoseconds) and bid close prices of the candles in the window, and
+            their sum and count.
+        """
+        state = {'times': np.empty(0, dtype=np.int64), 'values': np.empty(0, dtype=np.float64), 'sum': 0.0, 'count': 0}
+
+        if len(history.index) > 0:
+            window = pd.to_timedelta(feature_execution.feature.calculation_period).value
+            history = history.sort_index()
+            times = history.index.asi8
+            keep = times > times[-1] - window
+            state['times'] = times[keep]
+            state['values'] = history['bid_close'].to_numpy(dtype=np.float64)[keep]
+            state['sum'] = float(state['values'].sum())
+            state['count'] = len(state['values'])
+
+        return state
+
+    def update(self, feature_execution, state, new_candles):
         """
-        # Get the symbols. There should only be 1
-        assert len(feature_execution.featureexecutiondatasourcesymbol_set.all()) == 1
-        feds = feature_execution.featureexecutiondatasourcesymbol_set.all()[0]
-
-        self.__log.debug(f"Calculating moving average for {feature_execution}. FeatureExecutionDataSourceSymbol={feds}")
-
-        # Get the data. Candles that don't have a feature calculated and those that do but are required for teh first
-        # calculation.
-        data = ft.FeatureImplementation.get_data(feds)
-
-        # If get_data returned None, then we don't have any features to calculate. Otherwise calculate the moving
-        # average from the data.
-        if data is not None:
-            # Calculate the moving average
-            data['moving_average'] = data['bid_close'].rolling(feature_execution.feature.calculation_period).mean()
-
-            # Remove the rows that already had a result and were only used to calculate the first results.
-            data = data[data['result'].isna()]
-
-            # Reshape the dataframe for upload into the feature_execution_result table. This will require candle_id,
-            # feature_execution_id and result
-            data = data.reset_index()
-            data['feature_execution_id'] = feature_execution.id
-            data['result'] = data['moving_average']
-            data = data.drop(labels=data.columns.difference(['time', 'feature_execution_id', 'result']), axis=1)
-
-            # Save the calculations
-            DatabaseUtility.bulk_insert_or_update(data=data,
-                                                  table=models.FeatureExecutionResult.objects.model._meta.db_table,
-                                                  batch_size=1000)
-
-        else:
-            self.__log.debug(f"Feature calculations up to date. No new features calculated for "
-                             f"{feds.datasource_symbol.symbol.name}.")
+        Calculates the moving average for the new candles. Each mean is over the candles in the calculation period up
+        to and including the candle, consistent with pandas rolling over a time offset.
+        :param feature_execution:
+        :param state:
+        :param new_candles:
+        :return: Tuple of updated state and moving averages for the new candles.
+        """
+        self.__log.debug(f"Calculating moving average for {feature_execution}. {len(new_candles.index)} new candles.")
+        if len(new_candles.index) == 0:
+            return state, pd.Series(dtype=np.float64, index=new_candles.index)
+
+        window = pd.to_timedelta(feature_execution.feature.calculation_period).value
+        times = new_candles.index.asi8
+        values = new_candles['bid_close'].to_numpy(dtype=np.float64)
+
+        # The number of candles in the window and of the new candles that have left the window of each new candle
+        evicted = np.searchsorted(state['times'], times - window, side='right')
+        evicted_new = np.searchsorted(times, times - window, side='right')
+
+        # Mean for each new candle from the running sum and count, adding the new candles up to and including it and
+        # subtracting those that have left its window. Only the candles that leave the window are summed.
+        cumsum = np.concatenate([[0.0], np.cumsum(values)])
+        evicted_cumsum = np.concatenate([[0.0], np.cumsum(state['values'][:evicted[-1]])])
+        sums = state['sum'] + cumsum[1:] - evicted_cumsum[evicted] - cumsum[evicted_new]
+        counts = state['count'] + np.arange(1, len(times) + 1) - evicted - evicted_new
+        means = sums / counts
+
+        # Keep only the candles that will be in the window for the next calculation
+        state = {'times': np.concatenate([state['times'][evicted[-1]:], times[evicted_new[-1]:]]),
+                 'values': np.concatenate([state['values'][evicted[-1]:], values[evicted_new[-1]:]]),
+                 'sum': float(sums[-1]), 'count': int(counts[-1])}
+
+        return state, pd.Series(means, index=new_candles.index)
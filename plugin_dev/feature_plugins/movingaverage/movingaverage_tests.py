@@ -2,6 +2,7 @@ import logging
 from datetime import datetime, timedelta
 from random import random
 
+import pandas as pd
 import pytz
 from django.test import TestCase
 
@@ -95,4 +96,80 @@ class TestMovingAverageFeature(TestCase):
             # We should have 1000 + another 10 for every iteration of this loop
             self.assertEqual(len(results), 1000 + (i+1)*10)
 
+    def test_matches_rolling_mean(self):
+        """
+        Test that the incrementally calculated moving average matches a pandas rolling mean over all the candles,
+        including when calculated over several runs.
+        :return:
+        """
+        # Calculate over the first 1000 candles, then add 100 more and calculate again
+        ft_imp = MovingAverage(self.feature)
+        ft_imp.execute(feature_execution=self.feature_execution)
+
+        time = datetime(2020, 1, 1, 0, 16, 40, 0, pytz.UTC)
+        for i in range(0, 100):
+            price = random()
+            time = time + timedelta(seconds=1)
+            pd_models.Candle(datasource_symbol=self.dss, time=time, period='1S', bid_open=price, bid_high=price,
+                             bid_low=price, bid_close=price, ask_open=price, ask_high=price, ask_low=price,
+                             ask_close=price, volume=i).save()
+        ft_imp.execute(feature_execution=self.feature_execution)
+
+        # Compare with pandas
+        candles = pd.DataFrame(list(pd_models.Candle.objects.filter(datasource_symbol=self.dss).values('time',
+                                                                                                      'bid_close')))
+        expected = candles.set_index('time').sort_index()['bid_close'].astype(float).rolling('1min').mean()
+        results = pd.DataFrame(list(ft_models.FeatureExecutionResult.objects.filter(
+            feature_execution=self.feature_execution).values('time', 'result')))
+        results = results.set_index('time').sort_index()['result'].astype(float)
 
+        self.assertEqual(len(results.index), 1100)
+        self.assertTrue(((results - expected).abs() < 0.000001).all())
+
+    def test_execute_batch(self):
+        """
+        Test that feature executions calculated together in a batch match a pandas rolling mean for each symbol, and
+        that they continue incrementally afterwards.
+        :return:
+        """
+        # A second symbol with 500 candles, offset by half a second from the first
+        symbol = pd_models.Symbol(name="test2", instrument_type="FOREX")
+        symbol.save()
+        dss2 = pd_models.DataSourceSymbol(datasource=self.dss.datasource, symbol=symbol, retrieve_price_data=True)
+        dss2.save()
+        time = datetime(2020, 1, 1, 0, 0, 0, 500000, pytz.UTC)
+        for i in range(0, 500):
+            price = random()
+            time = time + timedelta(seconds=1)
+            pd_models.Candle(datasource_symbol=dss2, time=time, period='1S', bid_open=price, bid_high=price,
+                             bid_low=price, bid_close=price, ask_open=price, ask_high=price, ask_low=price,
+                             ask_close=price, volume=i).save()
+        feature_execution2 = ft_models.FeatureExecution(feature=self.feature, name='test2')
+        feature_execution2.save()
+        ft_models.FeatureExecutionDataSourceSymbol(feature_execution=feature_execution2, datasource_symbol=dss2,
+                                                   candle_period='1S').save()
+
+        ft_imp = MovingAverage(self.feature)
+        self.assertTrue(ft_imp.vectorised)
+        ft_imp.execute_batch([self.feature_execution, feature_execution2])
+
+        for feature_execution, dss, num in [(self.feature_execution, self.dss, 1000), (feature_execution2, dss2, 500)]:
+            candles = pd.DataFrame(list(pd_models.Candle.objects.filter(datasource_symbol=dss).values('time',
+                                                                                                      'bid_close')))
+            expected = candles.set_index('time').sort_index()['bid_close'].astype(float).rolling('1min').mean()
+            results = pd.DataFrame(list(ft_models.FeatureExecutionResult.objects.filter(
+                feature_execution=feature_execution).values('time', 'result')))
+            results = results.set_index('time').sort_index()['result'].astype(float)
+            self.assertEqual(len(results.index), num)
+            self.assertTrue(((results - expected).abs() < 0.000001).all())
+
+        # Now calculated, the next batch should continue incrementally and persist state
+        ft_imp.execute_batch([self.feature_execution, feature_execution2])
+        self.assertEqual(len(ft_models.FeatureExecutionState.objects.all()), 0)
+        pd_models.Candle(datasource_symbol=dss2, time=time + timedelta(seconds=1), period='1S', bid_open=1,
+                         bid_high=1, bid_low=1, bid_close=1, ask_open=1, ask_high=1, ask_low=1, ask_close=1,
+                         volume=1).save()
+        ft_imp.execute_batch([self.feature_execution, feature_execution2])
+        self.assertEqual(len(ft_models.FeatureExecutionResult.objects.filter(feature_execution=feature_execution2)),
+                         501)
+        self.assertEqual(len(ft_models.FeatureExecutionState.objects.all()), 1)
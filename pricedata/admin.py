@@ -9,7 +9,8 @@ admin.site.index_title = 'AlgoBuilder administration'
 
 # DataSourceCandlePeriod. Not registered as used in line on DataSource admin
 class DataSourceCandlePeriodAdmin(admin.ModelAdmin):
-    list_display = ("datasource", "period", "start_from", "active")
+    list_display = ("datasource", "period", "start_from", "derived_from", "from_ticks", "active", "next_retrieval",
+                    "retrieval_seconds", "idle_retrievals")
     list_editable = ("period", "start_from", "active")
     list_filter = ("datasource__name", "period")
 
@@ -17,7 +18,9 @@ class DataSourceCandlePeriodAdmin(admin.ModelAdmin):
 # CandlePeriods will be administered on datasource admin page
 class CandlePeriods(admin.TabularInline):
     model = models.DataSourceCandlePeriod
-    fields = ("datasource", "period", "start_from", "active")
+    fields = ("datasource", "period", "start_from", "derived_from", "from_ticks", "active", "next_retrieval",
+              "retrieval_seconds", "idle_retrievals")
+    readonly_fields = ("next_retrieval", "retrieval_seconds", "idle_retrievals")
     extra = 0
 
 
@@ -39,6 +42,14 @@ class SymbolAdmin(admin.ModelAdmin):
     search_fields = ["name", "instrument_type"]
 
 
+# TradingSession
+@admin.register(models.TradingSession)
+class TradingSessionAdmin(admin.ModelAdmin):
+    list_display = ("symbol", "instrument_type", "open_day", "open_time", "close_day", "close_time")
+    list_filter = ("instrument_type", "open_day")
+    search_fields = ["symbol__name"]
+
+
 # DataSourceSymbol
 @admin.action(description='Set retrieve price data for all')
 def set_retrieve_price_data_for_all(modeladmin, request, queryset):
@@ -65,3 +76,20 @@ class DataSourceSymbolAdmin(admin.ModelAdmin):
     search_fields = ["symbol__name", "symbol__instrument_type"]
     actions = [set_retrieve_price_data_for_all, unset_retrieve_price_data_for_all]
 
+
+# CandleGap
+@admin.action(description='Retry repair of selected gaps')
+def retry_candle_gaps(modeladmin, request, queryset):
+    from pricedata import tasks  # Imported when needed, due to circular dependency
+    queryset.update(status=models.CandleGap.STATUS_OPEN, attempts=0)
+    for gap_id in queryset.values_list('id', flat=True):
+        tasks.repair_gap.delay(gap_id)
+
+
+@admin.register(models.CandleGap)
+class CandleGapAdmin(admin.ModelAdmin):
+    list_display = ("datasource_symbol", "period", "from_date", "to_date", "missing", "status", "attempts",
+                    "last_attempt")
+    list_filter = ("datasource_symbol__datasource__name", "period", "status")
+    search_fields = ["datasource_symbol__symbol__name"]
+    actions = [retry_candle_gaps]
@@ -0,0 +1,202 @@
+"""
+Vectorised aggregation of ticks into candles, and of candles into longer candle periods. Used to build candles from
+ticks for periods that a datasource doesn't provide, and to derive candle periods from the candles of a shorter base
+period rather than retrieving them from the datasource.
+"""
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Nanoseconds in each fixed width candle period. Weeks and months are calendar periods.
+period_ns = {'1S': 10**9, '5S': 5 * 10**9, '10S': 10 * 10**9, '15S': 15 * 10**9, '30S': 30 * 10**9,
+             '1M': 60 * 10**9, '5M': 300 * 10**9, '10M': 600 * 10**9, '15M': 900 * 10**9, '30M': 1800 * 10**9,
+             '1H': 3600 * 10**9, '3H': 3 * 3600 * 10**9, '6H': 6 * 3600 * 10**9, '12H': 12 * 3600 * 10**9,
+             '1D': 86400 * 10**9}
+
+# The fields of the candles to aggregate, and how they are aggregated
+first_fields = ['bid_open', 'ask_open']
+max_fields = ['bid_high', 'ask_high']
+min_fields = ['bid_low', 'ask_low']
+last_fields = ['bid_close', 'ask_close']
+sum_fields = ['volume']
+
+
+class CandleAggregator:
+    """
+    Aggregates candles into longer candle periods in a single vectorised pass. Candles are labelled with the time that
+    they open. Weekly candles open on Monday and monthly candles on the first of the month.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    @staticmethod
+    def can_derive(period: str, base_period: str) -> bool:
+        """
+        Returns whether candles for a period can be derived from the candles for a base period. The period must be
+        longer than the base period, and each of its candles must contain a whole number of base candles.
+        :param period:
+        :param base_period:
+        :return:
+        """
+        if base_period not in period_ns or period == base_period:
+            return False
+        elif period in period_ns:
+            return period_ns[period] % period_ns[base_period] == 0
+        else:
+            # Weeks and months start at midnight, so can be derived from any period up to a day
+            return period in ['1W', '1MO']
+
+    @staticmethod
+    def bin_starts(times: np.ndarray, period: str) -> np.ndarray:
+        """
+        Returns the open time of the candle for the period that each time falls into.
+        :param times: int64 nanoseconds since the epoch, UTC.
+        :param period: The candle period
+        :return: int64 nanoseconds since the epoch, UTC.
+        """
+        if period in period_ns:
+            return times - np.mod(times, period_ns[period])
+        elif period == '1W':
+            # The epoch was a Thursday. Weeks start on Monday, 4 days later.
+            offset = 4 * period_ns['1D']
+            return times - np.mod(times - offset, 7 * period_ns['1D'])
+        elif period == '1MO':
+            return times.astype('datetime64[ns]').astype('datetime64[M]').astype('datetime64[ns]').astype(np.int64)
+        else:
+            raise ValueError(f"Candle period {period} cannot be aggregated.")
+
+    @staticmethod
+    def bin_ends(starts: np.ndarray, period: str) -> np.ndarray:
+        """
+        Returns the close time of candles for the period, from their open times.
+        :param starts: int64 nanoseconds since the epoch, UTC.
+        :param period: The candle period
+        :return: int64 nanoseconds since the epoch, UTC.
+        """
+        if period in period_ns:
+            return starts + period_ns[period]
+        elif period == '1W':
+            return starts + 7 * period_ns['1D']
+        elif period == '1MO':
+            months = starts.astype('datetime64[ns]').astype('datetime64[M]') + np.timedelta64(1, 'M')
+            return months.astype('datetime64[ns]').astype(np.int64)
+        else:
+            raise ValueError(f"Candle period {period} cannot be aggregated.")
+
+    @staticmethod
+    def aggregate(times: np.ndarray, opens: np.ndarray, highs: np.ndarray, lows: np.ndarray, closes: np.ndarray,
+                  volumes: np.ndarray, period: str) -> Tuple[np.ndarray, ...]:
+        """
+        Aggregates sorted OHLCV arrays into candles for the period, using numpy reductions over the boundaries of each
+        candle. Opens, highs, lows and closes can be 2 dimensional (e.g. bid and ask as columns) and are aggregated
+        column by column.
+        :param times: Sorted int64 nanoseconds since the epoch, UTC.
+        :param opens:
+        :param highs:
+        :param lows:
+        :param closes:
+        :param volumes:
+        :param period: The candle period to aggregate to
+        :return: Tuple of times, opens, highs, lows, closes and volumes for the aggregated candles. The last candle may
+            be partial.
+        """
+        bins = CandleAggregator.bin_starts(times, period)
+        if len(bins) == 0:
+            return bins, opens[:0], highs[:0], lows[:0], closes[:0], volumes[:0]
+
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(bins)) + 1])
+        ends = np.concatenate([starts[1:], [len(bins)]]) - 1
+
+        return bins[starts], opens[starts], np.maximum.reduceat(highs, starts, axis=0), \
+            np.minimum.reduceat(lows, starts, axis=0), closes[ends], np.add.reduceat(volumes, starts, axis=0)
+
+    @staticmethod
+    def resample(candles: pd.DataFrame, period: str) -> pd.DataFrame:
+        """
+        Resamples candles into a longer period. First bid and ask open, max high, min low, last close and sum of volume.
+        :param candles: Dataframe of candles indexed on time (UTC) with bid and ask OHLC and volume columns.
+        :param period: The candle period to resample to.
+        :return: Dataframe of candles for the period indexed and sorted on time (UTC), with the same columns. The last
+            candle may be partial.
+        """
+        candles = candles.sort_index()
+        times, opens, highs, lows, closes, volumes = CandleAggregator.aggregate(
+            pd.DatetimeIndex(candles.index).asi8, candles[first_fields].to_numpy(dtype=np.float64),
+            candles[max_fields].to_numpy(dtype=np.float64), candles[min_fields].to_numpy(dtype=np.float64),
+            candles[last_fields].to_numpy(dtype=np.float64), candles[sum_fields].to_numpy(dtype=np.float64), period)
+
+        resampled = pd.DataFrame(np.concatenate([opens, highs, lows, closes, volumes], axis=1),
+                                 columns=first_fields + max_fields + min_fields + last_fields + sum_fields,
+                                 index=pd.DatetimeIndex(times, tz='UTC', name='time'))
+
+        return resampled[[column for column in candles.columns if column in resampled.columns]]
+
+
+class TickAggregator:
+    """
+    Aggregates ticks into bid and ask OHLC candles for many candle periods at once. Can be used by any
+    DataSourceImplementation that retrieves ticks for periods that the datasource doesn't provide candles for.
+
+    The ticks are only passed over once, to build the candles for the shortest period. Each longer period is then
+    aggregated from the candles of the longest shorter period that it can be derived from, or from the ticks if there
+    is none.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    # Ordering of the candle periods by length
+    __period_lengths = dict(period_ns, **{'1W': 7 * period_ns['1D'], '1MO': 31 * period_ns['1D']})
+
+    @staticmethod
+    def aggregate(times: np.ndarray, bids: np.ndarray, asks: np.ndarray, periods: List[str],
+                  volumes: np.ndarray = None, complete_to: int = None) -> Dict[str, pd.DataFrame]:
+        """
+        Aggregates ticks into candles.
+        :param times: int64 nanoseconds since the epoch, UTC. Sorted if possible, otherwise they are sorted.
+        :param bids: Bid price for each tick
+        :param asks: Ask price for each tick
+        :param periods: The candle periods to aggregate the ticks to
+        :param volumes: Optional. Volume for each tick. If not provided, volume is the number of ticks.
+        :param complete_to: Optional. int64 nanoseconds since the epoch, UTC. The time up to which all ticks have been
+            provided. Trailing candles that don't close by this time are partial and are not returned, so that they can
+            be built from all their ticks later. If not provided, partial trailing candles are returned.
+        :return: Dict of period to dataframe with columns time (UTC), period, bid_open, bid_high, bid_low, bid_close,
+            ask_open, ask_high, ask_low, ask_close and volume, a row for each period that contains ticks.
+        """
+        times = np.asarray(times, dtype=np.int64)
+        prices = np.column_stack([np.asarray(bids, dtype=np.float64), np.asarray(asks, dtype=np.float64)])
+        volumes = np.ones(len(times)) if volumes is None else np.asarray(volumes, dtype=np.float64)
+
+        if len(times) > 1 and np.any(np.diff(times) < 0):
+            order = np.argsort(times, kind='stable')
+            times, prices, volumes = times[order], prices[order], volumes[order]
+
+        # Shortest period first, each from the longest shorter period already aggregated that it can be derived from
+        candles = {}
+        for period in sorted(set(periods), key=lambda p: TickAggregator.__period_lengths[p]):
+            base = next((p for p in reversed(list(candles.keys())) if CandleAggregator.can_derive(period, p)), None)
+            if base is not None:
+                candles[period] = CandleAggregator.aggregate(*candles[base], period)
+            else:
+                candles[period] = CandleAggregator.aggregate(times, prices, prices, prices, prices, volumes, period)
+
+        frames = {}
+        for period in periods:
+            starts, opens, highs, lows, closes, period_volumes = candles[period]
+            if complete_to is not None:
+                complete = CandleAggregator.bin_ends(starts, period) <= complete_to
+                starts, opens, highs, lows, closes, period_volumes = \
+                    starts[complete], opens[complete], highs[complete], lows[complete], closes[complete], \
+                    period_volumes[complete]
+
+            frames[period] = pd.DataFrame({'time': pd.DatetimeIndex(starts, tz='UTC'), 'period': period,
+                                           'bid_open': opens[:, 0], 'bid_high': highs[:, 0], 'bid_low': lows[:, 0],
+                                           'bid_close': closes[:, 0], 'ask_open': opens[:, 1],
+                                           'ask_high': highs[:, 1], 'ask_low': lows[:, 1], 'ask_close': closes[:, 1],
+                                           'volume': period_volumes})
+
+        return frames
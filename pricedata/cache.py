@@ -0,0 +1,237 @@
+"""
+A cache of recent candles for each datasource symbol and candle period, held in each worker process so that features
+calculated over the same symbol don't each read the same candles from the database.
+"""
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+
+from pricedata import models as pd_models
+
+# The candle fields held in the cache
+candle_fields = ['bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high', 'ask_low', 'ask_close',
+                 'volume']
+
+
+class CandleWindowCache:
+    """
+    Holds the most recent candles for each datasource symbol and candle period as numpy arrays. Each read first
+    extends the cached windows with the candles that have arrived since they were last read, in a single query for all
+    the windows being read. The last cached candle is read again, so updates to an incomplete candle are picked up.
+    Windows that don't go back far enough are read again from the requested date. The least recently used windows are
+    evicted.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    # Cached windows. (datasource symbol id, period) to dict of times (int64 ns, UTC, sorted), values (float64, a column
+    # for each candle field) and start (the time in int64 ns from which the window is complete). Most recently used
+    # last.
+    __windows = OrderedDict()
+
+    # Lock for the windows
+    __lock = threading.Lock()
+
+    # The earliest time. Used as the start of windows that contain all candles.
+    __min_time = np.iinfo(np.int64).min
+
+    # The version of the cached windows. Changed in the ALGOBUILDER_INVALIDATION_CACHE by invalidate, so that all
+    # processes discard their cached windows.
+    __version = None
+    __version_key = 'candle_window_cache_version'
+
+    @staticmethod
+    def get(datasource_symbol_id: int, period: str, from_date: datetime = None,
+            to_date: datetime = None) -> pd.DataFrame:
+        """
+        Gets the candles for a datasource symbol and period.
+        :param datasource_symbol_id:
+        :param period:
+        :param from_date: Optional. Only candles from this time.
+        :param to_date: Optional. Only candles before this time.
+        :return: Dataframe indexed and sorted on time (UTC) with a float column for each candle field.
+        """
+        return CandleWindowCache.get_many([(datasource_symbol_id, period, from_date)], to_date)[
+            (datasource_symbol_id, period)]
+
+    @staticmethod
+    def get_many(requests: List[Tuple[int, str, datetime]],
+                 to_date: datetime = None) -> Dict[Tuple[int, str], pd.DataFrame]:
+        """
+        Gets the candles for many datasource symbols and periods, using at most three queries, a read of the version of the
+        cached windows from the invalidation cache, one to extend the cached windows and one to read those that aren't
+        cached or don't go back far enough.
+        :param requests: List of (datasource symbol id, period, from date). From date can be None for all candles.
+        :param to_date: Optional. Only candles before this time.
+        :return: Dict of (datasource symbol id, period) to dataframe indexed and sorted on time (UTC) with a float
+            column for each candle field. If a datasource symbol and period is requested more than once, the candles are
+            from the earliest of its from dates.
+        """
+        from pricedata.shared import SharedCandleStore  # Imported when needed, due to circular dependency
+
+        # The earliest from date requested for each window
+        starts = {}
+        for dss_id, period, from_date in requests:
+            start = CandleWindowCache.__to_ns(from_date)
+            starts[(dss_id, period)] = min(start, starts.get((dss_id, period), start))
+        to_ns = None if to_date is None else CandleWindowCache.__to_ns(to_date)
+
+        # Windows held in full in shared memory by price retrieval on this host aren't read from the database
+        shared = {}
+        if SharedCandleStore.enabled():
+            for key, start in starts.items():
+                window = SharedCandleStore.get(*key, start, to_ns)
+                if window is not None:
+                    shared[key] = pd.DataFrame(window[1], columns=candle_fields,
+                                               index=pd.DatetimeIndex(window[0], tz='UTC', name='time'))
+            starts = {key: start for key, start in starts.items() if key not in shared}
+
+        # Discard the cached windows if they have been invalidated by another process. Not read if all windows were
+        # served from shared memory, as reading the invalidation cache may be a query.
+        version = caches[settings.ALGOBUILDER_INVALIDATION_CACHE].get(CandleWindowCache.__version_key) \
+            if len(starts) > 0 else CandleWindowCache.__version
+        with CandleWindowCache.__lock:
+            if version != CandleWindowCache.__version:
+                CandleWindowCache.__windows.clear()
+                CandleWindowCache.__version = version
+            windows = {key: CandleWindowCache.__windows.get(key) for key in starts.keys()}
+
+        # Extend the cached windows
+        extend = {key: window for key, window in windows.items() if window is not None}
+        if len(extend) > 0:
+            query = Q()
+            for (dss_id, period), window in extend.items():
+                condition = Q(datasource_symbol_id=dss_id, period=period)
+                if len(window['times']) > 0 or window['start'] != CandleWindowCache.__min_time:
+                    condition &= Q(time__gte=CandleWindowCache.__to_datetime(
+                        window['times'][-1] if len(window['times']) > 0 else window['start']))
+                query |= condition
+
+            new_candles = CandleWindowCache.__read(query)
+            for key, window in extend.items():
+                times, values = new_candles.get(key, (np.empty(0, dtype=np.int64),
+                                                      np.empty((0, len(candle_fields)))))
+                keep = window['times'] < times[0] if len(times) > 0 else slice(None)
+                windows[key] = {'times': np.concatenate([window['times'][keep], times]),
+                                'values': np.concatenate([window['values'][keep], values]),
+                                'start': window['start']}
+
+        # Read the windows that aren't cached or don't go back far enough
+        read = [key for key, window in windows.items() if window is None or starts[key] < window['start']]
+        if len(read) > 0:
+            query = Q()
+            for dss_id, period in read:
+                condition = Q(datasource_symbol_id=dss_id, period=period)
+                if starts[(dss_id, period)] != CandleWindowCache.__min_time:
+                    condition &= Q(time__gte=CandleWindowCache.__to_datetime(starts[(dss_id, period)]))
+                query |= condition
+
+            CandleWindowCache.__log.debug(f"Reading candles for {len(read)} datasource symbol periods.")
+            candles = CandleWindowCache.__read(query)
+            for key in read:
+                times, values = candles.get(key, (np.empty(0, dtype=np.int64), np.empty((0, len(candle_fields)))))
+                windows[key] = {'times': times, 'values': values, 'start': starts[key]}
+
+        # Slice before caching, as caching may trim the windows, then cache
+        frames = {key: CandleWindowCache.__slice(window, starts[key], to_ns) for key, window in windows.items()}
+        CandleWindowCache.__cache(windows)
+
+        return {**frames, **shared}
+
+    @staticmethod
+    def clear():
+        """
+        Removes all cached windows in this process. Required when candles other than the most recent are changed or
+        deleted.
+        """
+        with CandleWindowCache.__lock:
+            CandleWindowCache.__windows.clear()
+
+    @staticmethod
+    def invalidate():
+        """
+        Removes all cached windows in all processes, the next time that each reads from the cache. Required when
+        candles other than the most recent are changed by another process, e.g. when gaps are repaired.
+        """
+        caches[settings.ALGOBUILDER_INVALIDATION_CACHE].set(CandleWindowCache.__version_key, uuid.uuid4().hex, timeout=None)
+        CandleWindowCache.clear()
+
+    @staticmethod
+    def __read(query: Q) -> Dict[Tuple[int, str], Tuple[np.ndarray, np.ndarray]]:
+        """
+        Reads the candles matching the query.
+        :return: Dict of (datasource symbol id, period) to tuple of sorted times (int64 ns) and values.
+        """
+        candles = pd.DataFrame.from_records(
+            pd_models.Candle.objects.filter(query).order_by('time').
+            values_list('datasource_symbol_id', 'period', 'time', *candle_fields),
+            columns=['datasource_symbol_id', 'period', 'time'] + candle_fields)
+
+        windows = {}
+        if len(candles.index) > 0:
+            candles['time'] = pd.to_datetime(candles['time'], utc=True)
+            for key, group in candles.groupby(['datasource_symbol_id', 'period']):
+                windows[key] = (pd.DatetimeIndex(group['time']).asi8,
+                                group[candle_fields].to_numpy(dtype=np.float64))
+
+        return windows
+
+    @staticmethod
+    def __cache(windows: Dict[Tuple[int, str], Dict]):
+        """
+        Caches the windows, trimmed to the maximum number of candles, evicting the least recently used windows if
+        there are too many.
+        """
+        max_rows = settings.ALGOBUILDER_CANDLE_CACHE_ROWS
+        with CandleWindowCache.__lock:
+            for key, window in windows.items():
+                if len(window['times']) > max_rows:
+                    window = {'times': window['times'][-max_rows:], 'values': window['values'][-max_rows:],
+                              'start': window['times'][-max_rows]}
+                CandleWindowCache.__windows[key] = window
+                CandleWindowCache.__windows.move_to_end(key)
+
+            while len(CandleWindowCache.__windows) > settings.ALGOBUILDER_CANDLE_CACHE_SYMBOLS:
+                CandleWindowCache.__windows.popitem(last=False)
+
+    @staticmethod
+    def __slice(window: Dict, from_ns: int, to_ns: int) -> pd.DataFrame:
+        """
+        Slices a window from the from time up to the to time, as a dataframe.
+        """
+        first = np.searchsorted(window['times'], from_ns, side='left')
+        last = len(window['times']) if to_ns is None else np.searchsorted(window['times'], to_ns, side='left')
+
+        return pd.DataFrame(window['values'][first:last], columns=candle_fields,
+                            index=pd.DatetimeIndex(window['times'][first:last], tz='UTC', name='time'))
+
+    @staticmethod
+    def __to_ns(date: datetime) -> int:
+        """
+        Converts a datetime to int64 ns UTC. None is the earliest time.
+        """
+        if date is None:
+            return CandleWindowCache.__min_time
+
+        timestamp = pd.Timestamp(date)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize('UTC')
+
+        return timestamp.value
+
+    @staticmethod
+    def __to_datetime(ns: int) -> datetime:
+        """
+        Converts int64 ns UTC to a datetime.
+        """
+        return pd.Timestamp(ns, tz='UTC').to_pydatetime()
@@ -3,10 +3,17 @@ The DataSourceImplementation interface. Subclasses will be used to connect to pr
 """
 
 import abc
+import asyncio
 import logging
+import threading
+import time
+import numpy as np
 import pandas as pd
-from datetime import datetime
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, List, Dict
+
+from django.conf import settings
 
 from pricedata import models
 
@@ -75,6 +82,16 @@ class DataSourceImplementation:
     _prices_columns = ['time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high',
                        'ask_low', 'ask_close', 'volume']
 
+    # The get_ticks implementation should return a pandas dataframe with the following columns
+    _ticks_columns = ['time', 'bid', 'ask']
+
+    # Pooled instances in this process. Datasource name to dict of the time that the datasource was last updated, the
+    # instance and the time that its health was last checked.
+    __pool = {}
+
+    # Lock for the pool
+    __pool_lock = threading.Lock()
+
     def __init__(self, datasource: models.DataSource) -> None:
         """
         Construct the datasource implementation and stores its model
@@ -86,23 +103,94 @@ class DataSourceImplementation:
     @staticmethod
     def instance(name: str):
         """
-        Get the DataSource instance specified by the name.
+        Get the DataSource instance specified by the name. Instances are pooled in each worker process and reused
+        until their DataSource is changed or they fail a health check, so that connections to the datasource are only
+        set up when required. Changes are detected from the time that the DataSource was last updated, read from the
+        database, so changes made in any process are picked up by all of them.
         :param name:
         :return:
         """
+        with DataSourceImplementation.__pool_lock:
+            entry = DataSourceImplementation.__pool.get(name)
+
+        if entry is not None:
+            # Discard if the datasource has changed or been deleted
+            updated = models.DataSource.objects.filter(name=name).values_list('updated', flat=True).first()
+            if updated is None or updated != entry['updated']:
+                DataSourceImplementation.__log.debug(f"Datasource {name} has changed. Creating a new instance.")
+                DataSourceImplementation.__discard(name, entry)
+                entry = None
+
+        if entry is not None and \
+                time.monotonic() - entry['checked'] > settings.ALGOBUILDER_PRICEDATA_DATASOURCE_HEALTH_CHECK_SECONDS:
+            # Discard if it is no longer healthy. A new instance is created and connected below.
+            if entry['instance'].check_health():
+                entry['checked'] = time.monotonic()
+            else:
+                DataSourceImplementation.__log.warning(f"Datasource {name} failed health check. Reconnecting.")
+                DataSourceImplementation.__discard(name, entry)
+                entry = None
+
+        if entry is None:
+            datasources = models.DataSource.objects.filter(name=name)
+
+            if len(datasources) != 0:
+                ds = datasources[0]
+
+                # Get plugin class
+                clazz = ds.pluginclass.plugin_class
+            else:
+                raise DataSourceInstanceNotImplementedError(f'DataSourceImplementation instance cannot be created for '
+                                                            f'datasource {name}. Datasource could not be found.')
+
+            entry = {'updated': ds.updated, 'instance': clazz(ds), 'checked': time.monotonic()}
+
+            with DataSourceImplementation.__pool_lock:
+                DataSourceImplementation.__pool[name] = entry
+
+        return entry['instance']
 
-        datasources = models.DataSource.objects.filter(name=name)
+    @staticmethod
+    def clear():
+        """
+        Shuts down and removes all pooled instances in this process.
+        :return:
+        """
+        with DataSourceImplementation.__pool_lock:
+            entries = list(DataSourceImplementation.__pool.items())
 
-        if len(datasources) != 0:
-            ds = datasources[0]
+        for name, entry in entries:
+            DataSourceImplementation.__discard(name, entry)
 
-            # Get plugin class
-            clazz = ds.pluginclass.plugin_class
-        else:
-            raise DataSourceInstanceNotImplementedError(f'DataSourceImplementation instance cannot be created for '
-                                                        f'datasource {name}. Datasource could not be found.')
+    @staticmethod
+    def __discard(name: str, entry: Dict):
+        """
+        Removes a pooled instance and shuts it down.
+        """
+        with DataSourceImplementation.__pool_lock:
+            if DataSourceImplementation.__pool.get(name) is entry:
+                del DataSourceImplementation.__pool[name]
 
-        return clazz(ds)
+        try:
+            entry['instance'].shutdown()
+        except Exception as ex:
+            DataSourceImplementation.__log.warning(f"Error shutting down datasource {name}. {ex}")
+
+    def check_health(self) -> bool:
+        """
+        Returns whether the connection to the datasource is healthy. Called periodically on pooled instances. Unhealthy
+        instances are shut down and a new instance created. Override for datasources that hold a connection.
+        :return:
+        """
+        return True
+
+    def shutdown(self):
+        """
+        Releases any connection to the datasource. Called when a pooled instance is discarded. Override for datasources
+        that hold a connection.
+        :return:
+        """
+        pass
 
     @staticmethod
     def all_instances():
@@ -114,7 +202,7 @@ class DataSourceImplementation:
 
         all_datasource_implementations = []
         for datasource_model in all_datasource_models:
-            all_datasource_implementations.append(DataSourceImplementation.instance(datasource_model))
+            all_datasource_implementations.append(DataSourceImplementation.instance(datasource_model.name))
 
         return all_datasource_implementations
 
@@ -144,3 +232,194 @@ class DataSourceImplementation:
             'ask_open', 'ask_high', 'ask_low', 'ask_close', 'volume']
         """
         raise NotImplementedError
+
+    def get_prices_bulk(self, symbols: List[str], from_dates: Dict[str, datetime], to_date: datetime, period: str,
+                        symbol_info: Dict[str, Dict[str, any]] = None) -> pd.DataFrame:
+        """
+        Gets OHLC price data for many symbols. Override for datasources that can retrieve prices for many symbols in a
+        single request. The default implementation calls get_prices for each symbol.
+        :param symbols: The names of the symbols to get the price data for.
+        :param from_dates: Dict of symbol name to the date from when to retrieve its data
+        :param to_date: Date to receive data up to
+        :param period: The period for the candes. Possible values are defined in models.candle_periods.
+        :param symbol_info: A dict of symbol name to a dict of any additional info for the symbol required by
+            implementation.
+
+        :return: Price data for all symbols as a pandas dataframe containing the following columns:
+            ['symbol', 'time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close',
+            'ask_open', 'ask_high', 'ask_low', 'ask_close', 'volume']. Symbols that data isn't available for are
+            logged and not included.
+        """
+        frames = []
+        for symbol in symbols:
+            try:
+                prices = self.get_prices(symbol, from_dates[symbol], to_date, period, (symbol_info or {}).get(symbol))
+                frames.append(prices.assign(symbol=symbol))
+            except DataNotAvailableException as ex:
+                self.__log.warning(ex)
+
+        return self._concat_prices(frames)
+
+    def _concat_prices(self, frames: List[pd.DataFrame]) -> pd.DataFrame:
+        """
+        Concatenates the price data for many symbols into the dataframe returned by get_prices_bulk.
+        :param frames: Price data for each symbol, with the symbol column.
+        :return:
+        """
+        columns = ['symbol'] + self._prices_columns
+        frames = [frame for frame in frames if len(frame.index) > 0]
+        return pd.concat(frames, ignore_index=True)[columns] if len(frames) > 0 else pd.DataFrame(columns=columns)
+
+    def get_ticks(self, symbol: str, from_date: datetime, to_date: datetime,
+                  symbol_info: Dict[str, any] = None) -> pd.DataFrame:
+        """
+        Gets ticks for the specified symbol. Optional. Only required for datasources whose candle periods are built
+        from ticks.
+        :param symbol: The name of the symbol to get the ticks for.
+        :param from_date: Date from when to retrieve ticks
+        :param to_date: Date to retrieve ticks up to
+        :param symbol_info: A dict of any additional info for symbol required by implementation.
+
+        :return: Ticks for symbol as pandas dataframe containing the following columns:
+            ['time', 'bid', 'ask']. Time must be UTC.
+        """
+        raise NotImplementedError
+
+    def _fetch_batched(self, fetch: Callable[[datetime, datetime], np.ndarray], from_date: datetime, to_date: datetime,
+                       window: timedelta, max_workers: int = None, target_rows: int = None) -> np.ndarray:
+        """
+        Fetches data for a date range from the datasource in windows, for datasources that limit how much data can be
+        requested at once. Windows are requested concurrently in rounds of up to max_workers, on a thread pool so that
+        blocking client libraries can be used. After each round, the window size is adapted to the rows per window
+        observed, so that each window returns around target_rows rows. The arrays returned for each window are
+        concatenated once, in window order.
+
+        :param fetch: Function to fetch the data for a window. Called with the window from and to dates, both
+            inclusive. Returns a numpy array, usually a record array, or raises an exception if the data isn't
+            available.
+        :param from_date: Date to fetch data from
+        :param to_date: Date to fetch data up to
+        :param window: The size of the first windows
+        :param max_workers: Optional. The maximum number of windows to fetch concurrently. Use 1 for client libraries
+            that aren't thread safe. Default from settings.
+        :param target_rows: Optional. The number of rows to aim for in each window. Default from settings.
+        :return: The data for all windows, or None if the date range is empty. Windows overlap at their boundaries by
+            less than 1ms, so data at the boundaries may be duplicated.
+        """
+        max_workers = max_workers or settings.ALGOBUILDER_PRICEDATA_FETCH_WORKERS
+        target_rows = target_rows or settings.ALGOBUILDER_PRICEDATA_FETCH_TARGET_ROWS
+
+        arrays = []
+        window_from = from_date
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while window_from < to_date:
+                # The windows for this round. Each starts 1ms after the last ends.
+                windows = []
+                while window_from < to_date and len(windows) < max_workers:
+                    window_to = min(window_from + window, to_date)
+                    windows.append((window_from, window_to))
+                    window_from = window_to + timedelta(milliseconds=1)
+
+                round_arrays = list(executor.map(lambda w: fetch(w[0], w[1]), windows))
+                arrays += round_arrays
+
+                # Adapt the window size to the rows per window observed, by at most a factor of 4 each round
+                rows = sum(len(array) for array in round_arrays)
+                duration = sum((end - start for start, end in windows), timedelta())
+                target = window * 4 if rows == 0 else duration * target_rows / rows
+                window = max(min(target, window * 4), window / 4, timedelta(seconds=1))
+                self.__log.debug(f"Fetched {rows} rows in {len(windows)} windows. Next window size {window}.")
+
+        return np.concatenate(arrays) if len(arrays) > 0 else None
+
+
+class AsyncDataSourceImplementation(DataSourceImplementation):
+    """
+    The interface for asynchronous datasources, for I/O bound datasources such as HTTP or websocket APIs. The price data
+    for all symbols is retrieved concurrently on a single event loop by get_prices_bulk, so one worker process can
+    retrieve prices for hundreds of symbols without waiting for each in turn.
+
+    A new event loop is used for each run, so any connections or sessions bound to the event loop should be created in
+    open and released in close.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    async def open(self):
+        """
+        Called on the event loop before any data is retrieved. Override to create connections or sessions.
+        :return:
+        """
+        pass
+
+    async def close(self):
+        """
+        Called on the event loop after all data has been retrieved. Override to release connections or sessions.
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    async def get_symbols(self) -> List[Dict[str, any]]:
+        """
+        Get symbols from datasource
+
+        :return: list of dictionaries containing symbol_name and instrument_type at a minimum. Dict can also include any
+        other broker specific symbol information required by the implemented datasource.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_prices(self, symbol: str, from_date: datetime, to_date: datetime, period: str,
+                         symbol_info: Dict[str, any] = None) -> pd.DataFrame:
+        """
+        Gets OHLC price data for the specified symbol.
+        :param symbol: The name of the symbol to get the price data for.
+        :param from_date: Date from when to retrieve data
+        :param to_date: Date to receive data up to
+        :param period: The period for the candes. Possible values are defined in models.candle_periods.
+        :param symbol_info: A dict of any additional info for symbol required by implementation.
+
+        :return: Price data for symbol as pandas dataframe containing the following columns:
+            ['time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close',
+            'ask_open', 'ask_high', 'ask_low', 'ask_close', 'volume']
+        """
+        raise NotImplementedError
+
+    async def get_prices_bulk(self, symbols: List[str], from_dates: Dict[str, datetime], to_date: datetime,
+                              period: str, symbol_info: Dict[str, Dict[str, any]] = None) -> pd.DataFrame:
+        """
+        Gets OHLC price data for many symbols. Override for datasources that can retrieve prices for many symbols in a
+        single request. The default implementation calls get_prices for the symbols concurrently, up to
+        ALGOBUILDER_PRICEDATA_ASYNC_CONCURRENCY at a time.
+        :param symbols: The names of the symbols to get the price data for.
+        :param from_dates: Dict of symbol name to the date from when to retrieve its data
+        :param to_date: Date to receive data up to
+        :param period: The period for the candes. Possible values are defined in models.candle_periods.
+        :param symbol_info: A dict of symbol name to a dict of any additional info for the symbol required by
+            implementation.
+
+        :return: Price data for all symbols as a pandas dataframe containing the following columns:
+            ['symbol', 'time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close',
+            'ask_open', 'ask_high', 'ask_low', 'ask_close', 'volume']. Symbols that data isn't available for are
+            logged and not included.
+        """
+        semaphore = asyncio.Semaphore(settings.ALGOBUILDER_PRICEDATA_ASYNC_CONCURRENCY)
+
+        async def get_prices(symbol):
+            async with semaphore:
+                prices = await self.get_prices(symbol, from_dates[symbol], to_date, period,
+                                               (symbol_info or {}).get(symbol))
+                return prices.assign(symbol=symbol)
+
+        frames = []
+        for result in await asyncio.gather(*[get_prices(symbol) for symbol in symbols], return_exceptions=True):
+            if isinstance(result, DataNotAvailableException):
+                self.__log.warning(result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                frames.append(result)
+
+        return self._concat_prices(frames)
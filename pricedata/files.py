@@ -0,0 +1,249 @@
+"""
+A cache of candles in memory mapped files on local disk, for notebooks and research that read large ranges of candles
+repeatedly. Candles are read from the database once, then only the ranges not already in the files are read.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from pricedata import models
+from pricedata.aggregation import CandleAggregator
+from pricedata.cache import candle_fields
+
+
+class CandleFileCache:
+    """
+    Holds the candles for each datasource symbol and candle period in a directory of numpy files, a file of candle
+    times (int64 ns, UTC, sorted) and a file of candle values (float64, a column for each candle field), with an index
+    of the time ranges that the files hold all candles for. The files are opened memory mapped, so only the pages read
+    are loaded and the candles returned aren't copied.
+
+    Each time candles are read, the ranges that aren't in the index are read from the database and the files are
+    rewritten with them. Ranges are only added to the index up to the current candle, so the current candle is read
+    from the database until it is complete. The files are written under new names and the index then replaced, so
+    other processes reading the files aren't affected.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    # Lock for reading and writing the files in this process
+    __lock = threading.Lock()
+
+    # The name of the index file
+    __index_file = 'index.json'
+
+    # The number of times that the files are opened again if they are replaced by another process while being opened
+    __open_retries = 3
+
+    @staticmethod
+    def get(datasource: str, symbol: str, period: str, from_date: datetime, to_date: datetime = None) -> pd.DataFrame:
+        """
+        Gets the candles for a symbol from a datasource, by name.
+        :param datasource: The datasource name
+        :param symbol: The symbol name
+        :param period: The candle period
+        :param from_date: Candles from this time
+        :param to_date: Optional. Candles before this time. If not provided, now.
+        :return: Dataframe indexed and sorted on time (UTC) with a float column for each candle field. The values are
+            memory mapped copy on write, so changes to them aren't written to the files.
+        """
+        dss = models.DataSourceSymbol.objects.get(datasource__name=datasource, symbol__name=symbol)
+        times, values = CandleFileCache.load(dss.id, period, from_date, to_date)
+
+        return pd.DataFrame(values, columns=candle_fields, index=pd.DatetimeIndex(times, tz='UTC', name='time'),
+                            copy=False)
+
+    @staticmethod
+    def load(datasource_symbol_id: int, period: str, from_date: datetime,
+             to_date: datetime = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gets the candles for a datasource symbol and period, reading the ranges not already in the files from the
+        database.
+        :param datasource_symbol_id:
+        :param period:
+        :param from_date: Candles from this time
+        :param to_date: Optional. Candles before this time. If not provided, now.
+        :return: Tuple of sorted times (int64 ns UTC) and values (float64, a column for each candle field), memory
+            mapped from the files.
+        """
+        now = timezone.now()
+        from_ns = pd.Timestamp(from_date).value
+        to_ns = pd.Timestamp(now if to_date is None else to_date).value
+        directory = CandleFileCache.__directory(datasource_symbol_id, period)
+
+        with CandleFileCache.__lock:
+            index = CandleFileCache.__read_index(directory)
+            missing = CandleFileCache.__subtract([(from_ns, to_ns)], index['ranges'])
+            if len(missing) > 0:
+                current_ns = int(CandleAggregator.bin_starts(np.array([pd.Timestamp(now).value]), period)[0])
+                index = CandleFileCache.__extend(datasource_symbol_id, period, directory, index, missing, current_ns)
+
+            times, values = CandleFileCache.__open(directory, index)
+
+        first, last = np.searchsorted(times, [from_ns, to_ns], side='left')
+        return times[first:last], values[first:last]
+
+    @staticmethod
+    def ranges(datasource_symbol_id: int, period: str) -> List[Tuple[datetime, datetime]]:
+        """
+        The time ranges that the files hold all candles for.
+        :param datasource_symbol_id:
+        :param period:
+        :return: List of sorted tuples of from time and to time (not including)
+        """
+        index = CandleFileCache.__read_index(CandleFileCache.__directory(datasource_symbol_id, period))
+        return [(pd.Timestamp(range_from, tz='UTC').to_pydatetime(), pd.Timestamp(range_to, tz='UTC').to_pydatetime())
+                for range_from, range_to in index['ranges']]
+
+    @staticmethod
+    def clear(datasource_symbol_id: int = None, period: str = None):
+        """
+        Removes the files for a datasource symbol and period, or for all if not provided. Required when candles already
+        in the files are changed in the database, e.g. when gaps are repaired.
+        """
+        directory = os.path.join(settings.ALGOBUILDER_CANDLE_FILE_DIR, settings.DATABASES['default']['NAME'])
+        if datasource_symbol_id is not None:
+            directory = CandleFileCache.__directory(datasource_symbol_id, period)
+
+        with CandleFileCache.__lock:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def __extend(datasource_symbol_id: int, period: str, directory: str, index: dict, missing: List[Tuple[int, int]],
+                 current_ns: int) -> dict:
+        """
+        Reads the missing ranges from the database, writes the files with them and returns the new index.
+        """
+        query = Q()
+        for range_from, range_to in missing:
+            query |= Q(time__gte=pd.Timestamp(range_from, tz='UTC').to_pydatetime(),
+                       time__lt=pd.Timestamp(range_to, tz='UTC').to_pydatetime())
+        candles = pd.DataFrame.from_records(
+            models.Candle.objects.filter(query, datasource_symbol_id=datasource_symbol_id, period=period).
+            order_by('time').values_list('time', *candle_fields), columns=['time'] + candle_fields)
+        new_times = pd.DatetimeIndex(pd.to_datetime(candles['time'], utc=True)).asi8
+        new_values = candles[candle_fields].to_numpy(dtype=np.float64).reshape(-1, len(candle_fields))
+        CandleFileCache.__log.debug(f"Read {len(new_times)} candles in {len(missing)} ranges for datasource symbol "
+                                    f"{datasource_symbol_id} {period}.")
+
+        # Merge with the candles in the files, replacing those read again
+        times, values = CandleFileCache.__open(directory, index)
+        kept = ~np.isin(times, new_times)
+        times = np.concatenate([times[kept], new_times])
+        values = np.concatenate([values[kept], new_values])
+        order = np.argsort(times, kind='stable')
+
+        # Write the files under a new name, then replace the index, then remove the old files
+        os.makedirs(directory, exist_ok=True)
+        name = uuid.uuid4().hex
+        np.save(os.path.join(directory, f'{name}.times.npy'), times[order])
+        np.save(os.path.join(directory, f'{name}.values.npy'), values[order])
+        complete = [(range_from, min(range_to, current_ns)) for range_from, range_to in missing
+                    if range_from < min(range_to, current_ns)]
+        new_index = {'name': name, 'ranges': CandleFileCache.__union(index['ranges'] + complete)}
+        index_path = os.path.join(directory, CandleFileCache.__index_file)
+        with open(f'{index_path}.{name}', 'w') as file:
+            json.dump(new_index, file)
+        os.replace(f'{index_path}.{name}', index_path)
+        if index['name'] is not None:
+            for suffix in ['times', 'values']:
+                try:
+                    os.remove(os.path.join(directory, f"{index['name']}.{suffix}.npy"))
+                except FileNotFoundError:
+                    pass
+
+        return new_index
+
+    @staticmethod
+    def __open(directory: str, index: dict) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Opens the files in an index memory mapped. If they have been replaced by another process, opens the files in
+        the new index.
+        """
+        for _ in range(0, CandleFileCache.__open_retries):
+            if index['name'] is None:
+                return np.empty(0, dtype=np.int64), np.empty((0, len(candle_fields)), dtype=np.float64)
+
+            try:
+                times = CandleFileCache.__load(os.path.join(directory, f"{index['name']}.times.npy"))
+                values = CandleFileCache.__load(os.path.join(directory, f"{index['name']}.values.npy"))
+                return times, values
+            except FileNotFoundError:
+                index = CandleFileCache.__read_index(directory)
+
+        raise FileNotFoundError(f"Candle files in {directory} replaced while being opened.")
+
+    @staticmethod
+    def __load(path: str) -> np.ndarray:
+        """
+        Loads a numpy file memory mapped copy on write. Empty files can't be memory mapped, so are loaded.
+        """
+        try:
+            return np.load(path, mmap_mode='c')
+        except ValueError:
+            return np.load(path)
+
+    @staticmethod
+    def __read_index(directory: str) -> dict:
+        """
+        Reads the index of the files in a directory. The name of the current files and the ranges that they hold all
+        candles for, as sorted lists of int64 ns from and to times.
+        """
+        try:
+            with open(os.path.join(directory, CandleFileCache.__index_file), 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'name': None, 'ranges': []}
+
+    @staticmethod
+    def __directory(datasource_symbol_id: int, period: str) -> str:
+        """
+        The directory of the files for a datasource symbol and period. Includes the database name, so that applications
+        using different databases don't share files.
+        """
+        return os.path.join(settings.ALGOBUILDER_CANDLE_FILE_DIR, settings.DATABASES['default']['NAME'],
+                            f'{datasource_symbol_id}_{period}')
+
+    @staticmethod
+    def __union(ranges: List) -> List[List[int]]:
+        """
+        Merges overlapping and adjacent ranges.
+        """
+        union = []
+        for range_from, range_to in sorted([list(candle_range) for candle_range in ranges]):
+            if len(union) > 0 and range_from <= union[-1][1]:
+                union[-1][1] = max(union[-1][1], range_to)
+            else:
+                union.append([range_from, range_to])
+
+        return union
+
+    @staticmethod
+    def __subtract(ranges: List, remove: List) -> List[Tuple[int, int]]:
+        """
+        The parts of the ranges that aren't in the sorted, non overlapping ranges to remove.
+        """
+        result = []
+        for range_from, range_to in ranges:
+            for remove_from, remove_to in remove:
+                if remove_to <= range_from or remove_from >= range_to:
+                    continue
+                if remove_from > range_from:
+                    result.append((range_from, remove_from))
+                range_from = max(range_from, remove_to)
+            if range_from < range_to:
+                result.append((range_from, range_to))
+
+        return result
@@ -0,0 +1,142 @@
+"""
+Detection of gaps in the candles retrieved from datasources. Candles are only retrieved forward from the last candle, so
+any candles missed, e.g. during a datasource outage, are found here so that they can be retrieved again.
+"""
+import logging
+from datetime import datetime
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.models import Max
+
+from pricedata import models
+from pricedata.aggregation import period_ns
+from pricedata.sessions import TradingCalendar
+
+
+class GapDetector:
+    """
+    Finds the candles missing for each datasource symbol and candle period, by comparing the time between each candle
+    and the next with the candle period. Candles are only expected if the market is open during them, from the trading
+    sessions of the symbol. Gaps are found from the periods that the market is open between candles, so the time of
+    each missing candle is never enumerated.
+
+    Candles shorter than ALGOBUILDER_PRICEDATA_GAP_MIN_PERIOD aren't checked, as datasources usually build them from
+    ticks, so periods without ticks have no candles and aren't gaps.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    @staticmethod
+    def detect(ds_pc: models.DataSourceCandlePeriod, from_date: datetime = None) -> int:
+        """
+        Finds the gaps in the candles for all symbols of a datasource candle period and records them as CandleGaps.
+        Gaps already recorded are not recorded again. Only periods with a fixed length, no shorter than
+        ALGOBUILDER_PRICEDATA_GAP_MIN_PERIOD, are checked.
+        :param ds_pc: The datasource candle period to find gaps for
+        :param from_date: Optional. Only find gaps from this time. If not provided, gaps are found from the first
+            candle.
+        :return: The number of gaps found
+        """
+        if not GapDetector.checked(ds_pc.period):
+            return 0
+
+        candles = models.Candle.objects.filter(datasource_symbol__datasource=ds_pc.datasource, period=ds_pc.period)
+        if from_date is not None:
+            candles = candles.filter(time__gte=from_date)
+        times = pd.DataFrame.from_records(candles.order_by('datasource_symbol_id', 'time').
+                                          values_list('datasource_symbol_id', 'time'),
+                                          columns=['datasource_symbol_id', 'time'])
+
+        # The last candle before the from date for each symbol, so that gaps spanning the from date are found. If there
+        # isn't one, gaps are found from the first candle. Candles before it may not be available from the datasource.
+        previous = {} if from_date is None else dict(
+            models.Candle.objects.filter(datasource_symbol__datasource=ds_pc.datasource, period=ds_pc.period,
+                                         time__lt=from_date).
+            values('datasource_symbol_id').annotate(last_time=Max('time')).
+            values_list('datasource_symbol_id', 'last_time'))
+        datasource_symbols = {dss.id: dss for dss in models.DataSourceSymbol.objects.filter(
+            id__in=times['datasource_symbol_id'].unique().tolist()).select_related('symbol')}
+        sessions = TradingCalendar.sessions({dss.symbol for dss in datasource_symbols.values()})
+
+        gaps = []
+        if len(times.index) > 0:
+            times['time'] = pd.to_datetime(times['time'], utc=True)
+            for dss_id, symbol_times in times.groupby('datasource_symbol_id'):
+                symbol_ns = pd.DatetimeIndex(symbol_times['time']).asi8
+                if dss_id in previous:
+                    symbol_ns = np.concatenate([[pd.Timestamp(previous[dss_id]).value], symbol_ns])
+                for gap_from, gap_to, missing in GapDetector.find(symbol_ns, ds_pc.period,
+                                                                  sessions[datasource_symbols[dss_id].symbol_id]):
+                    gaps.append(models.CandleGap(datasource_symbol_id=dss_id, period=ds_pc.period,
+                                                 from_date=pd.Timestamp(gap_from, tz='UTC').to_pydatetime(),
+                                                 to_date=pd.Timestamp(gap_to, tz='UTC').to_pydatetime(),
+                                                 missing=missing))
+
+        models.CandleGap.objects.bulk_create(gaps, ignore_conflicts=True)
+        GapDetector.__log.debug(f"{len(gaps)} gaps found in {ds_pc.period} candles for {ds_pc.datasource.name}.")
+
+        return len(gaps)
+
+    @staticmethod
+    def find(times: np.ndarray, period: str, sessions: np.ndarray = None,
+             max_candles: int = None) -> List[Tuple[int, int, int]]:
+        """
+        Finds the gaps in sorted candle times. Each gap is a run of consecutive candles that are missing while the
+        market is open, so gaps never span a market closure. Gaps with more than max_candles candles missing are split.
+        :param times: Sorted int64 nanoseconds since the epoch, UTC.
+        :param period: The candle period. Must be a fixed length period.
+        :param sessions: Optional. The trading sessions of the symbol, from TradingCalendar. If not provided, the
+            default sessions.
+        :param max_candles: Optional. The maximum number of missing candles in each gap. Default from settings.
+        :return: List of tuples of the time of the first missing candle, the time up to which candles are missing
+            (not including) and the number of missing candles. int64 nanoseconds since the epoch, UTC.
+        """
+        max_candles = max_candles or settings.ALGOBUILDER_PRICEDATA_GAP_MAX_CANDLES
+        sessions = TradingCalendar.default_sessions() if sessions is None else sessions
+        length = period_ns[period]
+
+        # The candles missing between each candle and the next
+        diffs = np.diff(times)
+        after = np.flatnonzero(diffs > length)
+        counts = (diffs[after] - 1) // length
+
+        gaps = []
+        for last, count in zip(times[after], counts):
+            if count == 0:
+                continue
+
+            # Missing candles are last + k * length for k from 1 to count. Those expected are the runs of k during which
+            # the market is open, from the open periods between the first missing candle and the end of the last. Runs
+            # that touch the same candle, or are adjacent, are merged.
+            runs = []
+            for period_open, period_close in TradingCalendar.open_periods(last + length, last + (count + 1) * length,
+                                                                          sessions):
+                first_k = max(1, (period_open - last) // length)
+                last_k = min(count, -((last - period_close) // length) - 1)
+                if len(runs) > 0 and first_k <= runs[-1][1] + 1:
+                    runs[-1][1] = max(runs[-1][1], last_k)
+                elif first_k <= last_k:
+                    runs.append([first_k, last_k])
+
+            # Split into runs of at most max candles
+            for first_k, last_k in runs:
+                for chunk_k in range(first_k, last_k + 1, max_candles):
+                    chunk_count = min(max_candles, last_k + 1 - chunk_k)
+                    gaps.append((int(last + chunk_k * length), int(last + (chunk_k + chunk_count) * length),
+                                 int(chunk_count)))
+
+        return gaps
+
+    @staticmethod
+    def checked(period: str) -> bool:
+        """
+        Whether candles of a period are checked for gaps. Only periods with a fixed length, no shorter than
+        ALGOBUILDER_PRICEDATA_GAP_MIN_PERIOD.
+        :param period:
+        :return:
+        """
+        return period in period_ns and period_ns[period] >= period_ns[settings.ALGOBUILDER_PRICEDATA_GAP_MIN_PERIOD]
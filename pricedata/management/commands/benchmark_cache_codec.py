@@ -0,0 +1,66 @@
+import io
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from algobuilder.utils import DataFrameCodec
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks serialising candle dataframes for the Django cache with the binary dataframe codec, with and without
+    compression, against JSON as the cache used before. Checks that each reads back the same candles.
+
+    python manage.py benchmark_cache_codec --candles 100000 --repeat 5
+    """
+    help = 'Benchmarks the time and size of serialising candle dataframes with the dataframe codec against JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--candles', type=int, default=100000, help='The number of candles in the dataframe.')
+        parser.add_argument('--repeat', type=int, default=5, help='The number of times to encode and decode.')
+
+    def handle(self, *args, **options):
+        candles = Command.__candles(options['candles'])
+        codecs = {'json': (lambda data: data.to_json(orient='table'),
+                           lambda text: pd.read_json(io.StringIO(text), orient='table')),
+                  'codec': (lambda data: DataFrameCodec.encode(data, compression=0), DataFrameCodec.decode),
+                  'codec zlib 1': (lambda data: DataFrameCodec.encode(data, compression=1), DataFrameCodec.decode),
+                  'codec zlib 6': (lambda data: DataFrameCodec.encode(data, compression=6), DataFrameCodec.decode)}
+
+        self.stdout.write(f"Serialising {len(candles.index)} candles, {options['repeat']} times.")
+        for name, (encode, decode) in codecs.items():
+            start = time.perf_counter()
+            for _ in range(0, options['repeat']):
+                encoded = encode(candles)
+            encode_secs = (time.perf_counter() - start) / options['repeat']
+
+            start = time.perf_counter()
+            for _ in range(0, options['repeat']):
+                decoded = decode(encoded)
+            decode_secs = (time.perf_counter() - start) / options['repeat']
+
+            if not decoded.equals(candles) or not decoded.dtypes.equals(candles.dtypes):
+                self.stderr.write(f"Candles read back with {name} differ.")
+
+            self.stdout.write(f"{name}: encode {encode_secs * 1000:.1f}ms, decode {decode_secs * 1000:.1f}ms, "
+                              f"{len(encoded) / 1024:.0f}KB.")
+
+    @staticmethod
+    def __candles(num_candles: int) -> pd.DataFrame:
+        """
+        Generates random walk 1 minute candles, with a spread of 1 to 3 points.
+        """
+        rng = np.random.default_rng(0)
+        times = pd.date_range('2021-01-04', periods=num_candles, freq='1min', tz='UTC', name='time')
+        bid_open = 1.2 + np.cumsum(rng.normal(0, 0.0001, num_candles))
+        bid_close = np.append(bid_open[1:], bid_open[-1])
+        bid_high = np.maximum(bid_open, bid_close) + rng.exponential(0.00005, num_candles)
+        bid_low = np.minimum(bid_open, bid_close) - rng.exponential(0.00005, num_candles)
+        spread = rng.integers(1, 4, num_candles) * 0.00001
+
+        return pd.DataFrame({'bid_open': bid_open, 'bid_high': bid_high, 'bid_low': bid_low, 'bid_close': bid_close,
+                             'ask_open': bid_open + spread, 'ask_high': bid_high + spread,
+                             'ask_low': bid_low + spread, 'ask_close': bid_close + spread,
+                             'volume': rng.integers(1, 1000, num_candles)}, index=times)
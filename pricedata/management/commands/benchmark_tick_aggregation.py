@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from pricedata.aggregation import TickAggregator
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks the tick aggregation engine against resampling ticks with pandas, separately for bid and ask, for each
+    period. Checks that both produce the same candles.
+
+    python manage.py benchmark_tick_aggregation --ticks 5000000 --periods 1S,5S,10S,15S,30S
+    """
+    help = 'Benchmarks aggregating ticks into candles using the tick aggregation engine against pandas resample.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ticks', type=int, default=5000000, help='The number of ticks to aggregate.')
+        parser.add_argument('--periods', type=str, default='1S,5S,10S,15S,30S',
+                            help='The candle periods to aggregate to, comma separated.')
+
+    def handle(self, *args, **options):
+        periods = options['periods'].split(',')
+        ticks = Command.__ticks(options['ticks'])
+        self.stdout.write(f"Aggregating {len(ticks.index)} ticks over {ticks.index[-1] - ticks.index[0]} to "
+                          f"{periods}.")
+
+        # Pandas. Bid and ask resampled separately for each period.
+        start = time.perf_counter()
+        resampled = {period: Command.__resample(ticks, period) for period in periods}
+        pandas_secs = time.perf_counter() - start
+
+        # Engine. All periods in one pass over the ticks.
+        start = time.perf_counter()
+        aggregated = TickAggregator.aggregate(ticks.index.asi8, ticks['bid'].to_numpy(), ticks['ask'].to_numpy(),
+                                              periods)
+        engine_secs = time.perf_counter() - start
+
+        for period in periods:
+            engine = aggregated[period].set_index('time')[resampled[period].columns]
+            if not np.allclose(engine.to_numpy(dtype=float), resampled[period].to_numpy(dtype=float)):
+                self.stderr.write(f"Candles for {period} differ.")
+
+        self.stdout.write(f"pandas resample: {pandas_secs:.3f}s. Tick aggregation engine: {engine_secs:.3f}s. "
+                          f"{pandas_secs / engine_secs:.1f}x faster.")
+
+    @staticmethod
+    def __ticks(num_ticks: int) -> pd.DataFrame:
+        """
+        Generates random walk ticks, on average 100ms apart, with a spread of 1 to 3 points.
+        """
+        rng = np.random.default_rng(0)
+        times = np.datetime64('2021-01-04T00:00:00', 'ns') + \
+            np.cumsum(rng.exponential(100, num_ticks)).astype('timedelta64[ms]')
+        bids = 1.2 + np.cumsum(rng.normal(0, 0.00001, num_ticks))
+        asks = bids + rng.integers(1, 4, num_ticks) * 0.00001
+
+        return pd.DataFrame({'bid': bids, 'ask': asks}, index=pd.DatetimeIndex(times, tz='UTC'))
+
+    @staticmethod
+    def __resample(ticks: pd.DataFrame, period: str) -> pd.DataFrame:
+        """
+        Resamples ticks into candles with pandas, as datasources did before the tick aggregation engine.
+        """
+        rule = {'1W': 'W-MON', '1MO': 'MS'}.get(period, period.replace('M', 'min'))
+        ohlc_calcs = {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'count'}
+        bid_candles = ticks['bid'].resample(rule, closed='left', label='left').agg(ohlc_calcs)
+        ask_candles = ticks['ask'].resample(rule, closed='left', label='left').agg(ohlc_calcs)
+        candles = pd.concat([bid_candles, ask_candles], axis=1)
+        candles.columns = ['bid_open', 'bid_high', 'bid_low', 'bid_close', 'bid_volume', 'ask_open', 'ask_high',
+                           'ask_low', 'ask_close', 'volume']
+
+        return candles.drop('bid_volume', axis=1).dropna()
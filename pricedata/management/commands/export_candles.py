@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pricedata import models
+from pricedata.files import CandleFileCache
+
+
+class Command(BaseCommand):
+    """
+    Exports the candles for symbols from a datasource to the memory mapped candle files in ALGOBUILDER_CANDLE_FILE_DIR,
+    so that notebooks can read them with CandleFileCache without querying the database. Only the candles not already
+    exported are read.
+
+    python manage.py export_candles --datasource MT5 --symbols EURUSD,GBPUSD --period 1M --from 2021-01-01
+    """
+    help = 'Exports candles to memory mapped files for notebooks and research.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--datasource', type=str, required=True, help='The datasource name.')
+        parser.add_argument('--symbols', type=str, default=None,
+                            help='The symbol names, comma separated. All symbols with price data retrieved if not '
+                                 'provided.')
+        parser.add_argument('--period', type=str, required=True, help='The candle period.')
+        parser.add_argument('--from', type=datetime.fromisoformat, required=True, dest='from_date',
+                            help='Export candles from this UTC date and time, in ISO format.')
+        parser.add_argument('--to', type=datetime.fromisoformat, default=None, dest='to_date',
+                            help='Export candles before this UTC date and time, in ISO format. Now if not provided.')
+        parser.add_argument('--clear', action='store_true', help='Remove the exported candles first.')
+
+    def handle(self, *args, **options):
+        datasource_symbols = models.DataSourceSymbol.objects.filter(datasource__name=options['datasource']).\
+            select_related('symbol')
+        if options['symbols'] is None:
+            datasource_symbols = datasource_symbols.filter(retrieve_price_data=True)
+        else:
+            datasource_symbols = datasource_symbols.filter(symbol__name__in=options['symbols'].split(','))
+        if len(datasource_symbols) == 0:
+            raise CommandError(f"No symbols found for datasource {options['datasource']}.")
+
+        from_date, to_date = [None if date is None else date.replace(tzinfo=date.tzinfo or timezone.utc)
+                              for date in [options['from_date'], options['to_date']]]
+        for dss in datasource_symbols:
+            if options['clear']:
+                CandleFileCache.clear(dss.id, options['period'])
+            times, _ = CandleFileCache.load(dss.id, options['period'], from_date, to_date)
+            self.stdout.write(f"Exported {len(times)} {options['period']} candles for {dss.symbol.name}.")
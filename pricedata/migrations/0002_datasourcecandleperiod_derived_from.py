@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricedata', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasourcecandleperiod',
+            name='derived_from',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='derived_periods', to='pricedata.datasourcecandleperiod'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricedata', '0002_datasourcecandleperiod_derived_from'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasourcecandleperiod',
+            name='from_ticks',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='datasourcesymbol',
+            name='ticks_from',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='datasourcesymbol',
+            name='ticks_to',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # The tick table is partitioned by range of tick time, which Django can't create. The primary key has to include
+        # the partition key. Partitions are created by TickStore as ticks are stored.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='Tick',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('time', models.DateTimeField()),
+                        ('bid', models.FloatField()),
+                        ('ask', models.FloatField()),
+                        ('datasource_symbol', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='pricedata.datasourcesymbol')),
+                    ],
+                ),
+                migrations.AddIndex(
+                    model_name='tick',
+                    index=models.Index(fields=['datasource_symbol', 'time'], name='pricedata_t_datasou_f7b1b5_idx'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    sql=[
+                        """CREATE TABLE pricedata_tick (
+                            id bigserial NOT NULL,
+                            datasource_symbol_id bigint NOT NULL
+                                REFERENCES pricedata_datasourcesymbol (id) ON DELETE CASCADE,
+                            time timestamp with time zone NOT NULL,
+                            bid double precision NOT NULL,
+                            ask double precision NOT NULL,
+                            PRIMARY KEY (id, time)
+                        ) PARTITION BY RANGE (time)""",
+                        "CREATE INDEX pricedata_t_datasou_f7b1b5_idx ON pricedata_tick (datasource_symbol_id, time)",
+                    ],
+                    reverse_sql="DROP TABLE pricedata_tick",
+                ),
+            ],
+        ),
+    ]
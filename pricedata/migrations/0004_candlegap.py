@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricedata', '0003_tick'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasourcecandleperiod',
+            name='gaps_checked',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CandleGap',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('1S', '1 Second'), ('5S', '5 Second'), ('10S', '10 Second'), ('15S', '15 Second'), ('30S', '30 Second'), ('1M', '1 Minute'), ('5M', '5 Minute'), ('10M', '10 Minute'), ('15M', '15 Minute'), ('30M', '30 Minute'), ('1H', '1 Hour'), ('3H', '3 Hour'), ('6H', '6 Hour'), ('12H', '12 Hour'), ('1D', '1 Day'), ('1W', '1 Week'), ('1MO', '1 Month')], max_length=3)),
+                ('from_date', models.DateTimeField()),
+                ('to_date', models.DateTimeField()),
+                ('missing', models.IntegerField()),
+                ('status', models.CharField(choices=[('OPEN', 'Open'), ('REPAIRED', 'Repaired'), ('UNAVAILABLE', 'Unavailable')], default='OPEN', max_length=11)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_attempt', models.DateTimeField(blank=True, null=True)),
+                ('datasource_symbol', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pricedata.datasourcesymbol')),
+            ],
+            options={
+                'unique_together': {('datasource_symbol', 'period', 'from_date')},
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:52
+
+import json
+
+from django.db import migrations, models
+
+
+def schedule_retrieval_tasks(apps, schema_editor):
+    """
+    Existing price retrieval periodic tasks only retrieve prices when they are due.
+    """
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    PeriodicTask.objects.filter(task='retrieve_prices').update(kwargs=json.dumps({'scheduled': True}))
+
+
+def unschedule_retrieval_tasks(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    PeriodicTask.objects.filter(task='retrieve_prices').update(kwargs=json.dumps({}))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricedata', '0005_tradingsession'),
+        ('django_celery_beat', '0015_edit_solarschedule_events_choices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasourcecandleperiod',
+            name='idle_retrievals',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='datasourcecandleperiod',
+            name='next_retrieval',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='datasourcecandleperiod',
+            name='retrieval_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(schedule_retrieval_tasks, unschedule_retrieval_tasks),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricedata', '0006_adaptive_retrieval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -4,6 +4,7 @@ import logging
 
 from django_celery_beat import models as cm
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -21,13 +22,17 @@ instrument_types = [
         ('CRYPTO', 'Crypto Currency')
     ]
 
+days_of_week = [(0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'),
+                (6, 'Sunday')]
+
 aggregation_periods = [
         ('minutes', 'Minutes'), ('hours', 'Hours'), ('days', 'Days'), ('weeks', 'Weeks'), ('months', 'Months')
     ]
 
 # Task repeat will be set depending on the candle period, so that we do not check for new candles more
 # often than necessary. For periods < 10S, we will check every 10s. For others, we will align the
-# repeat with the period.
+# repeat with the period. Retrieval is scheduled adaptively by pricedata.scheduling.RetrievalScheduler, so these tasks
+# are a fallback and only retrieve prices when they are due.
 schedules = {'1S': cm.IntervalSchedule(every=10, period=cm.IntervalSchedule.SECONDS),
              '5S': cm.IntervalSchedule(every=10, period=cm.IntervalSchedule.SECONDS),
              '10S': cm.IntervalSchedule(every=10, period=cm.IntervalSchedule.SECONDS),
@@ -66,6 +71,9 @@ class DataSource(models.Model):
     # The periodic task to refresh symbols
     task = models.OneToOneField(cm.PeriodicTask, on_delete=models.CASCADE,  null=True, blank=True)
 
+    # When the datasource was last changed. Pooled instances of the datasource created before this are created again.
+    updated = models.DateTimeField(auto_now=True)
+
     @property
     def task_name(self):
         """
@@ -148,6 +156,41 @@ class Symbol(models.Model):
         return f"{self.name}"
 
 
+class TradingSession(models.Model):
+    """
+    A weekly trading session for a Symbol, or for all symbols of an instrument type. Sessions for a symbol override
+    those for its instrument type. Symbols without any sessions are open outside the weekly market closure in
+    settings, if any. Used by pricedata.sessions.TradingCalendar.
+    """
+    # The symbol or instrument type that the session is for
+    symbol = models.ForeignKey(Symbol, on_delete=models.CASCADE, null=True, blank=True)
+    instrument_type = models.CharField(max_length=10, choices=instrument_types, null=True, blank=True)
+
+    # The day of the week and UTC time that the session opens, and that it closes. Sessions can span the end of the
+    # week, e.g. from Sunday 22:00 to Friday 22:00.
+    open_day = models.IntegerField(choices=days_of_week)
+    open_time = models.TimeField()
+    close_day = models.IntegerField(choices=days_of_week)
+    close_time = models.TimeField()
+
+    def clean(self):
+        """
+        Validates that the session is for either a symbol or an instrument type.
+        :return:
+        """
+        if (self.symbol is None) == (self.instrument_type is None):
+            raise ValidationError('A trading session must be for either a symbol or an instrument type.')
+
+    def __repr__(self):
+        return f"TradingSession(symbol={self.symbol}, instrument_type={self.instrument_type}, " \
+               f"open_day={self.open_day}, open_time={self.open_time}, close_day={self.close_day}, " \
+               f"close_time={self.close_time})"
+
+    def __str__(self):
+        return f"{self.symbol if self.symbol is not None else self.instrument_type}: " \
+               f"{self.get_open_day_display()} {self.open_time} to {self.get_close_day_display()} {self.close_time}"
+
+
 class DataSourceSymbol(models.Model):
     """
     The mapping between data sources and symbols, including a flag to determine whether price data will be retrieved
@@ -163,6 +206,11 @@ class DataSourceSymbol(models.Model):
     # Any broker specific data required for the symbol. Stored as json text.
     symbol_info = models.CharField(max_length=1000)
 
+    # The time range that ticks have been retrieved from the datasource and stored for, from and up to but not
+    # including. None if no ticks have been retrieved. Ticks are only ever retrieved for times outside of this range.
+    ticks_from = models.DateTimeField(null=True, blank=True)
+    ticks_to = models.DateTimeField(null=True, blank=True)
+
     @property
     def symbol_info_dict(self):
         """
@@ -199,6 +247,27 @@ class DataSourceCandlePeriod(models.Model):
     # Whether data collection is active
     active = models.BooleanField(default=False)
 
+    # The shorter candle period of the same datasource that candles for this period are derived from, rather than
+    # retrieved from the datasource. Derived candles are aggregated from the base period candles whenever they are
+    # retrieved.
+    derived_from = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True,
+                                     related_name='derived_periods')
+
+    # Whether candles for this period are built from the ticks stored for the datasource, rather than retrieved from the
+    # datasource as candles. Ticks are retrieved once and stored, so candle periods built from them can be added
+    # without retrieving the ticks again. Requires a datasource that implements get_ticks.
+    from_ticks = models.BooleanField(default=False)
+
+    # When the candles for this period were last checked for gaps. Candles from this time are checked next time.
+    gaps_checked = models.DateTimeField(null=True, blank=True)
+
+    # Adaptive scheduling of retrieval, maintained by pricedata.scheduling.RetrievalScheduler. When the next retrieval
+    # is due, the moving average of the time taken to retrieve prices and the number of retrievals in a row that found
+    # no new candles.
+    next_retrieval = models.DateTimeField(null=True, blank=True)
+    retrieval_seconds = models.FloatField(null=True, blank=True)
+    idle_retrievals = models.IntegerField(default=0)
+
     # The periodic task to refresh prices
     task = models.OneToOneField(cm.PeriodicTask, on_delete=models.CASCADE, null=True, blank=True)
 
@@ -210,6 +279,23 @@ class DataSourceCandlePeriod(models.Model):
         """
         return f'Updating {self.period} prices for {self.datasource.name}'
 
+    def clean(self):
+        """
+        Validates that derived candle periods can be derived from their base period, and aren't also built from ticks.
+        :return:
+        """
+        from pricedata.aggregation import CandleAggregator  # Imported when needed, due to circular dependency
+
+        if self.derived_from is not None:
+            if self.derived_from.datasource_id != self.datasource_id:
+                raise ValidationError({'derived_from': 'Candles can only be derived from the same datasource.'})
+            if not CandleAggregator.can_derive(self.period, self.derived_from.period):
+                raise ValidationError({'derived_from': f'{self.period} candles cannot be derived from '
+                                                       f'{self.derived_from.period} candles.'})
+            if self.from_ticks:
+                raise ValidationError({'from_ticks': 'Candles can be built from ticks or derived from another period, '
+                                                     'but not both.'})
+
     def setup_task(self):
         """
         Sets up the periodic task to refresh prices. Also run it now.
@@ -230,7 +316,8 @@ class DataSourceCandlePeriod(models.Model):
                 name=self.task_name,
                 task='retrieve_prices',
                 interval=schedule,
-                args=json.dumps([self.id])
+                args=json.dumps([self.id]),
+                kwargs=json.dumps({'scheduled': True})
             )
         elif isinstance(schedule, cm.CrontabSchedule):
             # Get or create the schedule
@@ -244,7 +331,8 @@ class DataSourceCandlePeriod(models.Model):
                 name=self.task_name,
                 task='retrieve_prices',
                 crontab=schedule,
-                args=json.dumps([self.id])
+                args=json.dumps([self.id]),
+                kwargs=json.dumps({'scheduled': True})
             )
 
         self.save()
@@ -262,7 +350,8 @@ class DataSourceCandlePeriod(models.Model):
 
     def __repr__(self):
         return f"DataSourceCandlePeriod(datasource={self.datasource}, period={self.period}, " \
-               f"start_from={self.start_from}, active={self.active})"
+               f"start_from={self.start_from}, active={self.active}, derived_from={self.derived_from}, " \
+               f"from_ticks={self.from_ticks}, gaps_checked={self.gaps_checked})"
 
     def __str__(self):
         return f"datasource={self.datasource}, period={self.period}"
@@ -314,6 +403,78 @@ class Candle(models.Model):
         unique_together = ('datasource_symbol', 'time', 'period',)
 
 
+class Tick(models.Model):
+    """
+    A bid / ask tick for the Symbol retrieved from the DataSource. Stored in a table partitioned by month of the tick
+    time, and only written by pricedata.ticks.TickStore, which creates the partitions and bulk loads the ticks using
+    COPY.
+    """
+    # The datasource that this was retrieved from and the symbol that it is for. Ticks are deleted by the database when
+    # the datasource symbol is deleted, rather than one by one by Django.
+    datasource_symbol = models.ForeignKey(DataSourceSymbol, on_delete=models.DO_NOTHING)
+
+    # Timestamp
+    time = models.DateTimeField()
+
+    # Bid and ask prices
+    bid = models.FloatField()
+    ask = models.FloatField()
+
+    def __repr__(self):
+        return f"Tick(datasource_symbol={self.datasource_symbol}, time={self.time}, bid={self.bid}, ask={self.ask})"
+
+    def __str__(self):
+        return f"datasource={self.datasource_symbol.datasource}, symbol={self.datasource_symbol.symbol}, " \
+               f"time={self.time}, bid={self.bid}, ask={self.ask}"
+
+    class Meta:
+        indexes = [models.Index(fields=['datasource_symbol', 'time'])]
+
+
+class CandleGap(models.Model):
+    """
+    A run of candles missing for the Symbol while the market was open, found by pricedata.gaps.GapDetector. Gaps are
+    repaired by retrieving the candles for them from the DataSource again.
+    """
+    STATUS_OPEN = 'OPEN'
+    STATUS_REPAIRED = 'REPAIRED'
+    STATUS_UNAVAILABLE = 'UNAVAILABLE'
+    statuses = [(STATUS_OPEN, 'Open'), (STATUS_REPAIRED, 'Repaired'), (STATUS_UNAVAILABLE, 'Unavailable')]
+
+    # The datasource and symbol that the candles are missing for
+    datasource_symbol = models.ForeignKey(DataSourceSymbol, on_delete=models.CASCADE)
+
+    # Period of the missing candles
+    period = models.CharField(max_length=3, choices=candle_periods)
+
+    # The time of the first missing candle, and the time up to which candles are missing, not including
+    from_date = models.DateTimeField()
+    to_date = models.DateTimeField()
+
+    # The number of candles missing
+    missing = models.IntegerField()
+
+    # Whether the gap is still to be repaired, has been repaired, or the datasource didn't have the candles after all
+    # repair attempts
+    status = models.CharField(max_length=11, choices=statuses, default=STATUS_OPEN)
+
+    # The number of times that the candles have been retrieved for the gap, and when they were last retrieved
+    attempts = models.IntegerField(default=0)
+    last_attempt = models.DateTimeField(null=True, blank=True)
+
+    def __repr__(self):
+        return f"CandleGap(datasource_symbol={self.datasource_symbol}, period={self.period}, " \
+               f"from_date={self.from_date}, to_date={self.to_date}, missing={self.missing}, status={self.status}, " \
+               f"attempts={self.attempts}, last_attempt={self.last_attempt})"
+
+    def __str__(self):
+        return f"datasource={self.datasource_symbol.datasource}, symbol={self.datasource_symbol.symbol}, " \
+               f"period={self.period}, from_date={self.from_date}, to_date={self.to_date}, status={self.status}"
+
+    class Meta:
+        unique_together = ('datasource_symbol', 'period', 'from_date',)
+
+
 class SummaryBatch(models.Model):
     """
     A batch run to create the price data quality metrics and aggregation data for the pricedata quality dashboards
@@ -0,0 +1,102 @@
+"""
+Adaptive scheduling of price retrieval. Each retrieval schedules the next for just after the next candle closes, backing
+off while the datasource has no new candles and running again immediately while it is catching up. The periodic tasks
+in pricedata.models.schedules remain as a fallback, but only retrieve prices when they are due.
+"""
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from pricedata import models
+from pricedata.aggregation import CandleAggregator
+
+
+class RetrievalScheduler:
+    """
+    Schedules the retrieval of prices for datasource candle periods, from how long retrieval takes and whether new
+    candles were found.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    # The weight of the latest retrieval time in the moving average of retrieval times
+    __retrieval_seconds_weight = 0.2
+
+    @staticmethod
+    def claim(ds_pc: models.DataSourceCandlePeriod) -> bool:
+        """
+        Claims a scheduled retrieval if it is due, so that it only runs once when it is scheduled by both the periodic
+        task and the previous retrieval. The claim lasts for the lease in settings, after which the retrieval is due
+        again in case the worker claiming it stopped.
+        :param ds_pc:
+        :return: Whether the retrieval was claimed
+        """
+        now = timezone.now()
+        lease = timedelta(seconds=settings.ALGOBUILDER_PRICEDATA_SCHEDULE_LEASE)
+
+        return models.DataSourceCandlePeriod.objects.filter(id=ds_pc.id).\
+            filter(Q(next_retrieval__isnull=True) | Q(next_retrieval__lte=now)).\
+            update(next_retrieval=now + lease) == 1
+
+    @staticmethod
+    def reschedule(ds_pc: models.DataSourceCandlePeriod, retrieval_seconds: float, last_times: Dict[int, datetime],
+                   retrieved_times: Dict[int, datetime]) -> Optional[datetime]:
+        """
+        Records a retrieval and schedules the next. The next retrieval is just after the next candle closes, with
+        jitter so that retrievals for many periods don't all run at once. It is no sooner than the minimum interval or
+        the average retrieval time. While no new candles are found, it backs off by a doubling number of candles, up to
+        the maximum backoff. While new candles are found but the datasource is still more than a candle behind, it is
+        now.
+        :param ds_pc: The datasource candle period retrieved
+        :param retrieval_seconds: How long the retrieval took
+        :param last_times: Dict of datasource symbol id to the time of its last candle before the retrieval
+        :param retrieved_times: Dict of datasource symbol id to the time of the last candle retrieved for it
+        :return: The time of the next retrieval if it should be scheduled now, or None if it is too far away and will be
+            run by the periodic task.
+        """
+        now = timezone.now()
+        now_ns = np.array([pd.Timestamp(now).value])
+        candle_start = CandleAggregator.bin_starts(now_ns, ds_pc.period)
+        length = int(CandleAggregator.bin_ends(candle_start, ds_pc.period)[0] - candle_start[0])
+
+        # Moving average of the retrieval time, and the number of retrievals in a row without new candles
+        average_seconds = retrieval_seconds if ds_pc.retrieval_seconds is None else \
+            RetrievalScheduler.__retrieval_seconds_weight * retrieval_seconds + \
+            (1 - RetrievalScheduler.__retrieval_seconds_weight) * ds_pc.retrieval_seconds
+        updated = [dss_id for dss_id, time in retrieved_times.items()
+                   if dss_id not in last_times or time > last_times[dss_id]]
+        idle_retrievals = 0 if len(updated) > 0 else ds_pc.idle_retrievals + 1
+
+        # Behind if a symbol with new candles is still missing a complete candle
+        last_complete = candle_start[0] - length
+        behind = any(pd.Timestamp(retrieved_times[dss_id]).value < last_complete for dss_id in updated)
+
+        if behind:
+            next_retrieval = now
+        else:
+            earliest = now_ns + int(max(settings.ALGOBUILDER_PRICEDATA_SCHEDULE_MIN_INTERVAL, average_seconds) * 10**9)
+            backoff = min(2 ** min(idle_retrievals, 32) - 1,
+                          settings.ALGOBUILDER_PRICEDATA_SCHEDULE_MAX_BACKOFF * 10**9 // length)
+            close = CandleAggregator.bin_ends(CandleAggregator.bin_starts(earliest - 1, ds_pc.period),
+                                              ds_pc.period)[0] + backoff * length
+            next_retrieval = pd.Timestamp(close, tz='UTC').to_pydatetime() + \
+                timedelta(seconds=settings.ALGOBUILDER_PRICEDATA_SCHEDULE_DELAY +
+                          random.uniform(0, settings.ALGOBUILDER_PRICEDATA_SCHEDULE_JITTER))
+
+        # Update without saving the model, as saving updates its periodic task, which reloads the beat schedule
+        models.DataSourceCandlePeriod.objects.filter(id=ds_pc.id).update(
+            next_retrieval=next_retrieval, retrieval_seconds=average_seconds, idle_retrievals=idle_retrievals)
+        RetrievalScheduler.__log.debug(f"Next {ds_pc.period} retrieval for {ds_pc.datasource.name} at "
+                                       f"{next_retrieval}. {len(updated)} symbols updated in {retrieval_seconds:.1f}s. "
+                                       f"{idle_retrievals} retrievals without new candles.")
+
+        return next_retrieval if next_retrieval - now <= \
+            timedelta(seconds=settings.ALGOBUILDER_PRICEDATA_SCHEDULE_MAX_ETA) else None
@@ -0,0 +1,152 @@
+"""
+The weekly trading sessions of symbols, used to find when their markets are open. Prices aren't retrieved for symbols
+whose market has been closed since their last candle, and candles aren't expected while the market is closed.
+"""
+import logging
+from typing import Dict, List
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+
+from pricedata import models
+from pricedata.aggregation import period_ns
+
+
+class TradingCalendar:
+    """
+    Finds when the markets of symbols are open from their trading sessions. Sessions are held as an array with a row for
+    each session, of the open and close times in int64 nanoseconds since the start of the week (Monday 00:00 UTC). A
+    session that closes before it opens spans the end of the week.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    # Days of the week, as used in the market closed setting
+    __days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+    # Nanoseconds in a week. The epoch was a Thursday, so weeks start on Monday 4 days later.
+    __week_ns = 7 * period_ns['1D']
+    __week_origin_ns = 4 * period_ns['1D']
+
+    @staticmethod
+    def sessions(symbols: List[models.Symbol]) -> Dict[int, np.ndarray]:
+        """
+        Gets the trading sessions for symbols, in a single query. Sessions for a symbol override the sessions for its
+        instrument type. Symbols with neither are open outside the weekly market closure in settings, if any.
+        :param symbols:
+        :return: Dict of symbol id to sessions
+        """
+        symbols = list(symbols)
+        if len(symbols) == 0:
+            return {}
+
+        by_symbol = {}
+        by_instrument_type = {}
+        for session in models.TradingSession.objects.filter(
+                Q(symbol__in=symbols) | Q(instrument_type__in={symbol.instrument_type for symbol in symbols})):
+            row = [TradingCalendar.__to_ns(session.open_day, session.open_time.hour, session.open_time.minute),
+                   TradingCalendar.__to_ns(session.close_day, session.close_time.hour, session.close_time.minute)]
+            if session.symbol_id is not None:
+                by_symbol.setdefault(session.symbol_id, []).append(row)
+            else:
+                by_instrument_type.setdefault(session.instrument_type, []).append(row)
+
+        default = TradingCalendar.default_sessions()
+        return {symbol.id: np.array(by_symbol[symbol.id], dtype=np.int64) if symbol.id in by_symbol
+                else np.array(by_instrument_type[symbol.instrument_type], dtype=np.int64)
+                if symbol.instrument_type in by_instrument_type else default for symbol in symbols}
+
+    @staticmethod
+    def default_sessions() -> np.ndarray:
+        """
+        The sessions of symbols that don't have any, from the weekly market closure in settings. A single session from
+        when the market opens to when it closes, or all week if the market never closes.
+        """
+        if settings.ALGOBUILDER_PRICEDATA_MARKET_CLOSED is None:
+            return np.array([[0, TradingCalendar.__week_ns]], dtype=np.int64)
+
+        market_close, market_open = settings.ALGOBUILDER_PRICEDATA_MARKET_CLOSED
+        return np.array([[TradingCalendar.__parse(market_open), TradingCalendar.__parse(market_close)]],
+                        dtype=np.int64)
+
+    @staticmethod
+    def open_during(starts: np.ndarray, ends: np.ndarray, sessions: np.ndarray) -> np.ndarray:
+        """
+        Returns whether the market is open at any time during each time range. Used to find the candles that are
+        expected, with the range being the candle, and whether the market has been open since the last candle.
+        :param starts: Start of each range. int64 nanoseconds since the epoch, UTC.
+        :param ends: End of each range, not including. int64 nanoseconds since the epoch, UTC.
+        :param sessions: The trading sessions
+        :return: Boolean array
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        week = TradingCalendar.__week_ns
+
+        # Ranges of a week or more contain every session
+        is_open = (ends - starts >= week) & (len(sessions) > 0)
+
+        # Otherwise, the range overlaps a session in the week that it starts, the week before (sessions that span the
+        # end of the week) or the week after
+        week_starts = starts - np.mod(starts - TradingCalendar.__week_origin_ns, week)
+        for session_open, session_close in sessions:
+            if session_close <= session_open:
+                session_close += week
+            for weeks in [-1, 0, 1]:
+                is_open |= (week_starts + weeks * week + session_open < ends) & \
+                    (week_starts + weeks * week + session_close > starts)
+
+        return is_open
+
+    @staticmethod
+    def open_periods(start: int, end: int, sessions: np.ndarray) -> np.ndarray:
+        """
+        Returns the periods that the market is open between two times, without enumerating the candles in them. Used to
+        find the candles expected in long time ranges.
+        :param start: int64 nanoseconds since the epoch, UTC.
+        :param end: Not including. int64 nanoseconds since the epoch, UTC.
+        :param sessions: The trading sessions
+        :return: Array with a row for each period, of the open and close times in int64 nanoseconds since the epoch,
+            UTC, clipped to the start and end. Sorted, with overlapping and adjacent periods merged.
+        """
+        week = TradingCalendar.__week_ns
+        if end <= start or len(sessions) == 0:
+            return np.empty((0, 2), dtype=np.int64)
+
+        # Every session in the weeks from the week before the start (sessions that span the end of the week) to the end
+        week_start = start - (start - TradingCalendar.__week_origin_ns) % week
+        weeks = week_start + np.arange(-1, (end - week_start) // week + 1, dtype=np.int64) * week
+        opens = (weeks[:, np.newaxis] + sessions[:, 0]).ravel()
+        closes = (weeks[:, np.newaxis] + np.where(sessions[:, 1] <= sessions[:, 0], sessions[:, 1] + week,
+                                                  sessions[:, 1])).ravel()
+        overlapping = (opens < end) & (closes > start)
+        opens, closes = np.maximum(opens[overlapping], start), np.minimum(closes[overlapping], end)
+        if len(opens) == 0:
+            return np.empty((0, 2), dtype=np.int64)
+        order = np.argsort(opens, kind='stable')
+        opens, closes = opens[order], closes[order]
+
+        # Merge periods that overlap or are adjacent to those before them
+        latest_closes = np.maximum.accumulate(closes)
+        starts = np.concatenate([[0], np.flatnonzero(opens[1:] > latest_closes[:-1]) + 1])
+        ends = np.concatenate([starts[1:], [len(opens)]]) - 1
+
+        return np.column_stack([opens[starts], latest_closes[ends]]).astype(np.int64)
+
+    @staticmethod
+    def __parse(time: str) -> int:
+        """
+        Converts a day and time, e.g. 'Fri 22:00', to nanoseconds since the start of the week.
+        """
+        day, hours_minutes = time.split()
+        hours, minutes = hours_minutes.split(':')
+        return TradingCalendar.__to_ns(TradingCalendar.__days.index(day), int(hours), int(minutes))
+
+    @staticmethod
+    def __to_ns(day: int, hours: int, minutes: int) -> int:
+        """
+        Converts a day of the week (0 is Monday) and time to nanoseconds since the start of the week.
+        """
+        return day * period_ns['1D'] + hours * period_ns['1H'] + minutes * period_ns['1M']
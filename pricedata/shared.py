@@ -0,0 +1,222 @@
+"""
+An optional store of the most recent candles for each datasource symbol and candle period in shared memory, so that
+feature workers on the same host as price retrieval can read them without querying the database. Enabled by
+ALGOBUILDER_CANDLE_SHARED_MEMORY in settings.
+"""
+import logging
+import os
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+
+from pricedata.cache import candle_fields
+
+
+class SharedCandleStore:
+    """
+    Holds the most recent candles for each datasource symbol and candle period in a ring buffer in a named shared
+    memory segment. The segment has a header of int64 sequence number, capacity, size and end position, then the
+    candle times as int64 ns and the candle fields as float64, a row for each candle.
+
+    Candles are written by pricedata.tasks.save_candles after each upsert. The candles held are always all those stored
+    from the oldest candle held, so that reads from that time can be served without the database. Writers are
+    serialised with a Postgres advisory lock. Readers don't lock, but retry if the sequence number shows that the
+    buffer was written while they read it.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    # Header. Sequence number (odd while being written), capacity, number of candles held and position after the newest.
+    __header_fields = 4
+    __header_bytes = __header_fields * 8
+
+    # Open segments in this process. Segment name to SharedMemory.
+    __segments = {}
+
+    # Lock for the open segments
+    __lock = threading.Lock()
+
+    # The number of times that a read is retried if the buffer is written during it
+    __read_retries = 10
+
+    @staticmethod
+    def enabled() -> bool:
+        """
+        Whether the shared memory candle store is enabled in settings.
+        """
+        return settings.ALGOBUILDER_CANDLE_SHARED_MEMORY
+
+    @staticmethod
+    def append(data: pd.DataFrame):
+        """
+        Writes candles to the ring buffers of their datasource symbols and periods. Candles already held for the same
+        times are replaced. Candles older than the oldest held aren't written, as the candles stored between them and
+        the oldest held may not be held.
+        :param data: Dataframe of candles with columns datasource_symbol_id, period, time (UTC) and the candle fields.
+            All of the candles stored in the time range for each datasource symbol and period.
+        :return:
+        """
+        if len(data.index) == 0:
+            return
+
+        data = data.assign(time=pd.to_datetime(data['time'], utc=True))
+        for (dss_id, period), candles in data.groupby(['datasource_symbol_id', 'period']):
+            candles = candles.sort_values('time')
+            name = SharedCandleStore.__name(dss_id, period)
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [name])
+                SharedCandleStore.__write(SharedCandleStore.__segment(name, create=True),
+                                          pd.DatetimeIndex(candles['time']).asi8,
+                                          candles[candle_fields].to_numpy(dtype=np.float64))
+
+    @staticmethod
+    def get(datasource_symbol_id: int, period: str, from_ns: int,
+            to_ns: int = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Reads candles from the ring buffer for a datasource symbol and period.
+        :param datasource_symbol_id:
+        :param period:
+        :param from_ns: The time of the first candle. int64 ns UTC.
+        :param to_ns: Optional. Candles before this time. int64 ns UTC.
+        :return: Tuple of sorted times (int64 ns UTC) and values (float64, a column for each candle field), or None if
+            the buffer doesn't hold all the candles from the from time.
+        """
+        segment = SharedCandleStore.__segment(SharedCandleStore.__name(datasource_symbol_id, period), create=False)
+        if segment is None:
+            return None
+
+        header, times, values = SharedCandleStore.__arrays(segment)
+        for _ in range(0, SharedCandleStore.__read_retries):
+            sequence = int(header[0])
+            if sequence % 2 == 1:
+                continue
+
+            capacity, size, end = int(header[1]), int(header[2]), int(header[3])
+            positions = np.mod(np.arange(end - size, end), capacity)
+            held_times = times[positions]
+            if size == 0 or from_ns < held_times[0]:
+                return None
+
+            first = np.searchsorted(held_times, from_ns, side='left')
+            last = size if to_ns is None else np.searchsorted(held_times, to_ns, side='left')
+            result = held_times[first:last], values[positions[first:last]]
+
+            if int(header[0]) == sequence:
+                return result
+
+        SharedCandleStore.__log.debug(f"Candles for {datasource_symbol_id} {period} written during each read.")
+        return None
+
+    @staticmethod
+    def remove(datasource_symbol_id: int, period: str):
+        """
+        Removes the ring buffer for a datasource symbol and period from shared memory.
+        """
+        name = SharedCandleStore.__name(datasource_symbol_id, period)
+        segment = SharedCandleStore.__segment(name, create=False)
+        if segment is not None:
+            with SharedCandleStore.__lock:
+                SharedCandleStore.__segments.pop(name, None)
+            segment.close()
+
+            # Unlinking unregisters the segment from the resource tracker, which it was unregistered from when opened
+            if os.name == 'posix':
+                resource_tracker.register(segment._name, 'shared_memory')
+            segment.unlink()
+
+    @staticmethod
+    def __write(segment: shared_memory.SharedMemory, new_times: np.ndarray, new_values: np.ndarray):
+        """
+        Merges candles into a ring buffer. Called by append while holding the write lock.
+        """
+        header, times, values = SharedCandleStore.__arrays(segment)
+        capacity, size, end = int(header[1]), int(header[2]), int(header[3])
+        positions = np.mod(np.arange(end - size, end), capacity)
+
+        # Candles older than the oldest held aren't written
+        if size > 0:
+            keep = new_times >= times[positions[0]]
+            new_times, new_values = new_times[keep], new_values[keep]
+            if len(new_times) == 0:
+                return
+
+        # The held candles from the first new candle are replaced by the merge of them with the new candles
+        first = int(np.searchsorted(times[positions], new_times[0], side='left'))
+        replaced = positions[first:]
+        replaced_times, replaced_values = times[replaced], values[replaced]
+        kept = ~np.isin(replaced_times, new_times)
+        merged_times = np.concatenate([replaced_times[kept], new_times])
+        merged_values = np.concatenate([replaced_values[kept], new_values])
+        order = np.argsort(merged_times, kind='stable')
+        merged_times, merged_values = merged_times[order][-capacity:], merged_values[order][-capacity:]
+
+        header[0] += 1
+        try:
+            start = end - len(replaced)
+            write_positions = np.mod(np.arange(start, start + len(merged_times)), capacity)
+            times[write_positions] = merged_times
+            values[write_positions] = merged_values
+            header[3] = (start + len(merged_times)) % capacity
+            header[2] = min(first + len(merged_times), capacity)
+        finally:
+            header[0] += 1
+
+    @staticmethod
+    def __segment(name: str, create: bool) -> Optional[shared_memory.SharedMemory]:
+        """
+        Opens a shared memory segment, creating it if required. Segments stay open in the process once opened.
+        Segments aren't removed when the process that created them exits, so they persist across tasks and workers.
+        """
+        with SharedCandleStore.__lock:
+            segment = SharedCandleStore.__segments.get(name)
+            if segment is not None:
+                return segment
+
+            try:
+                segment = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                if not create:
+                    return None
+                capacity = settings.ALGOBUILDER_CANDLE_SHARED_ROWS
+                try:
+                    segment = shared_memory.SharedMemory(
+                        name=name, create=True,
+                        size=SharedCandleStore.__header_bytes + capacity * 8 * (1 + len(candle_fields)))
+                    np.ndarray((SharedCandleStore.__header_fields,), dtype=np.int64, buffer=segment.buf)[:] = \
+                        [0, capacity, 0, 0]
+                except FileExistsError:
+                    segment = shared_memory.SharedMemory(name=name)
+
+            # Shared memory opened by the process is otherwise removed when it exits
+            if os.name == 'posix':
+                resource_tracker.unregister(segment._name, 'shared_memory')
+            SharedCandleStore.__segments[name] = segment
+
+            return segment
+
+    @staticmethod
+    def __arrays(segment: shared_memory.SharedMemory) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the header, times and values of a ring buffer as numpy arrays over the shared memory.
+        """
+        header = np.ndarray((SharedCandleStore.__header_fields,), dtype=np.int64, buffer=segment.buf)
+        capacity = int(header[1])
+        times = np.ndarray((capacity,), dtype=np.int64, buffer=segment.buf, offset=SharedCandleStore.__header_bytes)
+        values = np.ndarray((capacity, len(candle_fields)), dtype=np.float64, buffer=segment.buf,
+                            offset=SharedCandleStore.__header_bytes + capacity * 8)
+
+        return header, times, values
+
+    @staticmethod
+    def __name(datasource_symbol_id: int, period: str) -> str:
+        """
+        The name of the shared memory segment for a datasource symbol and period. Includes the database name, so that
+        applications using different databases on the same host don't share segments.
+        """
+        return f"algobuilder_{settings.DATABASES['default']['NAME']}_{datasource_symbol_id}_{period}"
@@ -1,22 +1,37 @@
+import asyncio
 import json
 import logging
+import time
+import numpy as np
 import pandas as pd
-from datetime import timedelta
+from datetime import datetime, timedelta
+from typing import Coroutine, Dict, List
 
 from celery import shared_task
-from django.db.models import Max
+from django.conf import settings
+from django.db.models import Max, Q
 from django.utils import timezone
-from django.db import connection
+from django.db import connection, transaction
 
 from pricedata import datasource
-from algobuilder.utils import DatabaseUtility
+from pricedata.aggregation import CandleAggregator
+from pricedata.cache import CandleWindowCache, candle_fields
+from pricedata.gaps import GapDetector
+from pricedata.scheduling import RetrievalScheduler
+from pricedata.sessions import TradingCalendar
+from pricedata.shared import SharedCandleStore
+from pricedata.ticks import TickStore
+from algobuilder.utils import DatabaseUtility, invalidate_django_cache
 
 
 @shared_task(name='retrieve_prices', queue='pricedata')
-def retrieve_prices(datasource_candleperiod_id: int):
+def retrieve_prices(datasource_candleperiod_id: int, scheduled: bool = False):
     """
-    Retrieves prices for datasource candle period from datasource and populates in application database
+    Retrieves prices for datasource candle period from datasource and populates in application database, then schedules
+    the next retrieval
     :param datasource_candleperiod_id:
+    :param scheduled: Whether the retrieval was scheduled, by its periodic task or by the previous retrieval. Scheduled
+        retrievals only run when they are due.
     :return:
     """
     from pricedata import models  # Imported when needed, due to circular dependency
@@ -28,56 +43,398 @@ def retrieve_prices(datasource_candleperiod_id: int):
     ds_pc = models.DataSourceCandlePeriod.objects.get(id=datasource_candleperiod_id)
 
     # Only continue if active
-    if ds_pc.active:
+    if ds_pc.active and ds_pc.derived_from is not None:
+        # Derived periods aren't retrieved from the datasource. They are derived whenever their base period candles are
+        # retrieved. Catch up from the last derived candle for each symbol, in case any were missed.
+        last_times = dict(models.Candle.objects.filter(datasource_symbol__datasource=ds_pc.datasource,
+                                                       datasource_symbol__retrieve_price_data=True,
+                                                       period=ds_pc.period).
+                          values('datasource_symbol_id').annotate(last_time=Max('time')).
+                          values_list('datasource_symbol_id', 'last_time'))
+        datasource_symbols = models.DataSourceSymbol.objects.filter(datasource=ds_pc.datasource,
+                                                                    retrieve_price_data=True)
+        derive_prices(ds_pc, {dss.id: last_times.get(dss.id, ds_pc.start_from) for dss in datasource_symbols})
+    elif ds_pc.active:
+        # Only when due, if scheduled
+        if scheduled and not RetrievalScheduler.claim(ds_pc):
+            log.debug(f"{ds_pc.period} prices for {ds_pc.datasource.name} are not due.")
+            return
+
         # Get candles
         log.debug(f"Getting price data for {ds_pc.datasource.name} for period {ds_pc.period}.")
-
-        # Get datasource instance to retrieve data from
-        ds_instance = datasource.DataSourceImplementation.instance(ds_pc.datasource.name)
+        started = time.perf_counter()
 
         # Get the symbols where we will retrieving price data for
-        datasource_symbols = models.DataSourceSymbol.objects.filter(datasource=ds_pc.datasource,
-                                                                    retrieve_price_data=True)
+        datasource_symbols = list(models.DataSourceSymbol.objects.filter(datasource=ds_pc.datasource,
+                                                                         retrieve_price_data=True).
+                                  select_related('symbol'))
+
+        # Get last candle for period / symbol / datasource saved for all symbols. If there is one then the symbols
+        # from_date will be the candle time + 1ms. If there isn't one, its from_date will be the
+        # DataSourcePeriodCandles start_from date.
+        last_times = dict(models.Candle.objects.filter(datasource_symbol__in=datasource_symbols, period=ds_pc.period).
+                          values('datasource_symbol_id').annotate(last_time=Max('time')).
+                          values_list('datasource_symbol_id', 'last_time'))
+        from_dates = {dss.id: last_times[dss.id] + timedelta(milliseconds=1) if dss.id in last_times
+                      else ds_pc.start_from for dss in datasource_symbols}
+
+        # Only the symbols whose market has been open since the end of their last candle, or during the last candle
+        # period so that the last candle before the market closed is complete. If there are none, the datasource isn't
+        # called at all.
+        sessions = TradingCalendar.sessions([dss.symbol for dss in datasource_symbols])
+        now = np.array([pd.Timestamp(timezone.now()).value])
+        recent = CandleAggregator.bin_starts(CandleAggregator.bin_starts(now, ds_pc.period) - 1, ds_pc.period)
+        since = {dss_id: CandleAggregator.bin_ends(pd.DatetimeIndex([last_time]).asi8, ds_pc.period)
+                 for dss_id, last_time in last_times.items()}
+        datasource_symbols = [dss for dss in datasource_symbols if TradingCalendar.open_during(
+            np.concatenate([since.get(dss.id, pd.DatetimeIndex([ds_pc.start_from]).asi8), recent]),
+            np.concatenate([now, now]), sessions[dss.symbol_id]).any()]
+        if len(datasource_symbols) == 0:
+            log.debug(f"Markets closed for all symbols of {ds_pc.datasource.name}. Not retrieving {ds_pc.period} "
+                      f"prices.")
+            schedule_retrieval(ds_pc, time.perf_counter() - started, last_times, {})
+            return
 
-        # Iterate symbols, retrieving price data
-        for datasource_symbol in datasource_symbols:
-            symbol = datasource_symbol.symbol.name
-
-            # Get last candle for period / symbol / datasource saved. If there is one then our from_date will be the
-            # candle time + 1ms. If there isn't one, our from_date will be the DataSourcePeriodCandles start_from
-            # date.
-            from_date = ds_pc.start_from
-            last_candle_time = models.Candle.objects.filter(datasource_symbol=datasource_symbol,
-                                                            period=ds_pc.period).aggregate(Max('time'))['time__max']
+        # Get datasource instance to retrieve data from
+        ds_instance = datasource.DataSourceImplementation.instance(ds_pc.datasource.name)
 
-            if last_candle_time is not None:
-                from_date = last_candle_time + timedelta(milliseconds=1)
+        # The time of the first candle retrieved for each symbol, to derive the candles for any derived periods from,
+        # and of the last, to schedule the next retrieval from
+        derive_from_dates = {}
+        retrieved_times = {}
 
-            # To date is now.
+        if not ds_pc.from_ticks and hasattr(type(ds_instance), 'get_prices_bulk'):
+            # Get the prices for all symbols in bulk, then save them in a single upsert. Datasources that don't
+            # extend DataSourceImplementation may not implement get_prices_bulk. Async datasources retrieve the prices
+            # for all symbols concurrently on one event loop.
             to_date = timezone.now()
-
-            # Get the data
-            try:
-                # Get the prices
-                data = ds_instance.get_prices(symbol, from_date, to_date, ds_pc.period,
-                                              datasource_symbol.symbol_info_dict)
-                log.debug(f"{len(data.index)} {ds_pc.period} candles retrieved from {ds_pc.datasource.name} for "
-                          f"{symbol} to {to_date}.")
-
-                # Prepare the dataframe for bulk upsert by adding the datasource symbol.
-                data['datasource_symbol_id'] = datasource_symbol.id
-
-                # Update or insert. We need he data, the table name and the list of unique fields.
-                unique_fields = ['datasource_symbol_id', 'time', 'period']
-                table = models.Candle.objects.model._meta.db_table
-                DatabaseUtility.bulk_insert_or_update(data=data, table=table, unique_fields=unique_fields)
-            except datasource.DataNotAvailableException as ex:
-                log.warning(ex)
+            symbols = {dss.symbol.name: dss for dss in datasource_symbols}
+            args = (list(symbols.keys()), {name: from_dates[dss.id] for name, dss in symbols.items()}, to_date,
+                    ds_pc.period, {name: dss.symbol_info_dict for name, dss in symbols.items()})
+            if isinstance(ds_instance, datasource.AsyncDataSourceImplementation):
+                data = run_async(ds_instance, [ds_instance.get_prices_bulk(*args)])[0]
+                if isinstance(data, Exception):
+                    raise data
+            else:
+                data = ds_instance.get_prices_bulk(*args)
+            log.debug(f"{len(data.index)} {ds_pc.period} candles retrieved from {ds_pc.datasource.name} for "
+                      f"{len(symbols)} symbols to {to_date}.")
+
+            # Replace the symbol with the datasource symbol for bulk upsert
+            data['datasource_symbol_id'] = data['symbol'].map({name: dss.id for name, dss in symbols.items()})
+            data = data.drop(columns='symbol')
+            saved = save_candles(data)
+
+            if len(data.index) > 0:
+                derive_from_dates = saved.groupby('datasource_symbol_id')['time'].min().to_dict()
+                retrieved_times = data.groupby('datasource_symbol_id')['time'].max().to_dict()
+        else:
+            # Iterate symbols, retrieving price data
+            for datasource_symbol in datasource_symbols:
+                symbol = datasource_symbol.symbol.name
+                from_date = from_dates[datasource_symbol.id]
+                last_candle_time = last_times.get(datasource_symbol.id)
+
+                # To date is now.
+                to_date = timezone.now()
+
+                # Get the data
+                try:
+                    if ds_pc.from_ticks:
+                        # Retrieve any ticks not already stored, then build the candles from the stored ticks. Candles
+                        # built from ticks are always complete, so start from the end of the last candle.
+                        TickStore.retrieve(ds_instance, datasource_symbol, ds_pc.start_from, to_date)
+                        if last_candle_time is not None:
+                            from_date = pd.Timestamp(CandleAggregator.bin_ends(
+                                pd.DatetimeIndex([last_candle_time]).asi8, ds_pc.period)[0], tz='UTC').to_pydatetime()
+                        data = TickStore.get_candles(datasource_symbol.id, ds_pc.period, from_date, to_date)
+                    else:
+                        # Get the prices
+                        data = ds_instance.get_prices(symbol, from_date, to_date, ds_pc.period,
+                                                      datasource_symbol.symbol_info_dict)
+                    log.debug(f"{len(data.index)} {ds_pc.period} candles retrieved from {ds_pc.datasource.name} for "
+                              f"{symbol} to {to_date}.")
+
+                    # Prepare the dataframe for bulk upsert by adding the datasource symbol.
+                    data['datasource_symbol_id'] = datasource_symbol.id
+
+                    # Update or insert the candles that have changed
+                    saved = save_candles(data)
+
+                    if len(saved.index) > 0:
+                        derive_from_dates[datasource_symbol.id] = saved['time'].min()
+                    if len(data.index) > 0:
+                        retrieved_times[datasource_symbol.id] = data['time'].max()
+                except datasource.DataNotAvailableException as ex:
+                    log.warning(ex)
+
+        # Derive the candles for any periods derived from this one
+        for derived_period in ds_pc.derived_periods.filter(active=True):
+            derive_prices(derived_period, derive_from_dates)
+
+        schedule_retrieval(ds_pc, time.perf_counter() - started, last_times, retrieved_times)
+
+        # Check for gaps in the candles retrieved, if they haven't been checked recently
+        if ds_pc.gaps_checked is None or \
+                timezone.now() - ds_pc.gaps_checked >= pd.Timedelta(settings.ALGOBUILDER_PRICEDATA_GAP_CHECK_INTERVAL):
+            detect_gaps.delay(ds_pc.id)
     else:
         # Inactive
         log.debug(f"Task running for DataSourceCandlePeriod {ds_pc}.")
 
 
+def save_candles(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Upserts candles, dropping those that are unchanged from the candles already stored. Retrieval starts from the last
+    candle stored and datasources can return overlapping candles, and derived candles are derived again from the start
+    of the derived candle, so many of the candles saved are often already stored. The stored candles in the time range
+    of the candles for each symbol and period are read in a single query to compare them with.
+    :param data: Dataframe of candles with columns datasource_symbol_id, time (UTC), period and the candle fields.
+    :return: The candles that were new or changed, and were saved.
+    """
+    from pricedata import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    if data is None or len(data.index) == 0:
+        return data
+
+    keys = ['datasource_symbol_id', 'period', 'time']
+    data = data.assign(time=pd.to_datetime(data['time'], utc=True))
+    candles = data
+    query = Q()
+    for (dss_id, period), times in data.groupby(['datasource_symbol_id', 'period'])['time']:
+        query |= Q(datasource_symbol_id=dss_id, period=period, time__gte=times.min(), time__lte=times.max())
+    stored = pd.DataFrame.from_records(models.Candle.objects.filter(query).values_list(*keys, *candle_fields),
+                                       columns=keys + candle_fields)
+
+    if len(stored.index) > 0:
+        # Compare at the precision stored. Any candles that differ only by rounding aren't written by the upsert.
+        stored['time'] = pd.to_datetime(stored['time'], utc=True)
+        merged = data[keys + candle_fields].merge(stored, on=keys, how='left', suffixes=('', '_stored'))
+        unchanged = np.ones(len(merged.index), dtype=bool)
+        for field in candle_fields:
+            unchanged &= merged[field].astype(float).round(6).to_numpy() == \
+                merged[f'{field}_stored'].astype(float).round(6).to_numpy()
+        log.debug(f"{unchanged.sum()} of {len(data.index)} candles unchanged.")
+        data = data[~unchanged]
+
+    DatabaseUtility.bulk_insert_or_update(data=data, table=models.Candle.objects.model._meta.db_table,
+                                          unique_fields=['datasource_symbol_id', 'time', 'period'])
+
+    # All the candles, including those unchanged, so that the shared memory store holds every candle in the range
+    if SharedCandleStore.enabled():
+        SharedCandleStore.append(candles)
+
+    # Cached data read from candles is out of date if any changed
+    if len(data.index) > 0:
+        invalidate_django_cache('candles')
+
+    return data
+
+
+def schedule_retrieval(ds_pc, retrieval_seconds: float, last_times: Dict[int, datetime],
+                       retrieved_times: Dict[int, datetime]):
+    """
+    Schedules the next retrieval of prices for a datasource candle period, from the retrieval just run. Retrievals
+    too far in the future to schedule now are run by the periodic task.
+    :param ds_pc: The datasource candle period retrieved
+    :param retrieval_seconds: How long the retrieval took
+    :param last_times: Dict of datasource symbol id to the time of its last candle before the retrieval
+    :param retrieved_times: Dict of datasource symbol id to the time of the last candle retrieved for it
+    :return:
+    """
+    next_retrieval = RetrievalScheduler.reschedule(ds_pc, retrieval_seconds, last_times, retrieved_times)
+    if next_retrieval is not None:
+        retrieve_prices.apply_async(args=[ds_pc.id], kwargs={'scheduled': True}, eta=next_retrieval)
+
+
+@shared_task(name='detect_gaps', queue='pricedata')
+def detect_gaps(datasource_candleperiod_id: int):
+    """
+    Finds the gaps in the candles retrieved for a datasource candle period since it was last checked, then schedules
+    repairs for the open gaps. Gaps with the fewest repair attempts are repaired first, then the most recent. Only a
+    limited number of gaps are repaired each time that the candles are checked, and the repairs are rate limited, so
+    that repairs don't overload the datasource.
+    :param datasource_candleperiod_id:
+    :return:
+    """
+    from pricedata import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    ds_pc = models.DataSourceCandlePeriod.objects.get(id=datasource_candleperiod_id)
+
+    # Derived periods are repaired when their base period is repaired. Candles built from ticks are built from
+    # contiguous ticks.
+    if not ds_pc.active or ds_pc.derived_from is not None or ds_pc.from_ticks:
+        return
+
+    checked = timezone.now()
+    found = GapDetector.detect(ds_pc, ds_pc.gaps_checked)
+    ds_pc.gaps_checked = checked
+    ds_pc.save(update_fields=['gaps_checked'])
+
+    gaps = list(models.CandleGap.objects.filter(
+        datasource_symbol__datasource=ds_pc.datasource, datasource_symbol__retrieve_price_data=True,
+        period=ds_pc.period, status=models.CandleGap.STATUS_OPEN).
+        order_by('attempts', '-from_date').values_list('id', flat=True)[:settings.ALGOBUILDER_PRICEDATA_GAP_REPAIRS])
+    log.debug(f"{found} gaps found in {ds_pc.period} candles for {ds_pc.datasource.name}. Repairing {len(gaps)} "
+              f"gaps.")
+
+    for gap_id in gaps:
+        repair_gap.delay(gap_id)
+
+
+@shared_task(name='repair_gap', queue='pricedata', rate_limit=settings.ALGOBUILDER_PRICEDATA_GAP_REPAIR_RATE_LIMIT)
+def repair_gap(candle_gap_id: int):
+    """
+    Retrieves the candles for a gap from the datasource, then derives the candles for any periods derived from the gap
+    period. If the datasource doesn't have the candles, the gap is retried the next time that gaps are repaired, until
+    the maximum number of attempts.
+    :param candle_gap_id:
+    :return:
+    """
+    from pricedata import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    gap = models.CandleGap.objects.select_related('datasource_symbol__datasource', 'datasource_symbol__symbol').\
+        get(id=candle_gap_id)
+    if gap.status != models.CandleGap.STATUS_OPEN:
+        return
+
+    datasource_symbol = gap.datasource_symbol
+    symbol = datasource_symbol.symbol.name
+    ds_instance = datasource.DataSourceImplementation.instance(datasource_symbol.datasource.name)
+
+    # Get the candles for the gap. The to date is the next candle after the gap, which has already been retrieved.
+    try:
+        args = (symbol, gap.from_date, gap.to_date - timedelta(milliseconds=1), gap.period,
+                datasource_symbol.symbol_info_dict)
+        if isinstance(ds_instance, datasource.AsyncDataSourceImplementation):
+            data = run_async(ds_instance, [ds_instance.get_prices(*args)])[0]
+            if isinstance(data, Exception):
+                raise data
+        else:
+            data = ds_instance.get_prices(*args)
+        data = data[(data['time'] >= pd.Timestamp(gap.from_date)) & (data['time'] < pd.Timestamp(gap.to_date))]
+    except datasource.DataNotAvailableException as ex:
+        log.warning(ex)
+        data = None
+
+    gap.attempts += 1
+    gap.last_attempt = timezone.now()
+
+    if data is not None and len(data.index) > 0:
+        save_candles(data.assign(datasource_symbol_id=datasource_symbol.id))
+
+        # Derive the candles for any periods derived from the gap period, only for the gap
+        ds_pc = models.DataSourceCandlePeriod.objects.get(datasource=datasource_symbol.datasource, period=gap.period)
+        for derived_period in ds_pc.derived_periods.filter(active=True):
+            derive_prices(derived_period, {datasource_symbol.id: gap.from_date}, {datasource_symbol.id: gap.to_date})
+
+        # Candles that may already be cached for feature calculations have been added
+        CandleWindowCache.invalidate()
+
+        gap.status = models.CandleGap.STATUS_REPAIRED
+        log.debug(f"{len(data.index)} of {gap.missing} missing {gap.period} candles retrieved for {symbol} from "
+                  f"{gap.from_date} to {gap.to_date}.")
+    elif gap.attempts >= settings.ALGOBUILDER_PRICEDATA_GAP_REPAIR_ATTEMPTS:
+        gap.status = models.CandleGap.STATUS_UNAVAILABLE
+        log.debug(f"{gap.period} candles for {symbol} from {gap.from_date} to {gap.to_date} are not available.")
+
+    gap.save()
+
+
+def run_async(ds_instance, coroutines: List[Coroutine], max_concurrency: int = None) -> List:
+    """
+    Runs coroutines for an async datasource concurrently on a new event loop, opening the datasource before they run
+    and closing it after.
+    :param ds_instance: The AsyncDataSourceImplementation that the coroutines are for
+    :param coroutines: The coroutines to run, e.g. a get_prices call for each symbol
+    :param max_concurrency: Optional. The maximum number of coroutines to run at once. Default from settings.
+    :return: List of the result of each coroutine, in order. If a coroutine raised an exception, the exception is
+        returned in place of its result.
+    """
+    max_concurrency = max_concurrency or settings.ALGOBUILDER_PRICEDATA_ASYNC_CONCURRENCY
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        await ds_instance.open()
+        try:
+            return await asyncio.gather(*[run(coroutine) for coroutine in coroutines], return_exceptions=True)
+        finally:
+            await ds_instance.close()
+
+    return asyncio.run(run_all())
+
+
+def derive_prices(ds_pc, from_dates, to_dates=None):
+    """
+    Derives the candles for a derived datasource candle period from the candles of its base period, then for any
+    periods derived from it. The candles for all symbols are read in a single query and saved in a single upsert.
+    :param ds_pc: The derived datasource candle period
+    :param from_dates: Dict of datasource symbol id to the time of the first base candle that was added or changed.
+        Candles are derived from the start of the derived candle that this falls into.
+    :param to_dates: Optional. Dict of datasource symbol id to the time up to which base candles were added or changed,
+        not including. Candles are derived up to the end of the derived candle that the last changed candle falls
+        into. If not provided, candles are derived up to the last base candle.
+    :return:
+    """
+    from pricedata import models  # Imported when needed, due to circular dependency
+
+    # Logger
+    log = logging.getLogger(__name__)
+
+    if len(from_dates) == 0:
+        return
+
+    # Base candles from the start of the first derived candle affected for each symbol
+    query = Q()
+    for dss_id, from_date in from_dates.items():
+        start = CandleAggregator.bin_starts(pd.DatetimeIndex([pd.Timestamp(from_date)]).asi8, ds_pc.period)[0]
+        condition = Q(datasource_symbol_id=dss_id, time__gte=pd.Timestamp(start, tz='UTC').to_pydatetime())
+        if to_dates is not None and dss_id in to_dates:
+            last_ns = pd.Timestamp(to_dates[dss_id]).value - 1
+            end = CandleAggregator.bin_ends(CandleAggregator.bin_starts(np.array([last_ns]), ds_pc.period),
+                                            ds_pc.period)[0]
+            condition &= Q(time__lt=pd.Timestamp(end, tz='UTC').to_pydatetime())
+        query |= condition
+
+    fields = ['bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high', 'ask_low', 'ask_close', 'volume']
+    candles = pd.DataFrame.from_records(
+        models.Candle.objects.filter(query, period=ds_pc.derived_from.period).
+        values_list('datasource_symbol_id', 'time', *fields),
+        columns=['datasource_symbol_id', 'time'] + fields)
+
+    if len(candles.index) > 0:
+        candles['time'] = pd.to_datetime(candles['time'], utc=True)
+        derived = []
+        for dss_id, symbol_candles in candles.groupby('datasource_symbol_id'):
+            symbol_derived = CandleAggregator.resample(symbol_candles.set_index('time')[fields], ds_pc.period)
+            symbol_derived['datasource_symbol_id'] = dss_id
+            derived.append(symbol_derived)
+
+        data = pd.concat(derived).reset_index()
+        data['period'] = ds_pc.period
+        log.debug(f"Derived {len(data.index)} {ds_pc.period} candles for {ds_pc.datasource.name} from "
+                  f"{len(candles.index)} {ds_pc.derived_from.period} candles.")
+        save_candles(data)
+
+        # Derive any periods derived from this one
+        for derived_period in ds_pc.derived_periods.filter(active=True):
+            derive_prices(derived_period, from_dates, to_dates)
+
+
 @shared_task(name='retrieve_symbols', queue='pricedata')
 def retrieve_symbols(datasource_id):
     """
@@ -99,35 +456,48 @@ def retrieve_symbols(datasource_id):
         instance = datasource.DataSourceImplementation.instance(ds.name)
 
         # Get symbols from instance
-        ds_symbols = instance.get_symbols()
-
-        # Update the database.
-        for ds_symbol in ds_symbols:
-            # Get symbol if it already exists, otherwise create it
-            symbols = models.Symbol.objects.filter(name=ds_symbol['symbol_name'])
-            if len(symbols) > 0:
-                symbol = symbols[0]
-            else:
-                # Add it.
-                symbol = models.Symbol(name=ds_symbol['symbol_name'], instrument_type=ds_symbol['instrument_type'])
-                symbol.save()
-
-            # Get the symbol info. It is all fields from ds_symbol except for symbol_name and instrument_type
-            symbol_info = ds_symbol
-            del symbol_info['symbol_name']
-            del symbol_info['instrument_type']
-
-            # Create a DataSourceSymbol if it doesn't already exist. Update it if it does.
-            ds_symbols = models.DataSourceSymbol.objects.filter(datasource=ds, symbol=symbol)
-
-            if len(ds_symbols) == 0:
-                ds_symbol = models.DataSourceSymbol(datasource=ds, symbol=symbol, symbol_info=json.dumps(symbol_info))
-            else:
-                ds_symbol = ds_symbols[0]
-                ds_symbol.symbol_info = json.dumps(symbol_info)
-
-            # Save it
-            ds_symbol.save()
+        if isinstance(instance, datasource.AsyncDataSourceImplementation):
+            ds_symbols = run_async(instance, [instance.get_symbols()])[0]
+            if isinstance(ds_symbols, Exception):
+                raise ds_symbols
+        else:
+            ds_symbols = instance.get_symbols()
+
+        # The symbol info for each symbol is all fields except for symbol_name and instrument_type
+        symbol_infos = {ds_symbol['symbol_name']: {key: value for key, value in ds_symbol.items()
+                                                   if key not in ['symbol_name', 'instrument_type']}
+                        for ds_symbol in ds_symbols}
+        instrument_types = {ds_symbol['symbol_name']: ds_symbol['instrument_type'] for ds_symbol in ds_symbols}
+        names = list(symbol_infos.keys())
+
+        # Update the database in bulk, in a single transaction
+        with transaction.atomic():
+            # Create the symbols that don't already exist. Symbols can be created concurrently for other datasources,
+            # so ignore conflicts, then load them all.
+            existing = set(models.Symbol.objects.filter(name__in=names).values_list('name', flat=True))
+            models.Symbol.objects.bulk_create([models.Symbol(name=name, instrument_type=instrument_types[name])
+                                               for name in names if name not in existing],
+                                              ignore_conflicts=True)
+            symbols = dict(models.Symbol.objects.filter(name__in=names).values_list('name', 'id'))
+
+            # Create the DataSourceSymbols that don't already exist, and update those whose symbol info has changed
+            datasource_symbols = {dss.symbol_id: dss for dss in models.DataSourceSymbol.objects.filter(datasource=ds)}
+            create = []
+            update = []
+            for name, symbol_info in symbol_infos.items():
+                dss = datasource_symbols.get(symbols[name])
+                if dss is None:
+                    create.append(models.DataSourceSymbol(datasource=ds, symbol_id=symbols[name],
+                                                          symbol_info=json.dumps(symbol_info)))
+                elif dss.symbol_info_dict != symbol_info:
+                    dss.symbol_info = json.dumps(symbol_info)
+                    update.append(dss)
+
+            models.DataSourceSymbol.objects.bulk_create(create, ignore_conflicts=True)
+            models.DataSourceSymbol.objects.bulk_update(update, ['symbol_info'], batch_size=1000)
+
+        log.debug(f"{len(symbol_infos)} symbols retrieved from {ds.name}. {len(create)} added, {len(update)} updated "
+                  f"and {len(symbol_infos) - len(create) - len(update)} unchanged.")
 
 
 # noinspection PyTypeChecker
@@ -221,6 +591,7 @@ def create_summary_data():
     table = models.SummaryAggregation.objects.model._meta.db_table
     DatabaseUtility.bulk_insert_or_update(data=grouped, table=table,  batch_size=100)
 
-    # Batch complete
+    # Batch complete. Cached summary data is from the previous batch.
     batch.status = models.SummaryBatch.STATUS_COMPLETE
     batch.save()
+    invalidate_django_cache('summary')
@@ -1,18 +1,34 @@
+import asyncio
 import datetime
+import tempfile
+import time
 from decimal import Decimal
 
+import numpy as np
 import pandas as pd
 
 from datetime import timedelta
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, PropertyMock
 
 from django_celery_beat.models import PeriodicTask
 
+from algobuilder.utils import DatabaseUtility
 from plugin import models as plugin_models
+from pricedata import datasource
 from pricedata import models
 from pricedata import tasks
+from pricedata.cache import CandleWindowCache
+from pricedata.files import CandleFileCache
+from pricedata.gaps import GapDetector
+from pricedata.scheduling import RetrievalScheduler
+from pricedata.sessions import TradingCalendar
+from pricedata.shared import SharedCandleStore
+from pricedata.ticks import TickStore
+from pricedata.aggregation import CandleAggregator, TickAggregator, period_ns
 
 
 # Tests for the data model
@@ -146,6 +162,43 @@ class TasksTest(TestCase):
         symbols = models.Symbol.objects.all()
         self.assertTrue(len(symbols) == 5)
 
+    @patch('pricedata.datasource.DataSourceImplementation')
+    def test_retrieve_symbols_bulk(self, mock):
+        """
+        Test that symbols are added and updated in bulk, with the same number of queries however many symbols there are,
+        and that symbols whose info hasn't changed aren't updated
+        """
+        datasource_subclass_mock = MagicMock()
+        mock.instance.return_value = datasource_subclass_mock
+        ds = models.DataSource(name='test', pluginclass=self.plugin_class)
+        ds.save()
+
+        # An existing symbol, shared with another datasource
+        models.Symbol(name='Symbol0', instrument_type='FOREX').save()
+
+        queries = []
+        for num_symbols in [10, 100]:
+            datasource_subclass_mock.get_symbols.return_value = \
+                [{'symbol_name': f'Symbol{i}', 'instrument_type': 'FOREX', 'digits': 5} for i in range(0, num_symbols)]
+            with CaptureQueriesContext(connection) as context:
+                tasks.retrieve_symbols(datasource_id=ds.id)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(models.Symbol.objects.count(), 100)
+        self.assertEqual(models.DataSourceSymbol.objects.filter(datasource=ds).count(), 100)
+
+        # Change the info for one symbol. Only it is updated.
+        datasource_subclass_mock.get_symbols.return_value = \
+            [{'symbol_name': f'Symbol{i}', 'instrument_type': 'FOREX', 'digits': 3 if i == 5 else 5}
+             for i in range(0, 100)]
+        with CaptureQueriesContext(connection) as context:
+            tasks.retrieve_symbols(datasource_id=ds.id)
+        updates = [query for query in context.captured_queries
+                   if query['sql'].startswith('UPDATE "pricedata_datasourcesymbol"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(models.DataSourceSymbol.objects.get(symbol__name='Symbol5').symbol_info_dict, {'digits': 3})
+        self.assertEqual(models.DataSourceSymbol.objects.get(symbol__name='Symbol6').symbol_info_dict, {'digits': 5})
+
     @patch('pricedata.datasource.DataSourceImplementation')
     def test_retrieve_prices(self, mock):
         # Create some mock prices in a dataframe
@@ -225,6 +278,170 @@ class TasksTest(TestCase):
         candles = models.Candle.objects.all()
         self.assertEquals(len(candles), 5)
 
+    def test_save_candles(self):
+        """
+        Test that candles unchanged from those stored aren't saved again, and that new and changed candles are
+        """
+        ds = models.DataSource(name='test', pluginclass=self.plugin_class)
+        ds.save()
+        symbol = models.Symbol(name='TestSymbol')
+        symbol.save()
+        dss = models.DataSourceSymbol(datasource=ds, symbol=symbol)
+        dss.save()
+
+        start = datetime.datetime(2021, 1, 4, tzinfo=datetime.timezone.utc)
+        columns = ['time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high',
+                   'ask_low', 'ask_close', 'volume', 'datasource_symbol_id']
+        data = pd.DataFrame(columns=columns, data=[[start + timedelta(minutes=i), '1M', i + 0.1234567, i, i, i, i, i,
+                                                    i, i, 1, dss.id] for i in range(0, 5)])
+        self.assertEqual(len(tasks.save_candles(data).index), 5)
+
+        # The last candle has changed and there is a new one. Unchanged candles are dropped, including those that only
+        # differ beyond the precision stored.
+        data.loc[4, 'volume'] = 2
+        data.loc[0, 'bid_open'] += 0.0000001
+        data.loc[5] = [start + timedelta(minutes=5), '1M', 5, 5, 5, 5, 5, 5, 5, 5, 1, dss.id]
+        saved = tasks.save_candles(data)
+        self.assertEqual(list(saved['time']), [start + timedelta(minutes=4), start + timedelta(minutes=5)])
+        self.assertEqual(models.Candle.objects.count(), 6)
+        self.assertEqual(models.Candle.objects.get(time=start + timedelta(minutes=4)).volume, 2)
+
+    @patch('pricedata.datasource.DataSourceImplementation')
+    def test_derived_prices(self, mock):
+        """
+        Test that derived candle periods are aggregated from their base period whenever it is retrieved, and not
+        retrieved from the datasource
+        """
+        # 90 1M candles from midnight. Price is the minute.
+        columns = ['time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high',
+                   'ask_low', 'ask_close', 'volume']
+        start = datetime.datetime(2021, 1, 4, tzinfo=datetime.timezone.utc)
+        data = [[start + timedelta(minutes=i), '1M', i, i + 0.5, i - 0.5, i, i, i, i, i, 1] for i in range(0, 90)]
+
+        datasource_subclass_mock = MagicMock()
+        mock.instance.return_value = datasource_subclass_mock
+        datasource_subclass_mock.get_prices.return_value = pd.DataFrame(columns=columns, data=data)
+
+        # A 1M period, with 1H and 1D derived from it
+        ds = models.DataSource(name='test', pluginclass=self.plugin_class)
+        ds.save()
+        base = models.DataSourceCandlePeriod(datasource=ds, period='1M', start_from=start, active=True)
+        base.save()
+        hourly = models.DataSourceCandlePeriod(datasource=ds, period='1H', start_from=start, active=True,
+                                               derived_from=base)
+        hourly.save()
+        daily = models.DataSourceCandlePeriod(datasource=ds, period='1D', start_from=start, active=True,
+                                              derived_from=hourly)
+        daily.save()
+        symbol = models.Symbol(name='TestSymbol')
+        symbol.save()
+        models.DataSourceSymbol(datasource=ds, symbol=symbol, retrieve_price_data=True).save()
+
+        # 2 hourly candles, the second partial, and a daily candle
+        tasks.retrieve_prices(datasource_candleperiod_id=base.id)
+        candles = models.Candle.objects.filter(period='1H').order_by('time')
+        self.assertEqual(len(candles), 2)
+        self.assertEqual(candles[0].time, start)
+        self.assertEqual((candles[0].bid_open, candles[0].bid_high, candles[0].bid_low, candles[0].bid_close,
+                          candles[0].volume), (0, Decimal('59.5'), Decimal('-0.5'), 59, 60))
+        self.assertEqual((candles[1].bid_open, candles[1].bid_close, candles[1].volume), (60, 89, 30))
+        self.assertEqual(models.Candle.objects.get(period='1D').volume, 90)
+
+        # The next 30 minutes complete the second hourly candle
+        data = [[start + timedelta(minutes=i), '1M', i, i, i, i, i, i, i, i, 1] for i in range(90, 120)]
+        datasource_subclass_mock.get_prices.return_value = pd.DataFrame(columns=columns, data=data)
+        tasks.retrieve_prices(datasource_candleperiod_id=base.id)
+        candles = models.Candle.objects.filter(period='1H').order_by('time')
+        self.assertEqual(len(candles), 2)
+        self.assertEqual((candles[1].bid_open, candles[1].bid_close, candles[1].volume), (60, 119, 60))
+
+        # Derived periods are never retrieved from the datasource
+        tasks.retrieve_prices(datasource_candleperiod_id=hourly.id)
+        self.assertTrue(all(call[0][3] == '1M' for call in datasource_subclass_mock.get_prices.call_args_list))
+
+    @patch.object(datasource.DataSourceImplementation, 'instance')
+    def test_retrieve_prices_bulk(self, instance):
+        """
+        Test that prices are retrieved for all symbols in bulk, and that the default bulk implementation gets the prices
+        for each symbol, skipping symbols that prices aren't available for
+        """
+        class TestDataSource(datasource.DataSourceImplementation):
+            def get_prices(self, symbol, from_date, to_date, period, symbol_info=None):
+                if symbol == 'Symbol0':
+                    raise datasource.DataNotAvailableException('test', symbol, period, from_date, to_date)
+                return pd.DataFrame({'time': [from_date + timedelta(minutes=i) for i in range(0, 3)],
+                                     'period': period, 'bid_open': 1, 'bid_high': 1, 'bid_low': 1, 'bid_close': 1,
+                                     'ask_open': 1, 'ask_high': 1, 'ask_low': 1, 'ask_close': 1,
+                                     'volume': symbol_info['volume']})
+
+        ds = models.DataSource(name='test', pluginclass=self.plugin_class)
+        ds.save()
+        instance.return_value = TestDataSource(ds)
+        dscp = models.DataSourceCandlePeriod(datasource=ds, period='1M', start_from=timezone.now(), active=True)
+        dscp.save()
+        for i in range(0, 5):
+            symbol = models.Symbol(name=f'Symbol{i}')
+            symbol.save()
+            models.DataSourceSymbol(datasource=ds, symbol=symbol, symbol_info=f'{{"volume": {i}}}').save()
+
+        with patch.object(TestDataSource, 'get_prices_bulk', autospec=True,
+                          side_effect=TestDataSource.get_prices_bulk) as get_prices_bulk:
+            tasks.retrieve_prices(datasource_candleperiod_id=dscp.id)
+            get_prices_bulk.assert_called_once()
+
+        # 3 candles for each symbol except the first, with the symbol info for the symbol
+        self.assertEqual(models.Candle.objects.count(), 12)
+        for i in range(1, 5):
+            self.assertEqual(set(models.Candle.objects.filter(datasource_symbol__symbol__name=f'Symbol{i}').
+                                 values_list('volume', flat=True)), {i})
+
+    @patch('pricedata.datasource.DataSourceImplementation')
+    def test_retrieve_prices_async(self, mock):
+        """
+        Test that prices are retrieved concurrently for all symbols from async datasources, and that prices not
+        available for a symbol don't prevent those for other symbols being saved
+        """
+        class TestAsyncDataSource(datasource.AsyncDataSourceImplementation):
+            running = 0
+            max_running = 0
+            opened = False
+
+            async def open(self):
+                self.opened = True
+
+            async def get_symbols(self):
+                return [{'symbol_name': f'Symbol{i}', 'instrument_type': 'FOREX'} for i in range(0, 50)]
+
+            async def get_prices(self, symbol, from_date, to_date, period, symbol_info=None):
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                await asyncio.sleep(0.05)
+                self.running -= 1
+                if symbol == 'Symbol0':
+                    raise datasource.DataNotAvailableException('test', symbol, period, from_date, to_date)
+                return pd.DataFrame({'time': [from_date], 'period': [period], 'bid_open': [1], 'bid_high': [1],
+                                     'bid_low': [1], 'bid_close': [1], 'ask_open': [1], 'ask_high': [1],
+                                     'ask_low': [1], 'ask_close': [1], 'volume': [1]})
+
+        ds = models.DataSource(name='test', pluginclass=self.plugin_class)
+        ds.save()
+        ds_instance = TestAsyncDataSource(ds)
+        mock.instance.return_value = ds_instance
+        dscp = models.DataSourceCandlePeriod(datasource=ds, period='1M', start_from=timezone.now(), active=True)
+        dscp.save()
+
+        tasks.retrieve_symbols(datasource_id=ds.id)
+        self.assertEqual(models.DataSourceSymbol.objects.filter(datasource=ds).count(), 50)
+
+        # 50 symbols retrieved concurrently take about as long as 1
+        with self.settings(ALGOBUILDER_PRICEDATA_ASYNC_CONCURRENCY=20):
+            start = time.perf_counter()
+            tasks.retrieve_prices(datasource_candleperiod_id=dscp.id)
+            self.assertLess(time.perf_counter() - start, 1)
+        self.assertTrue(ds_instance.opened)
+        self.assertEqual(ds_instance.max_running, 20)
+        self.assertEqual(models.Candle.objects.count(), 49)
+
     def test_summary_data(self):
         """
         Test that the summary data accurately reflects the candle data
@@ -293,3 +510,835 @@ class TasksTest(TestCase):
         # populated a price for every second.
         self.assertEquals(aggregations[1].num_candles, 60)
 
+
+# Tests for the candle window cache
+class CandleWindowCacheTests(TestCase):
+    def setUp(self) -> None:
+        # Create a plugin, datasource, 2 symbols and 100 1M candles for each
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        plugin_class.save()
+        ds = models.DataSource(name='test', pluginclass=plugin_class)
+        ds.save()
+
+        self.start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        self.dss = []
+        for name in ['EURUSD', 'GBPUSD']:
+            symbol = models.Symbol(name=name, instrument_type='FOREX')
+            symbol.save()
+            dss = models.DataSourceSymbol(datasource=ds, symbol=symbol)
+            dss.save()
+            self.dss.append(dss)
+            for i in range(0, 100):
+                models.Candle(datasource_symbol=dss, time=self.start + timedelta(minutes=i), period='1M', bid_open=i,
+                              bid_high=i, bid_low=i, bid_close=i, ask_open=i, ask_high=i, ask_low=i, ask_close=i,
+                              volume=i).save()
+
+        CandleWindowCache.clear()
+
+    def test_get(self):
+        """
+        Test that candles are read once, then extended with new and updated candles only
+        :return:
+        """
+        # Each read also reads the version of the cached windows from the invalidation cache, a database cache
+        with self.assertNumQueries(2):
+            candles = CandleWindowCache.get(self.dss[0].id, '1M', self.start + timedelta(minutes=50))
+        self.assertEqual(len(candles.index), 50)
+        self.assertEqual(candles['bid_close'].iloc[0], 50.0)
+
+        # A new candle and an update to the last candle
+        models.Candle(datasource_symbol=self.dss[0], time=self.start + timedelta(minutes=100), period='1M',
+                      bid_open=1, bid_high=1, bid_low=1, bid_close=1, ask_open=1, ask_high=1, ask_low=1, ask_close=1,
+                      volume=1).save()
+        models.Candle.objects.filter(datasource_symbol=self.dss[0], time=self.start + timedelta(minutes=99)).\
+            update(bid_close=1000)
+
+        # Read from the cache, extended with only the new and updated candles
+        with self.assertNumQueries(2):
+            candles = CandleWindowCache.get(self.dss[0].id, '1M', self.start + timedelta(minutes=60),
+                                            self.start + timedelta(minutes=100))
+        self.assertEqual(len(candles.index), 40)
+        self.assertEqual(candles['bid_close'].iloc[-1], 1000.0)
+        self.assertEqual(len(CandleWindowCache.get(self.dss[0].id, '1M', self.start + timedelta(minutes=60)).index),
+                         41)
+
+        # Reading from before the cached window reads it again
+        with self.assertNumQueries(3):
+            candles = CandleWindowCache.get(self.dss[0].id, '1M')
+        self.assertEqual(len(candles.index), 101)
+
+    def test_get_many(self):
+        """
+        Test that the candles for many datasource symbols are read together
+        :return:
+        """
+        with self.assertNumQueries(2):
+            windows = CandleWindowCache.get_many([(self.dss[0].id, '1M', None),
+                                                  (self.dss[1].id, '1M', self.start + timedelta(minutes=90))])
+        self.assertEqual(len(windows[(self.dss[0].id, '1M')].index), 100)
+        self.assertEqual(len(windows[(self.dss[1].id, '1M')].index), 10)
+
+
+# Tests for the datasource implementation interface
+class DataSourceImplementationTests(TestCase):
+    def setUp(self) -> None:
+        # A record for every minute of 10 days
+        self.start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        self.end = self.start + timedelta(days=10)
+        self.records = np.rec.fromarrays([pd.date_range(self.start, self.end, freq='1min', closed='left').asi8,
+                                          np.arange(0, 10 * 1440, dtype=float)], names=['time', 'value'])
+        self.windows = []
+
+    def fetch(self, window_from, window_to):
+        """
+        Mock fetch. The records between the from and to dates inclusive.
+        """
+        self.windows.append((window_from, window_to))
+        return self.records[(self.records['time'] >= pd.Timestamp(window_from).value) &
+                            (self.records['time'] <= pd.Timestamp(window_to).value)]
+
+    def test_fetch_batched(self):
+        """
+        Test that windows are fetched concurrently and concatenated in order, and that the window size adapts to the
+        rows returned
+        """
+        ds_instance = datasource.DataSourceImplementation(None)
+        data = ds_instance._fetch_batched(self.fetch, self.start, self.end, timedelta(hours=1), max_workers=3,
+                                          target_rows=720)
+        self.assertTrue((data == self.records).all())
+
+        # The first round of 3 hourly windows, then windows growing by up to 4 times each round to 12 hours
+        windows = sorted(self.windows)
+        self.assertEqual([end - start for start, end in windows[:3]], [timedelta(hours=1)] * 3)
+        self.assertEqual(windows[3][1] - windows[3][0], timedelta(hours=4))
+        self.assertEqual(max(end - start for start, end in windows), timedelta(hours=12))
+        self.assertTrue(all(windows[i + 1][0] == windows[i][1] + timedelta(milliseconds=1)
+                            for i in range(0, len(windows) - 1)))
+
+        # Exceptions raised fetching a window are raised
+        def unavailable(window_from, window_to):
+            raise datasource.DataNotAvailableException('test', 'EURUSD', '1M', window_from, window_to)
+        self.assertRaises(datasource.DataNotAvailableException, ds_instance._fetch_batched, unavailable, self.start,
+                          self.end, timedelta(hours=1))
+
+    def test_instance_pool(self):
+        """
+        Test that datasource instances are pooled, and created again when their datasource changes or they fail a
+        health check
+        """
+        class TestDataSource(datasource.DataSourceImplementation):
+            healthy = True
+
+            def __init__(self, ds):
+                super().__init__(ds)
+                self.shutdown_called = False
+
+            def check_health(self):
+                return self.healthy
+
+            def shutdown(self):
+                self.shutdown_called = True
+
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        plugin_class.save()
+        ds = models.DataSource(name='test', pluginclass=plugin_class, connection_params='{}')
+        ds.save()
+
+        datasource.DataSourceImplementation.clear()
+        self.addCleanup(datasource.DataSourceImplementation.clear)
+        with patch.object(plugin_models.PluginClass, 'plugin_class', new_callable=PropertyMock,
+                          return_value=TestDataSource):
+            # Reused, only querying when the datasource was last updated
+            instance = datasource.DataSourceImplementation.instance('test')
+            with self.assertNumQueries(1):
+                self.assertIs(datasource.DataSourceImplementation.instance('test'), instance)
+
+            # Created again when the datasource changes
+            ds.connection_params = "{'param': 1}"
+            ds.save()
+            changed = datasource.DataSourceImplementation.instance('test')
+            self.assertIsNot(changed, instance)
+            self.assertTrue(instance.shutdown_called)
+            self.assertEqual(changed._datasource.connection_params, "{'param': 1}")
+
+            # Created again when unhealthy, once the health check is due
+            changed.healthy = False
+            self.assertIs(datasource.DataSourceImplementation.instance('test'), changed)
+            with self.settings(ALGOBUILDER_PRICEDATA_DATASOURCE_HEALTH_CHECK_SECONDS=0):
+                reconnected = datasource.DataSourceImplementation.instance('test')
+            self.assertIsNot(reconnected, changed)
+            self.assertTrue(changed.shutdown_called)
+
+            # Created again when the datasource is changed without signals, as by another process
+            models.DataSource.objects.filter(id=ds.id).update(connection_params="{'param': 2}", updated=timezone.now())
+            updated = datasource.DataSourceImplementation.instance('test')
+            self.assertIsNot(updated, reconnected)
+            self.assertTrue(reconnected.shutdown_called)
+            self.assertEqual(updated._datasource.connection_params, "{'param': 2}")
+
+            # Discarded when the datasource is deleted
+            models.DataSource.objects.filter(id=ds.id).delete()
+            self.assertRaises(datasource.DataSourceInstanceNotImplementedError,
+                              datasource.DataSourceImplementation.instance, 'test')
+            self.assertTrue(updated.shutdown_called)
+
+
+# Tests for tick storage
+@override_settings(ALGOBUILDER_PRICEDATA_TICK_WINDOW='1H')
+class TickStoreTests(TestCase):
+    def setUp(self) -> None:
+        # Create a plugin, datasource and symbol
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        self.plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        self.plugin_class.save()
+        self.ds = models.DataSource(name='test', pluginclass=self.plugin_class)
+        self.ds.save()
+        symbol = models.Symbol(name='EURUSD', instrument_type='FOREX')
+        symbol.save()
+        self.dss = models.DataSourceSymbol(datasource=self.ds, symbol=symbol, symbol_info='')
+        self.dss.save()
+
+        # A tick every 250ms for 4 hours, spanning the end of January. Price is the tick number.
+        self.start = datetime.datetime(2021, 1, 31, 22, tzinfo=datetime.timezone.utc)
+        self.ticks = pd.DataFrame({'time': pd.date_range(self.start, periods=4 * 3600 * 4, freq='250ms'),
+                                   'bid': np.arange(0, 4 * 3600 * 4, dtype=float)})
+        self.ticks['ask'] = self.ticks['bid'] + 0.5
+
+    def get_ticks(self, symbol, from_date, to_date, symbol_info=None):
+        """
+        Mock get_ticks. The ticks between the from and to dates inclusive.
+        """
+        return self.ticks[(self.ticks['time'] >= from_date) & (self.ticks['time'] <= to_date)]
+
+    def test_save_and_get(self):
+        """
+        Test that ticks are stored in monthly partitions, and that storing ticks replaces those already stored for the
+        time range
+        """
+        end = self.start + timedelta(hours=4)
+        TickStore.save(self.dss.id, self.ticks, self.start, end)
+        ticks = TickStore.get(self.dss.id, self.start, end)
+        self.assertEqual(len(ticks.index), len(self.ticks.index))
+        self.assertTrue((ticks.index == pd.DatetimeIndex(self.ticks['time'])).all())
+        self.assertTrue((ticks['bid'].to_numpy() == self.ticks['bid'].to_numpy()).all())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT inhrelid::regclass::text FROM pg_inherits "
+                           "WHERE inhparent = 'pricedata_tick'::regclass ORDER BY 1")
+            self.assertEqual([row[0] for row in cursor.fetchall()], ['pricedata_tick_202101', 'pricedata_tick_202102'])
+
+        # Replace the ticks for an hour with 1 tick
+        replace_from = self.start + timedelta(hours=1)
+        TickStore.save(self.dss.id, self.ticks[self.ticks['time'] == replace_from], replace_from,
+                       replace_from + timedelta(hours=1))
+        self.assertEqual(len(TickStore.get(self.dss.id, self.start, end).index), len(self.ticks.index) - 3600 * 4 + 1)
+
+    def test_retrieve(self):
+        """
+        Test that ticks are only ever retrieved once, a window at a time
+        """
+        ds_instance = MagicMock()
+        ds_instance.get_ticks.side_effect = self.get_ticks
+
+        # 2 hourly windows
+        TickStore.retrieve(ds_instance, self.dss, self.start + timedelta(hours=1), self.start + timedelta(hours=3))
+        self.assertEqual(ds_instance.get_ticks.call_count, 2)
+        self.assertEqual((self.dss.ticks_from, self.dss.ticks_to),
+                         (self.start + timedelta(hours=1), self.start + timedelta(hours=3)))
+
+        # Only the hours before and after those retrieved are retrieved
+        ds_instance.get_ticks.reset_mock()
+        TickStore.retrieve(ds_instance, self.dss, self.start, self.start + timedelta(hours=4))
+        self.assertEqual([call[0][1:3] for call in ds_instance.get_ticks.call_args_list],
+                         [(self.start, self.start + timedelta(hours=1)),
+                          (self.start + timedelta(hours=3), self.start + timedelta(hours=4))])
+        self.assertEqual(models.Tick.objects.filter(datasource_symbol=self.dss).count(), len(self.ticks.index))
+
+    @patch('pricedata.datasource.DataSourceImplementation')
+    def test_retrieve_prices_from_ticks(self, mock):
+        """
+        Test that candle periods built from ticks share the stored ticks, which are retrieved from the datasource once,
+        and that the candles built are complete
+        """
+        datasource_subclass_mock = MagicMock()
+        mock.instance.return_value = datasource_subclass_mock
+        datasource_subclass_mock.get_ticks.side_effect = self.get_ticks
+        to_date = self.start + timedelta(hours=2, milliseconds=2500)
+
+        periods = []
+        for period in ['1S', '5S']:
+            dscp = models.DataSourceCandlePeriod(datasource=self.ds, period=period, start_from=self.start, active=True,
+                                                 from_ticks=True)
+            dscp.save()
+            periods.append(dscp)
+
+        with patch('django.utils.timezone.now', return_value=to_date):
+            for dscp in periods:
+                tasks.retrieve_prices(datasource_candleperiod_id=dscp.id)
+
+        # Ticks retrieved once, for 2 hourly windows and the part of the third up to now
+        self.assertEqual(datasource_subclass_mock.get_ticks.call_count, 3)
+        datasource_subclass_mock.get_prices.assert_not_called()
+
+        # Complete candles only. The 1S candle at 2:00:02 is complete, the 5S candle at 2:00:00 isn't.
+        candles = models.Candle.objects.filter(period='1S').order_by('time')
+        self.assertEqual(len(candles), 2 * 3600 + 2)
+        self.assertEqual((candles[0].bid_open, candles[0].bid_high, candles[0].bid_close, candles[0].volume),
+                         (0, 3, 3, 4))
+        self.assertEqual(models.Candle.objects.filter(period='5S').count(), 2 * 3600 / 5)
+
+        # The next run builds the candles from the end of the last candle
+        with patch('django.utils.timezone.now', return_value=to_date + timedelta(seconds=5)):
+            tasks.retrieve_prices(datasource_candleperiod_id=periods[1].id)
+        candle = models.Candle.objects.filter(period='5S').latest('time')
+        self.assertEqual((candle.time, candle.bid_open, candle.volume), (self.start + timedelta(hours=2), 28800, 20))
+
+
+# Tests for tick and candle aggregation
+class AggregationTests(TestCase):
+    def setUp(self) -> None:
+        # 100,000 random ticks over about 3 weeks
+        rng = np.random.default_rng(0)
+        times = np.datetime64('2021-01-28T00:00:00', 'ns') + \
+            np.cumsum(rng.exponential(20000, 100000)).astype('timedelta64[ms]')
+        bids = 1.2 + np.cumsum(rng.normal(0, 0.0001, 100000))
+        self.ticks = pd.DataFrame({'bid': bids, 'ask': bids + 0.0002}, index=pd.DatetimeIndex(times, tz='UTC'))
+
+    def test_tick_aggregation(self):
+        """
+        Test that ticks aggregated for many periods are the same as resampling them with pandas
+        """
+        periods = ['1S', '5S', '1M', '1H', '1D', '1W', '1MO']
+        candles = TickAggregator.aggregate(self.ticks.index.asi8, self.ticks['bid'].to_numpy(),
+                                           self.ticks['ask'].to_numpy(), periods)
+
+        rules = {'1S': '1S', '5S': '5S', '1M': '1min', '1H': '1H', '1D': '1D', '1W': 'W-MON', '1MO': 'MS'}
+        for period in periods:
+            resampled = self.ticks['bid'].resample(rules[period], closed='left', label='left').\
+                agg(['first', 'max', 'min', 'last', 'count']).dropna()
+            self.assertTrue((candles[period]['time'].to_numpy() == resampled.index.to_numpy()).all(), period)
+            self.assertTrue(np.allclose(candles[period][['bid_open', 'bid_high', 'bid_low', 'bid_close', 'volume']].
+                                        to_numpy(dtype=float), resampled.to_numpy(dtype=float)), period)
+            self.assertTrue(np.allclose(candles[period]['ask_close'] - candles[period]['bid_close'], 0.0002))
+
+    def test_partial_candles(self):
+        """
+        Test that trailing candles that aren't complete are not returned when the time that ticks are complete to is
+        provided
+        """
+        complete_to = self.ticks.index[-1].floor('1H')
+        args = (self.ticks.index.asi8, self.ticks['bid'].to_numpy(), self.ticks['ask'].to_numpy(), ['1M', '1H'])
+        all_candles = TickAggregator.aggregate(*args)
+        candles = TickAggregator.aggregate(*args, complete_to=complete_to.value)
+
+        # Only the candles that closed by the complete to time are returned, and these are unchanged
+        for period, length in [('1M', timedelta(minutes=1)), ('1H', timedelta(hours=1))]:
+            expected = all_candles[period][all_candles[period]['time'] + length <= complete_to]
+            self.assertLess(len(candles[period].index), len(all_candles[period].index))
+            pd.testing.assert_frame_equal(candles[period].reset_index(drop=True), expected.reset_index(drop=True))
+        self.assertEqual(candles['1H']['time'].iloc[-1], complete_to - timedelta(hours=1))
+
+    def test_can_derive(self):
+        """
+        Test which periods can be derived from which
+        """
+        self.assertTrue(CandleAggregator.can_derive('1H', '1M'))
+        self.assertTrue(CandleAggregator.can_derive('15M', '5M'))
+        self.assertFalse(CandleAggregator.can_derive('15M', '10M'))
+        self.assertFalse(CandleAggregator.can_derive('1M', '1H'))
+        self.assertTrue(CandleAggregator.can_derive('1MO', '1D'))
+        self.assertFalse(CandleAggregator.can_derive('1MO', '1W'))
+
+
+# Tests for gap detection and repair
+class GapTests(TestCase):
+    def setUp(self) -> None:
+        # Create a plugin, datasource and symbol, with a 1M candle period and a 1H candle period derived from it
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        plugin_class.save()
+        self.ds = models.DataSource(name='test', pluginclass=plugin_class)
+        self.ds.save()
+        symbol = models.Symbol(name='EURUSD', instrument_type='FOREX')
+        symbol.save()
+        self.dss = models.DataSourceSymbol(datasource=self.ds, symbol=symbol, symbol_info='',
+                                           retrieve_price_data=True)
+        self.dss.save()
+
+        self.start = datetime.datetime(2021, 1, 4, tzinfo=datetime.timezone.utc)
+        self.base = models.DataSourceCandlePeriod(datasource=self.ds, period='1M', start_from=self.start, active=True)
+        self.base.save()
+        models.DataSourceCandlePeriod(datasource=self.ds, period='1H', start_from=self.start, active=True,
+                                      derived_from=self.base).save()
+
+        # 2 hours of 1M candles from Monday midnight, with 00:30 to 00:39 missing
+        self.columns = ['time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high',
+                        'ask_low', 'ask_close', 'volume']
+        candles = self.candles([i for i in range(0, 120) if not 30 <= i < 40])
+        candles['datasource_symbol_id'] = self.dss.id
+        DatabaseUtility.bulk_insert_or_update(data=candles, table=models.Candle.objects.model._meta.db_table,
+                                              unique_fields=['datasource_symbol_id', 'time', 'period'])
+
+    def candles(self, minutes):
+        """
+        1M candles for the minutes from the start. Price is the minute.
+        """
+        return pd.DataFrame(columns=self.columns,
+                            data=[[self.start + timedelta(minutes=i), '1M', i, i, i, i, i, i, i, i, 1]
+                                  for i in minutes])
+
+    @override_settings(ALGOBUILDER_PRICEDATA_MARKET_CLOSED=('Fri 22:00', 'Sun 22:00'))
+    def test_find(self):
+        """
+        Test that gaps are found while the market is open only, and that long gaps are split
+        """
+        # Hourly for a week from Monday, without the weekend closure from Friday 22:00 to Sunday 22:00, and with
+        # Wednesday 10:00 and 11:00 missing.
+        times = pd.date_range(self.start, periods=7 * 24, freq='1H')
+        times = times[((times.dayofweek < 4) | ((times.dayofweek == 4) & (times.hour < 22)) |
+                       ((times.dayofweek == 6) & (times.hour >= 22))) &
+                      ~((times.dayofweek == 2) & times.hour.isin([10, 11]))]
+
+        wednesday = pd.Timestamp('2021-01-06 10:00', tz='UTC')
+        self.assertEqual(GapDetector.find(times.asi8, '1H'),
+                         [(wednesday.value, (wednesday + pd.Timedelta(hours=2)).value, 2)])
+        self.assertEqual(GapDetector.find(times.asi8, '1H', max_candles=1),
+                         [(wednesday.value, (wednesday + pd.Timedelta(hours=1)).value, 1),
+                          ((wednesday + pd.Timedelta(hours=1)).value, (wednesday + pd.Timedelta(hours=2)).value, 1)])
+
+        # Without the closure, the weekend is missing too
+        with override_settings(ALGOBUILDER_PRICEDATA_MARKET_CLOSED=None):
+            self.assertEqual(sum(gap[2] for gap in GapDetector.find(times.asi8, '1H')), 2 + 48)
+
+        # A gap spanning the weekend closure is split either side of it
+        friday, sunday = pd.Timestamp('2021-01-08 20:00', tz='UTC'), pd.Timestamp('2021-01-10 22:00', tz='UTC')
+        self.assertEqual(GapDetector.find(np.array([(friday - pd.Timedelta(hours=1)).value,
+                                                    (sunday + pd.Timedelta(hours=4)).value]), '1H'),
+                         [(friday.value, (friday + pd.Timedelta(hours=2)).value, 2),
+                          (sunday.value, (sunday + pd.Timedelta(hours=4)).value, 4)])
+
+        # Long gaps in short periods are found without enumerating the missing candles
+        year = pd.Timedelta(days=365).value
+        with override_settings(ALGOBUILDER_PRICEDATA_MARKET_CLOSED=None):
+            self.assertEqual(GapDetector.find(np.array([0, year]), '1S', max_candles=year),
+                             [(10**9, year, year // 10**9 - 1)])
+
+    @patch.object(tasks.repair_gap, 'delay')
+    def test_detect_gaps(self, delay):
+        """
+        Test that gaps are recorded once, only checked from when they were last checked, and that repairs are scheduled
+        """
+        tasks.detect_gaps(self.base.id)
+        gap = models.CandleGap.objects.get()
+        self.assertEqual((gap.from_date, gap.to_date, gap.missing, gap.status),
+                         (self.start + timedelta(minutes=30), self.start + timedelta(minutes=40), 10,
+                          models.CandleGap.STATUS_OPEN))
+        delay.assert_called_once_with(gap.id)
+
+        # A gap after the last check, spanning the last candle checked
+        self.base.refresh_from_db()
+        self.assertIsNotNone(self.base.gaps_checked)
+        candles = self.candles([125])
+        candles['datasource_symbol_id'] = self.dss.id
+        DatabaseUtility.bulk_insert_or_update(data=candles, table=models.Candle.objects.model._meta.db_table,
+                                              unique_fields=['datasource_symbol_id', 'time', 'period'])
+        models.DataSourceCandlePeriod.objects.filter(id=self.base.id).update(
+            gaps_checked=self.start + timedelta(minutes=121))
+        tasks.detect_gaps(self.base.id)
+        self.assertEqual(list(models.CandleGap.objects.order_by('from_date').values_list('from_date', 'missing')),
+                         [(self.start + timedelta(minutes=30), 10), (self.start + timedelta(minutes=120), 5)])
+
+    def test_detect_from_first_candle(self):
+        """
+        Test that gaps are only found from the first candle, not the start from date, and that periods shorter than the
+        minimum gap period aren't checked unless configured
+        """
+        self.base.start_from = self.start - timedelta(days=7)
+        self.base.save()
+        self.assertEqual(GapDetector.detect(self.base), 1)
+        self.assertEqual(models.CandleGap.objects.get().from_date, self.start + timedelta(minutes=30))
+
+        self.assertFalse(GapDetector.checked('1S'))
+        self.assertTrue(GapDetector.checked('1M'))
+        with override_settings(ALGOBUILDER_PRICEDATA_GAP_MIN_PERIOD='1S'):
+            self.assertTrue(GapDetector.checked('1S'))
+
+    @patch.object(datasource.DataSourceImplementation, 'instance')
+    def test_repair_gap(self, instance):
+        """
+        Test that gaps are repaired from the datasource, with only the derived candles for the gap derived again, and
+        that gaps the datasource doesn't have candles for are marked unavailable after the maximum attempts
+        """
+        GapDetector.detect(self.base)
+        gap = models.CandleGap.objects.get()
+
+        # Datasource has the missing candles, and a candle either side of them
+        instance.return_value = MagicMock()
+        instance.return_value.get_prices.return_value = self.candles(range(29, 41))
+        tasks.repair_gap(gap.id)
+
+        gap.refresh_from_db()
+        self.assertEqual((gap.status, gap.attempts), (models.CandleGap.STATUS_REPAIRED, 1))
+        self.assertEqual(models.Candle.objects.filter(period='1M').count(), 120)
+        self.assertEqual(list(models.Candle.objects.filter(period='1H').values_list('time', 'volume')),
+                         [(self.start, 60)])
+
+        # Datasource doesn't have the candles
+        gap = models.CandleGap(datasource_symbol=self.dss, period='1M', from_date=self.start - timedelta(minutes=5),
+                               to_date=self.start, missing=5)
+        gap.save()
+        instance.return_value.get_prices.return_value = pd.DataFrame(columns=self.columns)
+        for attempt in range(0, 3):
+            tasks.repair_gap(gap.id)
+        gap.refresh_from_db()
+        self.assertEqual((gap.status, gap.attempts), (models.CandleGap.STATUS_UNAVAILABLE, 3))
+
+
+# Tests for trading sessions. Symbols without sessions are closed at the weekend, as forex is.
+@override_settings(ALGOBUILDER_PRICEDATA_MARKET_CLOSED=('Fri 22:00', 'Sun 22:00'))
+class TradingCalendarTests(TestCase):
+    def setUp(self) -> None:
+        # A stock with its own session, another stock and a forex symbol. Stocks trade 14:30 to 21:00 on weekdays.
+        self.stock = models.Symbol(name='AAPL', instrument_type='STOCK')
+        self.stock.save()
+        self.other_stock = models.Symbol(name='MSFT', instrument_type='STOCK')
+        self.other_stock.save()
+        self.forex = models.Symbol(name='EURUSD', instrument_type='FOREX')
+        self.forex.save()
+        for day in range(0, 5):
+            models.TradingSession(instrument_type='STOCK', open_day=day, open_time=datetime.time(14, 30),
+                                  close_day=day, close_time=datetime.time(21)).save()
+        models.TradingSession(symbol=self.stock, open_day=0, open_time=datetime.time(9), close_day=0,
+                              close_time=datetime.time(17)).save()
+
+        # Monday midnight
+        self.monday = pd.Timestamp('2021-01-04', tz='UTC')
+
+    def hours(self, *hours):
+        """
+        Times in int64 ns for the hours from Monday midnight
+        """
+        return np.array([(self.monday + pd.Timedelta(hours=hour)).value for hour in hours])
+
+    def test_open_during(self):
+        """
+        Test that symbol sessions override instrument type sessions, which override the default sessions, and that
+        ranges are open if they overlap any session
+        """
+        sessions = TradingCalendar.sessions([self.stock, self.other_stock, self.forex])
+
+        # Monday 09:00 to 10:00, 14:00 to 15:00, Tuesday 15:00 to 16:00
+        starts = self.hours(9, 14, 24 + 15)
+        ends = starts + period_ns['1H']
+        self.assertEqual(TradingCalendar.open_during(starts, ends, sessions[self.stock.id]).tolist(),
+                         [True, True, False])
+        self.assertEqual(TradingCalendar.open_during(starts, ends, sessions[self.other_stock.id]).tolist(),
+                         [False, True, True])
+
+        # Forex is closed from Friday 22:00 to Sunday 22:00, including the daily candle for Saturday. Sunday's daily
+        # candle is expected, as the market opens during it.
+        starts = self.hours(4 * 24 + 21, 4 * 24 + 22, 5 * 24, 6 * 24)
+        ends = starts + np.array([period_ns['1H'], period_ns['1H'], period_ns['1D'], period_ns['1D']])
+        self.assertEqual(TradingCalendar.open_during(starts, ends, sessions[self.forex.id]).tolist(),
+                         [True, False, False, True])
+
+        # A week or more is always open
+        self.assertTrue(TradingCalendar.open_during(self.hours(5 * 24), self.hours(12 * 24),
+                                                    sessions[self.forex.id])[0])
+
+        # Without a market closure, symbols without sessions, e.g. crypto, are always open
+        with override_settings(ALGOBUILDER_PRICEDATA_MARKET_CLOSED=None):
+            sessions = TradingCalendar.sessions([self.forex])
+            self.assertTrue(TradingCalendar.open_during(starts, ends, sessions[self.forex.id]).all())
+
+    @patch.object(datasource.DataSourceImplementation, 'instance')
+    def test_retrieve_prices_market_closed(self, instance):
+        """
+        Test that prices aren't retrieved while the market has been closed since the last candle
+        """
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        plugin_class.save()
+        ds = models.DataSource(name='test', pluginclass=plugin_class)
+        ds.save()
+        dss = models.DataSourceSymbol(datasource=ds, symbol=self.forex, symbol_info='', retrieve_price_data=True)
+        dss.save()
+        dscp = models.DataSourceCandlePeriod(datasource=ds, period='1M', start_from=self.monday, active=True)
+        dscp.save()
+
+        # The last candle before the market closed on Friday
+        friday = self.monday + pd.Timedelta(days=4, hours=21, minutes=59)
+        models.Candle(datasource_symbol=dss, time=friday, period='1M', bid_open=1, bid_high=1, bid_low=1, bid_close=1,
+                      ask_open=1, ask_high=1, ask_low=1, ask_close=1, volume=1).save()
+
+        # Retrieved once after the market closes, to complete the last candle, then not until it opens
+        instance.return_value = MagicMock()
+        with patch('django.utils.timezone.now', return_value=friday + pd.Timedelta(seconds=90)):
+            tasks.retrieve_prices(dscp.id)
+        instance.assert_called_once()
+        instance.reset_mock()
+        for minutes in [3, 60, 24 * 60]:
+            with patch('django.utils.timezone.now', return_value=friday + pd.Timedelta(minutes=minutes)):
+                tasks.retrieve_prices(dscp.id)
+        instance.assert_not_called()
+
+        with patch('django.utils.timezone.now', return_value=friday + pd.Timedelta(days=2, minutes=5)):
+            tasks.retrieve_prices(dscp.id)
+        instance.assert_called_once()
+
+
+# Tests for adaptive scheduling of price retrieval
+class RetrievalSchedulerTests(TestCase):
+    def setUp(self) -> None:
+        # Create a plugin, datasource and 1M candle period
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        plugin_class.save()
+        self.ds = models.DataSource(name='test', pluginclass=plugin_class)
+        self.ds.save()
+        self.now = datetime.datetime(2021, 1, 4, 10, 0, 30, tzinfo=datetime.timezone.utc)
+        self.dscp = models.DataSourceCandlePeriod(datasource=self.ds, period='1M', start_from=self.now, active=True)
+        self.dscp.save()
+
+    def reschedule(self, last_times, retrieved_times, period='1M'):
+        """
+        Reschedules at now, returning the next retrieval and the refreshed datasource candle period
+        """
+        dscp = models.DataSourceCandlePeriod.objects.get(datasource=self.ds, period=period)
+        with patch('django.utils.timezone.now', return_value=self.now):
+            next_retrieval = RetrievalScheduler.reschedule(dscp, 2.0, last_times, retrieved_times)
+        dscp.refresh_from_db()
+        return next_retrieval, dscp
+
+    def test_claim(self):
+        """
+        Test that a scheduled retrieval can only be claimed once until it is due again
+        """
+        with patch('django.utils.timezone.now', return_value=self.now):
+            self.assertTrue(RetrievalScheduler.claim(self.dscp))
+            self.assertFalse(RetrievalScheduler.claim(self.dscp))
+        with patch('django.utils.timezone.now', return_value=self.now + timedelta(hours=1)):
+            self.assertTrue(RetrievalScheduler.claim(self.dscp))
+
+    def test_reschedule(self):
+        """
+        Test that retrievals are scheduled just after the next candle closes, back off while idle and run immediately
+        while catching up
+        """
+        minute = self.now.replace(second=0)
+
+        # A new candle. Next retrieval just after the next candle closes, as the minimum interval is 10s.
+        next_retrieval, dscp = self.reschedule({1: minute - timedelta(minutes=2)}, {1: minute - timedelta(minutes=1)})
+        self.assertTrue(minute + timedelta(minutes=1, seconds=1) <= next_retrieval <=
+                        minute + timedelta(minutes=1, seconds=3))
+        self.assertEqual((dscp.next_retrieval, dscp.retrieval_seconds, dscp.idle_retrievals), (next_retrieval, 2.0, 0))
+
+        # No new candles. Backs off by 1 candle, then 3, up to the maximum backoff of 5 minutes.
+        last = {1: minute - timedelta(minutes=1)}
+        for idle_retrievals, candles in [(1, 2), (2, 4), (3, 6), (4, 6)]:
+            next_retrieval, dscp = self.reschedule(last, last)
+            self.assertEqual(dscp.idle_retrievals, idle_retrievals)
+            self.assertEqual(next_retrieval.replace(second=0, microsecond=0), minute + timedelta(minutes=candles))
+
+        # New candles, but still behind
+        next_retrieval, dscp = self.reschedule({1: minute - timedelta(minutes=60)}, {1: minute - timedelta(minutes=30)})
+        self.assertEqual((next_retrieval, dscp.idle_retrievals), (self.now, 0))
+
+        # Daily candles are left to the periodic task
+        models.DataSourceCandlePeriod(datasource=self.ds, period='1D', start_from=self.now, active=True).save()
+        next_retrieval, dscp = self.reschedule({}, {}, period='1D')
+        self.assertIsNone(next_retrieval)
+        self.assertEqual(dscp.next_retrieval.date(), datetime.date(2021, 1, 5))
+
+    @patch.object(datasource.DataSourceImplementation, 'instance')
+    def test_scheduled_retrieval(self, instance):
+        """
+        Test that scheduled retrievals only retrieve prices when they are due, and schedule the next retrieval
+        """
+        symbol = models.Symbol(name='EURUSD', instrument_type='FOREX')
+        symbol.save()
+        models.DataSourceSymbol(datasource=self.ds, symbol=symbol, symbol_info='', retrieve_price_data=True).save()
+        instance.return_value = MagicMock()
+
+        models.DataSourceCandlePeriod.objects.filter(id=self.dscp.id).update(
+            next_retrieval=timezone.now() + timedelta(minutes=1))
+        tasks.retrieve_prices(self.dscp.id, scheduled=True)
+        instance.assert_not_called()
+
+        models.DataSourceCandlePeriod.objects.filter(id=self.dscp.id).update(next_retrieval=None)
+        with patch.object(tasks.retrieve_prices, 'apply_async') as apply_async:
+            tasks.retrieve_prices(self.dscp.id, scheduled=True)
+        instance.assert_called_once()
+        self.dscp.refresh_from_db()
+        apply_async.assert_called_once_with(args=[self.dscp.id], kwargs={'scheduled': True},
+                                            eta=self.dscp.next_retrieval)
+
+
+# Tests for the shared memory candle store
+@override_settings(ALGOBUILDER_CANDLE_SHARED_MEMORY=True, ALGOBUILDER_CANDLE_SHARED_ROWS=5)
+class SharedCandleStoreTests(TestCase):
+    def setUp(self) -> None:
+        # Create a plugin, datasource and symbol
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        plugin_class.save()
+        ds = models.DataSource(name='test', pluginclass=plugin_class)
+        ds.save()
+        symbol = models.Symbol(name='EURUSD', instrument_type='FOREX')
+        symbol.save()
+        self.dss = models.DataSourceSymbol(datasource=ds, symbol=symbol)
+        self.dss.save()
+
+        self.start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        CandleWindowCache.clear()
+
+    def tearDown(self) -> None:
+        SharedCandleStore.remove(self.dss.id, '1M')
+
+    def candles(self, minutes, value):
+        """
+        Returns a dataframe of 1M candles at the minutes after the start with all fields set to value
+        """
+        data = pd.DataFrame({'time': [self.start + timedelta(minutes=minute) for minute in minutes]})
+        for field in ['bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high', 'ask_low', 'ask_close',
+                      'volume']:
+            data[field] = float(value)
+
+        return data.assign(datasource_symbol_id=self.dss.id, period='1M')
+
+    def ns(self, minute):
+        """
+        Returns the time of the minute after the start in int64 ns
+        """
+        return pd.Timestamp(self.start + timedelta(minutes=minute)).value
+
+    def test_append(self):
+        """
+        Test that candles are appended, replaced and wrap around the ring buffer, and that reads from before the oldest
+        candle held miss
+        """
+        self.assertIsNone(SharedCandleStore.get(self.dss.id, '1M', self.ns(0)))
+
+        SharedCandleStore.append(self.candles(range(0, 3), 1))
+        times, values = SharedCandleStore.get(self.dss.id, '1M', self.ns(1))
+        self.assertListEqual(list(times), [self.ns(1), self.ns(2)])
+        self.assertEqual(values.shape, (2, 9))
+
+        # Replace the last candle and add 3 more, wrapping around and dropping the oldest 2
+        SharedCandleStore.append(self.candles(range(2, 6), 2))
+        self.assertIsNone(SharedCandleStore.get(self.dss.id, '1M', self.ns(0)))
+        times, values = SharedCandleStore.get(self.dss.id, '1M', self.ns(1), self.ns(5))
+        self.assertListEqual(list(times), [self.ns(1), self.ns(2), self.ns(3), self.ns(4)])
+        self.assertListEqual(list(values[:, 0]), [1.0, 2.0, 2.0, 2.0])
+
+        # Candles older than the oldest held aren't written
+        SharedCandleStore.append(self.candles([0], 3))
+        self.assertIsNone(SharedCandleStore.get(self.dss.id, '1M', self.ns(0)))
+
+    def test_get_many(self):
+        """
+        Test that candles saved by price retrieval are read from shared memory, and from the database if not held
+        """
+        tasks.save_candles(self.candles(range(0, 5), 1))
+
+        with self.assertNumQueries(0):
+            windows = CandleWindowCache.get_many([(self.dss.id, '1M', self.start + timedelta(minutes=2))])
+        candles = windows[(self.dss.id, '1M')]
+        self.assertEqual(len(candles.index), 3)
+        self.assertEqual(candles.index[0], pd.Timestamp(self.start + timedelta(minutes=2)))
+        self.assertEqual(candles['bid_close'].iloc[-1], 1.0)
+
+        with self.assertNumQueries(2):
+            windows = CandleWindowCache.get_many([(self.dss.id, '1M', None)])
+        self.assertEqual(len(windows[(self.dss.id, '1M')].index), 5)
+
+
+# Tests for the memory mapped candle files
+class CandleFileCacheTests(TestCase):
+    def setUp(self) -> None:
+        # Create a plugin, datasource, symbol and 100 1M candles, and a directory for the files
+        plugin = plugin_models.Plugin(module_filename='testfilename.py', requirements_file='testfilename.txt')
+        plugin.save()
+        plugin_class = plugin_models.PluginClass(plugin=plugin, name="TestClassName", plugin_type="TestType")
+        plugin_class.save()
+        ds = models.DataSource(name='test', pluginclass=plugin_class)
+        ds.save()
+        symbol = models.Symbol(name='EURUSD', instrument_type='FOREX')
+        symbol.save()
+        self.dss = models.DataSourceSymbol(datasource=ds, symbol=symbol)
+        self.dss.save()
+
+        self.start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        for i in range(0, 100):
+            models.Candle(datasource_symbol=self.dss, time=self.start + timedelta(minutes=i), period='1M', bid_open=i,
+                          bid_high=i, bid_low=i, bid_close=i, ask_open=i, ask_high=i, ask_low=i, ask_close=i,
+                          volume=i).save()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(ALGOBUILDER_CANDLE_FILE_DIR=self.directory.name)
+        self.settings.enable()
+
+    def tearDown(self) -> None:
+        self.settings.disable()
+        self.directory.cleanup()
+
+    def test_get(self):
+        """
+        Test that candles are read from the database once, then only the ranges not in the files are read
+        """
+        with self.assertNumQueries(2):
+            candles = CandleFileCache.get('test', 'EURUSD', '1M', self.start + timedelta(minutes=20),
+                                          self.start + timedelta(minutes=40))
+        self.assertEqual(len(candles.index), 20)
+        self.assertEqual(candles['bid_close'].iloc[0], 20.0)
+
+        # Candles already in the files aren't read again
+        with self.assertNumQueries(0):
+            times, values = CandleFileCache.load(self.dss.id, '1M', self.start + timedelta(minutes=25),
+                                                 self.start + timedelta(minutes=35))
+        self.assertEqual(len(times), 10)
+        self.assertIsInstance(values, np.memmap)
+
+        # Only the missing ranges either side are read
+        with CaptureQueriesContext(connection) as queries:
+            times, values = CandleFileCache.load(self.dss.id, '1M', self.start + timedelta(minutes=10),
+                                                 self.start + timedelta(minutes=50))
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertListEqual(list(values[:, 0]), [float(i) for i in range(10, 50)])
+        self.assertListEqual(CandleFileCache.ranges(self.dss.id, '1M'),
+                             [(self.start + timedelta(minutes=10), self.start + timedelta(minutes=50))])
+
+        # Changes to the candles returned aren't written to the files
+        values[0, 0] = -1
+        times, values = CandleFileCache.load(self.dss.id, '1M', self.start + timedelta(minutes=10),
+                                             self.start + timedelta(minutes=11))
+        self.assertEqual(values[0, 0], 10.0)
+
+        # Cleared files are read again
+        CandleFileCache.clear(self.dss.id, '1M')
+        self.assertListEqual(CandleFileCache.ranges(self.dss.id, '1M'), [])
+
+    @patch('django.utils.timezone.now')
+    def test_current_candle(self, now):
+        """
+        Test that the current candle is read from the database until it is complete
+        """
+        now.return_value = self.start + timedelta(minutes=99, seconds=30)
+        CandleFileCache.load(self.dss.id, '1M', self.start + timedelta(minutes=90))
+        self.assertListEqual(CandleFileCache.ranges(self.dss.id, '1M'),
+                             [(self.start + timedelta(minutes=90), self.start + timedelta(minutes=99))])
+
+        models.Candle.objects.filter(datasource_symbol=self.dss, time=self.start + timedelta(minutes=99)).\
+            update(bid_open=1000)
+        now.return_value = self.start + timedelta(minutes=100, seconds=30)
+        times, values = CandleFileCache.load(self.dss.id, '1M', self.start + timedelta(minutes=90))
+        self.assertEqual(len(times), 10)
+        self.assertEqual(values[-1, 0], 1000.0)
@@ -0,0 +1,179 @@
+"""
+Storage of the ticks retrieved from datasources. Ticks are retrieved once, stored in a table partitioned by month and
+bulk loaded using COPY. Candles for periods that are built from ticks are aggregated from the stored ticks, so new
+candle periods can be added without retrieving the ticks from the datasource again.
+"""
+import logging
+from datetime import datetime
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+
+from algobuilder.utils import DatabaseUtility
+from pricedata import models
+from pricedata.aggregation import CandleAggregator, TickAggregator
+
+
+class TickStore:
+    """
+    Retrieves, stores and reads ticks for datasource symbols, and aggregates them into candles.
+    """
+
+    # Logger
+    __log = logging.getLogger(__name__)
+
+    # The columns of the candles built from ticks. The same as those returned by DataSourceImplementation.get_prices
+    __candle_columns = ['time', 'period', 'bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high',
+                        'ask_low', 'ask_close', 'volume']
+
+    @staticmethod
+    def retrieve(ds_instance, datasource_symbol: models.DataSourceSymbol, from_date: datetime, to_date: datetime):
+        """
+        Retrieves the ticks for the datasource symbol from the datasource and stores them, for the part of the time
+        range that ticks haven't already been retrieved for. Ticks are retrieved and stored a window at a time, so
+        that the memory required is bounded by the window size and an interrupted retrieval continues from the last
+        window stored.
+        :param ds_instance: The DataSourceImplementation to retrieve the ticks from. Must implement get_ticks.
+        :param datasource_symbol:
+        :param from_date: The time to retrieve ticks from
+        :param to_date: The time to retrieve ticks up to, but not including
+        :return:
+        """
+        # The ranges that ticks haven't been retrieved for. Before and after the range already retrieved, so that the
+        # range retrieved is always contiguous.
+        if datasource_symbol.ticks_from is None:
+            ranges = [(from_date, to_date)]
+        else:
+            ranges = [(from_date, datasource_symbol.ticks_from), (datasource_symbol.ticks_to, to_date)]
+
+        for range_from, range_to in ranges:
+            for window_from, window_to in TickStore.__windows(range_from, range_to):
+                ticks = ds_instance.get_ticks(datasource_symbol.symbol.name, window_from, window_to,
+                                              datasource_symbol.symbol_info_dict)
+                TickStore.__log.debug(f"{len(ticks.index)} ticks retrieved for {datasource_symbol.symbol.name} from "
+                                      f"{window_from} to {window_to}.")
+
+                with transaction.atomic():
+                    TickStore.save(datasource_symbol.id, ticks, window_from, window_to)
+
+                    # Extend the range retrieved. Windows are contiguous with it.
+                    if datasource_symbol.ticks_from is None or window_from < datasource_symbol.ticks_from:
+                        datasource_symbol.ticks_from = window_from
+                    if datasource_symbol.ticks_to is None or window_to > datasource_symbol.ticks_to:
+                        datasource_symbol.ticks_to = window_to
+                    datasource_symbol.save(update_fields=['ticks_from', 'ticks_to'])
+
+    @staticmethod
+    def save(datasource_symbol_id: int, ticks: pd.DataFrame, from_date: datetime, to_date: datetime):
+        """
+        Stores the ticks for the datasource symbol, replacing any already stored for the time range.
+        :param datasource_symbol_id:
+        :param ticks: Dataframe with columns time (UTC), bid and ask.
+        :param from_date: The time that the ticks are from
+        :param to_date: The time that the ticks are up to, but not including. Ticks from this time are not stored.
+        :return:
+        """
+        ticks = ticks[(ticks['time'] >= pd.Timestamp(from_date)) & (ticks['time'] < pd.Timestamp(to_date))]
+        data = pd.DataFrame({'datasource_symbol_id': datasource_symbol_id, 'time': ticks['time'],
+                             'bid': ticks['bid'], 'ask': ticks['ask']})
+
+        with transaction.atomic():
+            if len(data.index) > 0:
+                TickStore.create_partitions(data['time'].min(), data['time'].max())
+
+            models.Tick.objects.filter(datasource_symbol_id=datasource_symbol_id, time__gte=from_date,
+                                       time__lt=to_date).delete()
+            DatabaseUtility.bulk_copy(data, models.Tick.objects.model._meta.db_table)
+
+    @staticmethod
+    def get(datasource_symbol_id: int, from_date: datetime, to_date: datetime) -> pd.DataFrame:
+        """
+        Gets the stored ticks for the datasource symbol.
+        :param datasource_symbol_id:
+        :param from_date: The time to get ticks from
+        :param to_date: The time to get ticks up to, but not including
+        :return: Dataframe indexed and sorted on time (UTC) with bid and ask columns.
+        """
+        ticks = pd.DataFrame.from_records(
+            models.Tick.objects.filter(datasource_symbol_id=datasource_symbol_id, time__gte=from_date,
+                                       time__lt=to_date).order_by('time').values_list('time', 'bid', 'ask'),
+            columns=['time', 'bid', 'ask'])
+
+        return ticks.set_index(pd.DatetimeIndex(pd.to_datetime(ticks['time'], utc=True), name='time'))[['bid', 'ask']]
+
+    @staticmethod
+    def get_candles(datasource_symbol_id: int, period: str, from_date: datetime, to_date: datetime) -> pd.DataFrame:
+        """
+        Aggregates the stored ticks for the datasource symbol into candles, a window of ticks at a time. Ticks must
+        have been retrieved up to the to date.
+        :param datasource_symbol_id:
+        :param period: The candle period
+        :param from_date: The time to build candles from. Candles are built from the start of the candle that this
+            falls into.
+        :param to_date: The time that ticks have been retrieved up to. Candles that don't close by this time are partial
+            and are not returned.
+        :return: Dataframe of candles with columns time (UTC), period, bid_open, bid_high, bid_low, bid_close, ask_open,
+            ask_high, ask_low, ask_close and volume. Volume is the number of ticks.
+        """
+        # Windows that start and end on candle boundaries, so that no candle is split across windows
+        from_ns = CandleAggregator.bin_starts(pd.DatetimeIndex([pd.Timestamp(from_date)]).asi8, period)[0]
+        to_ns = pd.Timestamp(to_date).value
+        if from_ns >= to_ns:
+            return pd.DataFrame(columns=TickStore.__candle_columns)
+
+        edges = CandleAggregator.bin_starts(
+            pd.date_range(pd.Timestamp(from_ns, tz='UTC'), pd.Timestamp(to_date),
+                          freq=settings.ALGOBUILDER_PRICEDATA_TICK_WINDOW).asi8, period)
+        edges = np.unique(np.concatenate([[from_ns], edges[edges > from_ns], [to_ns]]))
+
+        candles = []
+        for window_from, window_to in zip(edges[:-1], edges[1:]):
+            ticks = TickStore.get(datasource_symbol_id, pd.Timestamp(window_from, tz='UTC').to_pydatetime(),
+                                  pd.Timestamp(window_to, tz='UTC').to_pydatetime())
+            if len(ticks.index) > 0:
+                candles.append(TickAggregator.aggregate(ticks.index.asi8, ticks['bid'].to_numpy(),
+                                                        ticks['ask'].to_numpy(), [period], complete_to=to_ns)[period])
+
+        return pd.concat(candles, ignore_index=True)[TickStore.__candle_columns] if len(candles) > 0 \
+            else pd.DataFrame(columns=TickStore.__candle_columns)
+
+    @staticmethod
+    def create_partitions(from_date: datetime, to_date: datetime):
+        """
+        Creates the monthly partitions of the tick table for the time range if they don't already exist.
+        :param from_date:
+        :param to_date:
+        :return:
+        """
+        table = models.Tick.objects.model._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Prevent concurrent stores creating the same partition
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [table])
+            for partition_from, partition_to in TickStore.__months(from_date, to_date):
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_{partition_from.strftime('%Y%m')} "
+                               f"PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", [partition_from, partition_to])
+
+    @staticmethod
+    def __months(from_date: datetime, to_date: datetime) -> List[Tuple[datetime, datetime]]:
+        """
+        Returns the start and end of each month in the time range, UTC.
+        """
+        starts = pd.date_range(pd.Timestamp(from_date).tz_convert('UTC').replace(day=1).normalize(),
+                               pd.Timestamp(to_date).tz_convert('UTC'), freq='MS')
+        return [(start.to_pydatetime(), (start + pd.offsets.MonthBegin(1)).to_pydatetime()) for start in starts]
+
+    @staticmethod
+    def __windows(from_date: datetime, to_date: datetime) -> List[Tuple[datetime, datetime]]:
+        """
+        Splits the time range into windows of the tick window size.
+        """
+        if from_date >= to_date:
+            return []
+
+        edges = list(pd.date_range(pd.Timestamp(from_date), pd.Timestamp(to_date),
+                                   freq=settings.ALGOBUILDER_PRICEDATA_TICK_WINDOW))
+        edges = [edge.to_pydatetime() for edge in edges if edge < pd.Timestamp(to_date)] + [to_date]
+        return list(zip(edges[:-1], edges[1:]))
@@ -19,6 +19,7 @@ from django.shortcuts import render, redirect
 from django.utils import timezone
 from django.views import View
 
+from algobuilder.utils import django_cache
 from pricedata import models, forms, tasks
 
 
@@ -624,9 +625,10 @@ class BatchManager:
         return params
 
     @staticmethod
+    @django_cache(tags=['summary'])
     def get_summary_data(period: str, datasource: str = 'all') -> pd.DataFrame:
         """
-        Gets the summary data from the last batch for the specified period
+        Gets the summary data from the last batch for the specified period. Cached until the next batch completes.
         :param period: The candle period for the summary data
         :param datasource: The datasource for the candle data. 'all' for a summary across all datasources. 'all' is
             default.
@@ -660,9 +662,11 @@ class BatchManager:
         return data
 
     @staticmethod
+    @django_cache(tags=['summary'])
     def get_aggregate_data(period: str, datasource: str, aggregation_period: str, from_date, to_date) -> pd.DataFrame:
         """
-        Gets the aggregate data from the last batch for the specified period and datasoruce
+        Gets the aggregate data from the last batch for the specified period and datasoruce. Cached until the next
+        batch completes.
         :param period: The candle period for the summary data
         :param datasource: The datasource for the candle data.
         :param aggregation_period. The aggregation period to aggregate the data to.